@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+from pydub import AudioSegment
+from pydub.silence import detect_silence
+
+
+@dataclass
+class AudioChunk:
+    """
+    A part of a longer recording, transcribed on its own.
+    """
+    audio: AudioSegment
+    overlaps_previous: bool  # whether it starts with the end of the previous chunk
+
+
+def split_audio(audio: AudioSegment, chunk_seconds: int, overlap_seconds: float) -> list[AudioChunk]:
+    """
+    Splits a recording into chunks of at most chunk_seconds.
+    Chunks are cut in a pause near the end of the window where there is one,
+    otherwise they are cut at the window end and the next chunk repeats the last
+    overlap_seconds, so words cut in half are still transcribed once in full.
+    :param audio: The recording
+    :param chunk_seconds: The maximum length of a chunk
+    :param overlap_seconds: The overlap of chunks that could not be cut in a pause
+    :return: The chunks, in order
+    """
+    window = chunk_seconds * 1000
+    if len(audio) <= window:
+        return [AudioChunk(audio, overlaps_previous=False)]
+
+    overlap = int(overlap_seconds * 1000)
+    # Pauses of half a second, clearly quieter than the recording on average
+    silences = detect_silence(audio, min_silence_len=500, silence_thresh=audio.dBFS - 16, seek_step=50)
+
+    chunks = []
+    start, overlaps_previous = 0, False
+    while len(audio) - start > window:
+        end = start + window
+        # Prefer the last pause in the final quarter of the window
+        pauses = [(silence_start + silence_end) // 2 for silence_start, silence_end in silences
+                  if end - window // 4 <= (silence_start + silence_end) // 2 < end]
+        if pauses:
+            cut = pauses[-1]
+            chunks.append(AudioChunk(audio[start:cut], overlaps_previous))
+            start, overlaps_previous = cut, False
+        else:
+            chunks.append(AudioChunk(audio[start:end], overlaps_previous))
+            start, overlaps_previous = end - overlap, overlap > 0
+    chunks.append(AudioChunk(audio[start:], overlaps_previous))
+    return chunks
+
+
+def stitch_transcripts(transcripts: list[str], chunks: list[AudioChunk], max_overlap_words: int = 20) -> str:
+    """
+    Joins the transcripts of the chunks of a recording, dropping the words
+    that were transcribed twice where chunks overlap.
+    :param transcripts: The transcripts of the chunks, in order
+    :param chunks: The chunks
+    :param max_overlap_words: The maximum number of words to look for in both transcripts
+    :return: The transcript of the whole recording
+    """
+    words = []
+    for transcript, chunk in zip(transcripts, chunks):
+        chunk_words = transcript.split()
+        if chunk.overlaps_previous and words:
+            chunk_words = chunk_words[_repeated_words(words, chunk_words, max_overlap_words):]
+        words.extend(chunk_words)
+    return ' '.join(words)
+
+
+def _repeated_words(previous: list[str], current: list[str], max_words: int) -> int:
+    """
+    Gets how many words at the start of current repeat the end of previous.
+    """
+    def normalise(word):
+        return word.strip('.,!?;:…"\'«»()-').lower()
+
+    for length in range(min(max_words, len(previous), len(current)), 0, -1):
+        if [normalise(w) for w in previous[-length:]] == [normalise(w) for w in current[:length]]:
+            return length
+    return 0
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from contextvars import ContextVar
+
+_current_scope: ContextVar[CancelScope | None] = ContextVar('cancel_scope', default=None)
+
+
+class CancelScope:
+    """
+    The tasks working on one update: the task handling it and the tasks it starts.
+    Cancelling the scope cancels all of them, which aborts their HTTP requests and Telegram sends.
+    The scope is cancelled by itself once its deadline has passed.
+    """
+
+    def __init__(self, key: tuple, timeout: float = 0):
+        """
+        Initializes the scope.
+        :param key: The chat ID and the user ID of the update
+        :param timeout: How long the update may take, in seconds, 0 for no deadline
+        """
+        self.key = key
+        self.tasks: set[asyncio.Task] = set()
+        self.cancelled = False
+        loop = asyncio.get_running_loop()
+        self.deadline = loop.time() + timeout if timeout > 0 else None
+        self.timer = loop.call_later(timeout, self.__expire) if timeout > 0 else None
+
+    def add(self, task: asyncio.Task):
+        """
+        Adds a task to the scope. A task added to a cancelled scope is cancelled right away.
+        """
+        if self.cancelled:
+            task.cancel()
+            return
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def remaining(self) -> float | None:
+        """
+        Gets the time left until the deadline, in seconds, or None if there is no deadline.
+        """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - asyncio.get_running_loop().time(), 0.0)
+
+    def cancel(self):
+        """
+        Cancels all tasks of the scope.
+        """
+        self.cancelled = True
+        self.close()
+        for task in list(self.tasks):
+            task.cancel()
+
+    def close(self):
+        """
+        Stops the deadline timer.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def __expire(self):
+        logging.warning(f'Update of chat and user IDs {self.key} missed its deadline, cancelling it')
+        self.cancel()
+
+
+def current_scope() -> CancelScope | None:
+    """
+    Gets the cancel scope of the update that is being handled, if any.
+    """
+    return _current_scope.get()
+
+
+class CancelScopes:
+    """
+    Keeps the cancel scopes of the updates of each user in each chat that are being handled,
+    so that starting a new flow can cancel the ones that are still running.
+    Work that should outlive the update that started it runs in detached tasks, outside of every scope.
+    """
+
+    def __init__(self, timeout: float = 0):
+        """
+        Initializes the cancel scopes.
+        :param timeout: How long an update may take, in seconds, 0 for no deadline
+        """
+        self.timeout = timeout
+        self.scopes: dict[tuple, set[CancelScope]] = {}  # {(chat_id, user_id): scopes of the running updates}
+        self.detached: set[asyncio.Task] = set()
+
+    def open(self, key: tuple) -> CancelScope:
+        """
+        Opens a scope for the current task and makes it the current scope, until the task is done.
+        :param key: The chat ID and the user ID of the update
+        :return: The scope
+        """
+        scope = CancelScope(key, self.timeout)
+        task = asyncio.current_task()
+        scope.add(task)
+        scopes = self.scopes.setdefault(key, set())
+        scopes.add(scope)
+        task.add_done_callback(lambda _: self.__close(scope))
+        _current_scope.set(scope)
+        return scope
+
+    def __close(self, scope: CancelScope):
+        scope.close()
+        scopes = self.scopes.get(scope.key)
+        if scopes is not None:
+            scopes.discard(scope)
+            if not scopes:
+                del self.scopes[scope.key]
+
+    def cancel(self, key: tuple) -> int:
+        """
+        Cancels the updates of a user in a chat that are still being handled.
+        :param key: The chat ID and the user ID
+        :return: The number of cancelled updates
+        """
+        scopes = self.scopes.pop(key, set())
+        for scope in scopes:
+            scope.cancel()
+        if scopes:
+            logging.info(f'Cancelled {len(scopes)} running updates of chat and user IDs {key}')
+        return len(scopes)
+
+    def detach(self, coroutine, name: str | None = None) -> asyncio.Task:
+        """
+        Runs a coroutine in a task outside of every cancel scope, for work that outlives the update
+        that started it, e.g. a pipeline that takes hours. The task is neither cancelled by new commands
+        nor by the update deadline, only by close().
+        :param coroutine: The coroutine
+        :param name: The name of the task, for the logs
+        :return: The task
+        """
+        async def _run():
+            _current_scope.set(None)
+            return await coroutine
+
+        task = asyncio.create_task(_run(), name=name)
+        self.detached.add(task)
+        task.add_done_callback(self.__detached_done)
+        return task
+
+    def __detached_done(self, task: asyncio.Task):
+        self.detached.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f'Background task {task.get_name()} failed', exc_info=task.exception())
+
+    async def close(self):
+        """
+        Cancels the detached tasks and waits for them, e.g. when the bot shuts down.
+        """
+        tasks = list(self.detached)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import deque
+
+import httpx
+
+# Response headers that are not worth keeping, or that must not end up in a cassette file
+IGNORED_HEADERS = ('set-cookie', 'date', 'connection', 'keep-alive', 'transfer-encoding')
+
+
+def request_key(request: httpx.Request) -> str:
+    """
+    Gets the key a request is matched by: its method, its URL without the host and its body.
+    JSON bodies are compared regardless of the order of their keys, other bodies (e.g. uploads
+    with a random multipart boundary) are not compared at all.
+    :param request: The request
+    :return: The key
+    """
+    body = ''
+    try:
+        content = request.content
+        if content:
+            body = hashlib.sha256(json.dumps(json.loads(content), sort_keys=True).encode()).hexdigest()
+    except (httpx.RequestNotRead, ValueError):
+        pass
+    return f'{request.method} {request.url.raw_path.decode()} {body}'
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    """
+    Records the responses of an HTTP client to a cassette file, or replays them without a network.
+    Responses are recorded chunk by chunk, together with how long each chunk took to arrive,
+    so streamed completions can be replayed with their original timing.
+    """
+
+    def __init__(self, path: str, mode: str, transport: httpx.AsyncBaseTransport | None = None,
+                 preserve_latency: bool = False):
+        """
+        Initializes the transport.
+        :param path: The path of the cassette file
+        :param mode: 'record' to send requests and record their responses, appending them to the cassette,
+                     or 'replay' to answer requests from the cassette
+        :param transport: The transport that sends the requests when recording
+        :param preserve_latency: Whether replayed responses take as long as the recorded ones
+        """
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown cassette mode {mode}, expected record or replay')
+        if mode == 'record' and transport is None:
+            raise ValueError('Recording a cassette needs a transport to send the requests')
+        self.path = path
+        self.mode = mode
+        self.transport = transport
+        self.preserve_latency = preserve_latency
+        self.interactions: list[dict] = []
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                self.interactions = json.load(file)['interactions']
+        elif mode == 'replay':
+            raise FileNotFoundError(f'Cassette {path} does not exist, record it first')
+        self.unplayed: dict[str, deque[dict]] = {}  # {request key: interactions not replayed yet}
+        for interaction in self.interactions:
+            self.unplayed.setdefault(interaction['key'], deque()).append(interaction)
+        logging.info(f"{'Recording' if mode == 'record' else 'Replaying'} HTTP traffic "
+                     f"{'to' if mode == 'record' else 'from'} cassette {path} ({len(self.interactions)} interactions)")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        if self.mode == 'replay':
+            return await self.__replay(request)
+        return await self.__record(request)
+
+    async def __record(self, request: httpx.Request) -> httpx.Response:
+        start = time.monotonic()
+        response = await self.transport.handle_async_request(request)
+        interaction = {
+            'key': request_key(request),
+            'request': {'method': request.method, 'url': str(request.url)},
+            'response': {
+                'status_code': response.status_code,
+                'headers': [[name, value] for name, value in response.headers.multi_items()
+                            if name.lower() not in IGNORED_HEADERS],
+                'latency': time.monotonic() - start,
+                'chunks': []  # [[seconds since the previous chunk, base64 data]]
+            }
+        }
+        if response.is_stream_consumed:
+            # The transport has read the body already, e.g. a response that was built in memory
+            interaction['response']['chunks'].append([0.0, base64.b64encode(response.content).decode()])
+            self.__save(interaction)
+            return response
+        response.stream = _RecordingStream(response.stream, interaction, self.__save)
+        return response
+
+    def __save(self, interaction: dict):
+        """
+        Appends a recorded interaction to the cassette file.
+        """
+        self.interactions.append(interaction)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path, 'w', encoding='utf-8') as file:
+            json.dump({'interactions': self.interactions}, file, indent=2)
+
+    async def __replay(self, request: httpx.Request) -> httpx.Response:
+        key = request_key(request)
+        queue = self.unplayed.get(key)
+        if not queue:
+            raise httpx.ConnectError(f'No recorded response left in cassette {self.path} for {key}', request=request)
+        recorded = queue.popleft()['response']
+        if self.preserve_latency:
+            await asyncio.sleep(recorded['latency'])
+        return httpx.Response(
+            status_code=recorded['status_code'],
+            headers=recorded['headers'],
+            stream=_ReplayStream(recorded['chunks'], self.preserve_latency),
+            request=request
+        )
+
+    async def aclose(self):
+        if self.transport is not None:
+            await self.transport.aclose()
+
+
+class _RecordingStream(httpx.AsyncByteStream):
+    """
+    A response stream that records its chunks and their timing as they are read.
+    """
+
+    def __init__(self, stream, interaction: dict, on_done):
+        self.stream = stream
+        self.interaction = interaction
+        self.on_done = on_done
+        self.saved = False
+
+    async def __aiter__(self):
+        last = time.monotonic()
+        async for chunk in self.stream:
+            now = time.monotonic()
+            self.interaction['response']['chunks'].append([now - last, base64.b64encode(chunk).decode()])
+            last = now
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.saved:
+                self.saved = True
+                self.on_done(self.interaction)
+
+
+class _ReplayStream(httpx.AsyncByteStream):
+    """
+    A response stream that replays recorded chunks, optionally with their original timing.
+    """
+
+    def __init__(self, chunks: list, preserve_latency: bool):
+        self.chunks = chunks
+        self.preserve_latency = preserve_latency
+
+    async def __aiter__(self):
+        for delay, data in self.chunks:
+            if self.preserve_latency:
+                await asyncio.sleep(delay)
+            yield base64.b64decode(data)
+
+    async def aclose(self):
+        pass
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class ChatQueue:
+    """
+    Serialises the requests of each chat, so that only one of them changes the conversation
+    at a time, while requests of different chats run in parallel.
+    Optionally, queries that queue up behind a running request are merged into one request.
+    """
+
+    def __init__(self, coalesce=False):
+        """
+        Initializes the chat queue.
+        :param coalesce: Whether queued queries of the same chat are merged into one request
+        """
+        self.coalesce = coalesce
+        self.locks: dict[int, asyncio.Lock] = {}  # {chat_id: lock}
+        self.waiting: dict[int, int] = {}  # {chat_id: number of requests holding or waiting for the lock}
+        self.pending: dict[int, list[list[str]]] = {}  # {chat_id: queued queries}
+
+    @asynccontextmanager
+    async def turn(self, chat_id: int, query: str | None = None):
+        """
+        Waits until it is the turn of the request in its chat, in order of arrival.
+        When coalescing, the first queued request takes the queries of all requests queued behind it,
+        and those requests get None instead of their query.
+        :param chat_id: The chat ID
+        :param query: The query of the request, if it may be merged with others
+        :return: The query to send, or None if it has been sent along with an earlier one
+        """
+        entry = [query]
+        merge = self.coalesce and query is not None
+        if merge:
+            self.pending.setdefault(chat_id, []).append(entry)
+
+        lock = self.locks.setdefault(chat_id, asyncio.Lock())
+        self.waiting[chat_id] = self.waiting.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                if not merge:
+                    yield query
+                    return
+                queued = self.pending.get(chat_id, [])
+                if not any(item is entry for item in queued):
+                    yield None
+                    return
+                merged = '\n\n'.join(item[0] for item in queued)
+                queued.clear()
+                yield merged
+        finally:
+            if merge:
+                queued = self.pending.get(chat_id, [])
+                # Drop the query if the request was cancelled before its turn
+                queued[:] = [item for item in queued if item is not entry]
+                if not queued:
+                    self.pending.pop(chat_id, None)
+            self.waiting[chat_id] -= 1
+            if self.waiting[chat_id] == 0:
+                del self.waiting[chat_id]
+                del self.locks[chat_id]
+
+    def busy(self, chat_id: int) -> bool:
+        """
+        Checks if a request of the chat is running or waiting for its turn.
+        """
+        return chat_id in self.waiting
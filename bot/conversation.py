@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import datetime
+import json
+
+
+class Conversation:
+    """
+    Chat history of a single conversation.
+    Every message is stored together with its token count, and a running total is
+    kept up to date, so the size of the history is known without re-encoding it.
+    The history starts with the system prompt, followed by the summary of older turns
+    once the conversation has been compacted, followed by the recent turns verbatim.
+    """
+
+    def __init__(self):
+        self.messages: list[dict] = []
+        self.token_counts: list[int] = []
+        self.token_total = 0
+        self.size = 0  # approximate size of the messages in bytes
+        self.summary: str | None = None
+        self.vision = False
+        self.last_updated = datetime.datetime.now()
+
+    @staticmethod
+    def message_size(message: dict) -> int:
+        """
+        Gets the approximate size of a message in bytes.
+        """
+        return len(json.dumps(message))
+
+    @property
+    def preamble_size(self) -> int:
+        """
+        The number of leading messages that are not conversation turns (system prompt and summary).
+        """
+        return 2 if self.summary is not None else 1
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def append(self, message: dict, tokens: int):
+        """
+        Appends a message to the history.
+        :param message: The message as sent to the API
+        :param tokens: The number of tokens the message takes up
+        """
+        self.messages.append(message)
+        self.token_counts.append(tokens)
+        self.token_total += tokens
+        self.size += self.message_size(message)
+
+    def pop(self, index: int = -1) -> tuple[dict, int]:
+        """
+        Removes a message from the history.
+        :param index: The index of the message to remove, defaults to the last one
+        :return: The removed message and its token count
+        """
+        message = self.messages.pop(index)
+        tokens = self.token_counts.pop(index)
+        self.token_total -= tokens
+        self.size -= self.message_size(message)
+        return message, tokens
+
+    def truncate(self, max_messages: int) -> list[dict]:
+        """
+        Keeps only the most recent turns, along with the system prompt and summary.
+        :param max_messages: The number of messages to keep
+        :return: The removed messages
+        """
+        start = self.preamble_size
+        dropped = min(len(self.messages) - max_messages, len(self.messages) - start - 1)
+        if dropped <= 0:
+            return []
+        end = start + dropped
+        # Tool results are meaningless without the call that requested them
+        while end < len(self.messages) - 1 and self.messages[end]['role'] in ('function', 'tool'):
+            end += 1
+        removed = self.messages[start:end]
+        self.token_total -= sum(self.token_counts[start:end])
+        self.size -= sum(self.message_size(message) for message in removed)
+        del self.messages[start:end]
+        del self.token_counts[start:end]
+        return removed
+
+    def to_dict(self) -> dict:
+        """
+        Serialises the conversation.
+        :return: A JSON serialisable dictionary
+        """
+        return {
+            'messages': self.messages,
+            'token_counts': self.token_counts,
+            'summary': self.summary,
+            'vision': self.vision,
+            'last_updated': self.last_updated.isoformat()
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Conversation:
+        """
+        Restores a conversation serialised with to_dict().
+        :param data: The serialised conversation
+        :return: The conversation
+        """
+        conversation = cls()
+        for message, tokens in zip(data['messages'], data['token_counts']):
+            conversation.append(message, tokens)
+        conversation.summary = data.get('summary')
+        conversation.vision = data.get('vision', False)
+        conversation.last_updated = datetime.datetime.fromisoformat(data['last_updated'])
+        return conversation
+
+    def image_refs(self) -> list[str]:
+        """
+        Gets the references of the images in the conversation, once per message part.
+        """
+        return [part['ref'] for message in self.messages if isinstance(message.get('content'), list)
+                for part in message['content'] if part['type'] == 'image_ref']
@@ -0,0 +1,406 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from conversation import Conversation
+from image_store import ImageStore
+
+
+class ConversationStore(ABC):
+    """
+    Keeps the conversation histories of all chats, by chat ID.
+    """
+
+    @abstractmethod
+    def __contains__(self, chat_id: int) -> bool:
+        pass
+
+    @abstractmethod
+    def get(self, chat_id: int) -> Conversation | None:
+        """
+        Gets the conversation of a chat, or None if there is none.
+        """
+        pass
+
+    @abstractmethod
+    def __setitem__(self, chat_id: int, conversation: Conversation):
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    def __getitem__(self, chat_id: int) -> Conversation:
+        conversation = self.get(chat_id)
+        if conversation is None:
+            raise KeyError(chat_id)
+        return conversation
+
+    def save(self, chat_id: int):
+        """
+        Persists the changes made to the conversation of a chat, if the store is persistent.
+        """
+        pass
+
+    def close(self):
+        """
+        Persists and releases everything the store holds.
+        """
+        pass
+
+
+class LRUConversationStore(ConversationStore):
+    """
+    Keeps conversations in memory, bounded by their number, their total size and their age.
+    The least recently used conversations are evicted first. Expired conversations are evicted
+    from the least recently used end, so every use of the store only looks at a few of them.
+    Conversations of chats with a request in flight are never evicted.
+    """
+
+    def __init__(self, max_conversations: int = 1000, max_bytes: int = 0, max_age_minutes: int = 0,
+                 on_evict=None, in_use=None):
+        """
+        Initializes the store.
+        :param max_conversations: The maximum number of conversations, 0 for no limit
+        :param max_bytes: The maximum total size of the conversations in bytes, 0 for no limit
+        :param max_age_minutes: How long a conversation is kept after it was last updated, 0 for no limit
+        :param on_evict: Called with the chat ID and the conversation of every evicted conversation
+        :param in_use: Called with a chat ID to check if the chat has a request in flight
+        """
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.max_age_minutes = max_age_minutes
+        self.on_evict = on_evict
+        self.in_use = in_use
+        self.conversations: OrderedDict[int, Conversation] = OrderedDict()
+        # The size of each conversation when it was last used, and their running total
+        self.sizes: dict[int, int] = {}
+        self.total_bytes = 0
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self.conversations
+
+    def get(self, chat_id: int) -> Conversation | None:
+        conversation = self.conversations.get(chat_id)
+        if conversation is not None:
+            self.conversations.move_to_end(chat_id)
+            self.__track(chat_id, conversation)
+        self.evict()
+        return conversation
+
+    def __setitem__(self, chat_id: int, conversation: Conversation):
+        self.conversations[chat_id] = conversation
+        self.conversations.move_to_end(chat_id)
+        self.__track(chat_id, conversation)
+        self.evict()
+
+    def __len__(self) -> int:
+        return len(self.conversations)
+
+    def save(self, chat_id: int):
+        conversation = self.conversations.get(chat_id)
+        if conversation is not None:
+            self.__track(chat_id, conversation)
+
+    def pop(self, chat_id: int) -> Conversation | None:
+        """
+        Removes a conversation without evicting it.
+        """
+        self.total_bytes -= self.sizes.pop(chat_id, 0)
+        return self.conversations.pop(chat_id, None)
+
+    def __track(self, chat_id: int, conversation: Conversation):
+        """
+        Brings the total size up to date with the changes made to a conversation since it was last used.
+        """
+        self.total_bytes += conversation.size - self.sizes.get(chat_id, 0)
+        self.sizes[chat_id] = conversation.size
+
+    def __over_limits(self) -> bool:
+        if 0 < self.max_conversations < len(self.conversations):
+            return True
+        return 0 < self.max_bytes < self.total_bytes
+
+    def evict(self):
+        """
+        Evicts expired conversations, then the least recently used ones while the store is over its limits.
+        A conversation that was used after it expired is left to its owner, who resets it on its next use.
+        The most recently used conversation is never evicted for the limits. Conversations of chats
+        with a request in flight are moved to the most recently used end instead of being evicted.
+        """
+        if self.max_age_minutes > 0:
+            cutoff = datetime.datetime.now() - datetime.timedelta(minutes=self.max_age_minutes)
+            skipped = 0
+            while skipped < len(self.conversations):
+                chat_id, conversation = next(iter(self.conversations.items()))
+                if conversation.last_updated >= cutoff:
+                    break
+                if self.__busy(chat_id):
+                    skipped += 1
+                    continue
+                self.__evict(chat_id)
+        skipped = 0
+        while skipped < len(self.conversations) - 1 and self.__over_limits():
+            chat_id = next(iter(self.conversations))
+            if self.__busy(chat_id):
+                skipped += 1
+                continue
+            self.__evict(chat_id)
+
+    def __busy(self, chat_id: int) -> bool:
+        """
+        Checks if a chat has a request in flight, and if so, moves its conversation out of the way of eviction.
+        """
+        if self.in_use is None or not self.in_use(chat_id):
+            return False
+        self.conversations.move_to_end(chat_id)
+        return True
+
+    def __evict(self, chat_id: int):
+        conversation = self.pop(chat_id)
+        logging.debug(f'Evicting conversation of chat ID {chat_id}')
+        if self.on_evict is not None:
+            self.on_evict(chat_id, conversation)
+
+    def close(self):
+        for chat_id in list(self.conversations):
+            self.__evict(chat_id)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Keeps recently used conversations in memory and all conversations in a SQLite database.
+    Saved conversations are written in batches every flush interval, on a worker thread, so they survive
+    restarts without blocking the event loop. Cold conversations are dropped from memory and reloaded
+    on demand, together with the images they refer to. Reads go through a connection of their own,
+    so they never wait for a batch that is being written.
+    """
+
+    def __init__(self, path: str, image_store: ImageStore, max_conversations: int = 1000, max_bytes: int = 0,
+                 max_age_minutes: int = 0, on_evict=None, flush_interval: float = 1.0, in_use=None):
+        """
+        Initializes the store.
+        :param path: The path of the SQLite database
+        :param image_store: The image store the images of the conversations are kept in while in memory
+        :param max_conversations: The maximum number of conversations kept in memory, 0 for no limit
+        :param max_bytes: The maximum total size of the conversations kept in memory, 0 for no limit
+        :param max_age_minutes: How long a conversation is kept after it was last updated, 0 for no limit
+        :param on_evict: Called with the chat ID and the conversation of every conversation dropped from memory
+        :param flush_interval: How long saved conversations may wait before they are written, in seconds
+        :param in_use: Called with a chat ID to check if the chat has a request in flight
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # The writing connection is shared with the worker thread that writes the batches,
+        # the lock serialises its use. In WAL mode, the reading connection is not blocked by the writes
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.lock = threading.Lock()
+        self.db.execute('CREATE TABLE IF NOT EXISTS conversations '
+                        '(chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, last_updated REAL NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS images (ref TEXT PRIMARY KEY, data BLOB NOT NULL)')
+        indexed = self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                                  "AND name = 'conversation_images'").fetchone() is not None
+        self.db.execute('CREATE TABLE IF NOT EXISTS conversation_images '
+                        '(chat_id INTEGER NOT NULL, ref TEXT NOT NULL, PRIMARY KEY (chat_id, ref))')
+        if not indexed:
+            # Databases written before the images of each conversation were indexed
+            for chat_id, data in self.db.execute('SELECT chat_id, data FROM conversations').fetchall():
+                refs = set(Conversation.from_dict(json.loads(data)).image_refs())
+                self.db.executemany('INSERT INTO conversation_images (chat_id, ref) VALUES (?, ?)',
+                                    [(chat_id, ref) for ref in refs])
+        self.db.commit()
+        self.reader = sqlite3.connect(path)
+        self.image_store = image_store
+        self.max_age_minutes = max_age_minutes
+        self.on_evict = on_evict
+        self.flush_interval = flush_interval
+        self.memory = LRUConversationStore(max_conversations, max_bytes, max_age_minutes, on_evict=self.__spill,
+                                           in_use=in_use)
+        self.dirty: set[int] = set()  # chats in memory that were saved since the last flush
+        self.unsaved: dict[int, dict] = {}  # {chat_id: snapshot that is not written yet}
+        self.flush_task: asyncio.Task | None = None
+        self.last_purge = 0.0
+        self.purge_expired()
+
+    def __contains__(self, chat_id: int) -> bool:
+        if chat_id in self.memory or chat_id in self.unsaved:
+            return True
+        return self.reader.execute('SELECT 1 FROM conversations WHERE chat_id = ?', (chat_id,)).fetchone() is not None
+
+    def get(self, chat_id: int) -> Conversation | None:
+        conversation = self.memory.get(chat_id)
+        if conversation is None:
+            conversation = self.__load(chat_id)
+            if conversation is not None:
+                self.memory[chat_id] = conversation
+        return conversation
+
+    def __setitem__(self, chat_id: int, conversation: Conversation):
+        self.memory[chat_id] = conversation
+        self.save(chat_id)
+
+    def __len__(self) -> int:
+        stored = self.reader.execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+        new = sum(1 for chat_id in self.unsaved
+                  if self.reader.execute('SELECT 1 FROM conversations WHERE chat_id = ?', (chat_id,)).fetchone() is None)
+        return stored + new
+
+    def save(self, chat_id: int):
+        if chat_id not in self.memory:
+            return
+        self.memory.save(chat_id)
+        self.dirty.add(chat_id)
+        self.__schedule_flush()
+
+    def __snapshot(self, conversation: Conversation) -> dict:
+        """
+        Takes a copy of a conversation that the worker thread can serialise while the conversation changes.
+        """
+        refs = set(conversation.image_refs())
+        data = conversation.to_dict()
+        data['messages'] = list(data['messages'])
+        data['token_counts'] = list(data['token_counts'])
+        return {
+            'data': data,
+            'last_updated': conversation.last_updated.timestamp(),
+            'refs': refs,
+            'images': [(ref, self.image_store.blobs[ref]) for ref in refs if ref in self.image_store.blobs]
+        }
+
+    def __schedule_flush(self):
+        if self.flush_task is not None and not self.flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self.flush_task = loop.create_task(self.__flush_later())
+
+    async def __flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        batch = self.__take_batch()
+        purge = time.monotonic() - self.last_purge > 60
+        try:
+            await asyncio.to_thread(self.__write, batch, purge)
+        except Exception as e:
+            logging.error(f'Failed to write {len(batch)} conversations to the conversation store: {str(e)}')
+        finally:
+            self.__written(batch)
+        if self.dirty or self.unsaved:
+            self.flush_task = asyncio.get_running_loop().create_task(self.__flush_later())
+
+    def __take_batch(self) -> dict[int, dict]:
+        for chat_id in self.dirty:
+            conversation = self.memory.conversations.get(chat_id)
+            if conversation is not None:
+                self.unsaved[chat_id] = self.__snapshot(conversation)
+        self.dirty.clear()
+        return dict(self.unsaved)
+
+    def __written(self, batch: dict[int, dict]):
+        """
+        Forgets the snapshots of a batch, unless they were replaced by newer ones while it was written.
+        A batch that failed to be written is kept, to be retried with the next one.
+        """
+        for chat_id, snapshot in batch.items():
+            if self.unsaved.get(chat_id) is snapshot and snapshot.get('written'):
+                del self.unsaved[chat_id]
+
+    def flush(self):
+        """
+        Writes the saved conversations right away, blocking until they are written.
+        """
+        batch = self.__take_batch()
+        self.__write(batch, purge=False)
+        self.__written(batch)
+
+    def __write(self, batch: dict[int, dict], purge: bool):
+        with self.lock:
+            for chat_id, snapshot in batch.items():
+                self.db.executemany('INSERT OR IGNORE INTO images (ref, data) VALUES (?, ?)', snapshot['images'])
+                self.db.execute('INSERT OR REPLACE INTO conversations (chat_id, data, last_updated) VALUES (?, ?, ?)',
+                                (chat_id, json.dumps(snapshot['data']), snapshot['last_updated']))
+                self.db.execute('DELETE FROM conversation_images WHERE chat_id = ?', (chat_id,))
+                self.db.executemany('INSERT INTO conversation_images (chat_id, ref) VALUES (?, ?)',
+                                    [(chat_id, ref) for ref in snapshot['refs']])
+            if purge:
+                self.__purge()
+            self.db.commit()
+        for snapshot in batch.values():
+            snapshot['written'] = True
+
+    def __load(self, chat_id: int) -> Conversation | None:
+        snapshot = self.unsaved.get(chat_id)
+        if snapshot is not None:
+            for _, image in snapshot['images']:
+                self.image_store.put(image)
+            return Conversation.from_dict(snapshot['data'])
+
+        row = self.reader.execute('SELECT data FROM conversations WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row is None:
+            return None
+        data = json.loads(row[0])
+        for message in data['messages']:
+            if not isinstance(message.get('content'), list):
+                continue
+            for index, part in enumerate(message['content']):
+                if part['type'] != 'image_ref':
+                    continue
+                image = self.reader.execute('SELECT data FROM images WHERE ref = ?', (part['ref'],)).fetchone()
+                if image is None:
+                    logging.warning(f"Image {part['ref']} of chat ID {chat_id} is missing "
+                                    f"from the conversation store")
+                    message['content'][index] = {'type': 'text', 'text': '[image]'}
+                else:
+                    self.image_store.put(image[0])
+        return Conversation.from_dict(data)
+
+    def __spill(self, chat_id: int, conversation: Conversation):
+        """
+        Keeps a conversation that is dropped from memory until it is written to the database.
+        """
+        self.unsaved[chat_id] = self.__snapshot(conversation)
+        self.dirty.discard(chat_id)
+        self.__schedule_flush()
+        if self.on_evict is not None:
+            self.on_evict(chat_id, conversation)
+
+    def purge_expired(self):
+        """
+        Deletes expired conversations from the database, along with the images no conversation refers to anymore.
+        """
+        with self.lock:
+            self.__purge()
+            self.db.commit()
+
+    def __purge(self):
+        self.last_purge = time.monotonic()
+        if self.max_age_minutes <= 0:
+            return
+        cutoff = time.time() - self.max_age_minutes * 60
+        self.db.execute('DELETE FROM conversation_images WHERE chat_id IN '
+                        '(SELECT chat_id FROM conversations WHERE last_updated < ?)', (cutoff,))
+        deleted = self.db.execute('DELETE FROM conversations WHERE last_updated < ?', (cutoff,)).rowcount
+        if deleted > 0:
+            self.db.execute('DELETE FROM images WHERE ref NOT IN (SELECT ref FROM conversation_images)')
+            logging.info(f'Purged {deleted} expired conversations from the conversation store')
+
+    def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        self.memory.close()
+        self.flush()
+        self.reader.close()
+        self.db.close()
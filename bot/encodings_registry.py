@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import logging
+import threading
+
+import tiktoken
+
+# Encoding used for models that tiktoken does not know about
+FALLBACK_ENCODING = 'cl100k_base'
+
+_encodings: dict[str, tiktoken.Encoding] = {}  # {model: encoding}
+_lock = threading.Lock()
+
+
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Gets the tiktoken encoding for the given model.
+    Encodings are resolved once per model and shared by the whole process.
+    :param model: The model name
+    :return: The encoding used by the model, or the fallback encoding for unknown models
+    """
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        return encoding
+
+    with _lock:
+        if model not in _encodings:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                logging.warning(f'No tiktoken encoding known for model {model}, using {FALLBACK_ENCODING}')
+                _encodings[model] = tiktoken.get_encoding(FALLBACK_ENCODING)
+        return _encodings[model]
+
+
+def warm_up_encodings(models) -> None:
+    """
+    Loads the encodings for the given models eagerly, so the BPE files are
+    read at startup instead of on the first request.
+    :param models: The model names
+    """
+    for model in models:
+        if model:
+            get_encoding(model).encode('warm up')
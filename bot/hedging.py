@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+
+class HedgePolicy:
+    """
+    Sends a duplicate of a request that has not produced its first token after a while,
+    keeps whichever answers first and cancels the other one.
+    The delay is learned from the recent first token latencies of each kind of request,
+    and hedges are capped to a share of all requests, which bounds the extra spend.
+    """
+
+    def __init__(self, budget_percent: float = 5.0, percentile: float = 95.0, initial_delay: float = 10.0,
+                 min_delay: float = 1.0, max_delay: float = 60.0, window: int = 200, min_samples: int = 20):
+        """
+        Initializes the hedge policy.
+        :param budget_percent: The maximum share of requests that may be hedged, in percent
+        :param percentile: The percentile of the recent first token latencies after which a request is hedged
+        :param initial_delay: The delay used until enough latencies have been observed, in seconds
+        :param min_delay: The minimum delay, in seconds
+        :param max_delay: The maximum delay, in seconds
+        :param window: The number of recent latencies the delay is learned from
+        :param min_samples: The number of latencies needed before the delay is learned
+        """
+        self.budget_percent = budget_percent
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.window = window
+        self.min_samples = min_samples
+        self.latencies: dict[str, deque[float]] = {}  # {kind of request: recent first token latencies}
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0  # hedges that answered before the original request
+
+    def delay(self, kind: str) -> float:
+        """
+        Gets how long to wait for the first token before hedging a request.
+        :param kind: The kind of request, e.g. the model and whether it is streamed
+        :return: The delay in seconds
+        """
+        latencies = self.latencies.get(kind)
+        if latencies is None or len(latencies) < self.min_samples:
+            return self.initial_delay
+        ordered = sorted(latencies)
+        index = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+        return min(max(ordered[index], self.min_delay), self.max_delay)
+
+    def __record(self, kind: str, latency: float):
+        self.latencies.setdefault(kind, deque(maxlen=self.window)).append(latency)
+
+    def __within_budget(self) -> bool:
+        # Counting the hedge that is about to be sent, so the first slow requests are not all hedged
+        return self.hedges + 1 <= self.requests * self.budget_percent / 100
+
+    async def call(self, kind: str, attempt, discard=None, admit=None):
+        """
+        Runs a request, hedging it if it is slow to answer.
+        The clock of an attempt starts once it is admitted, e.g. once the rate limiter has granted its tokens,
+        so a request that is queued for its rate limit is neither hedged nor learned from as slow.
+        :param kind: The kind of request, requests of the same kind share their learned delay
+        :param attempt: An async function that sends the request, called with what admit returned,
+                        and returns once the first token has arrived
+        :param discard: An async function called with the result of an attempt that finished but lost the race
+        :param admit: An async function that waits until an attempt may be sent, e.g. for its rate limit,
+                      and returns what the attempt needs, e.g. its reservation. Each attempt is admitted separately
+        :return: The result of the attempt that answered first
+        """
+        self.requests += 1
+        starts: dict[asyncio.Task, float] = {}  # {attempt: when it was admitted}
+
+        async def _admitted(admitted: asyncio.Event | None = None):
+            admission = await admit() if admit is not None else None
+            starts[asyncio.current_task()] = time.monotonic()
+            if admitted is not None:
+                admitted.set()
+            return await attempt(admission)
+
+        admitted = asyncio.Event()
+        primary = asyncio.create_task(_admitted(admitted))
+        pending = {primary}
+        try:
+            waiting = asyncio.create_task(admitted.wait())
+            try:
+                await asyncio.wait({primary, waiting}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiting.cancel()
+            done, _ = await asyncio.wait(pending, timeout=self.delay(kind))
+            if done or not self.__within_budget():
+                result = await primary
+                self.__record(kind, time.monotonic() - starts[primary])
+                return result
+
+            self.hedges += 1
+            logging.info(f'No first token after {time.monotonic() - starts[primary]:.1f}s, hedging {kind} request')
+            hedge = asyncio.create_task(_admitted())
+            pending.add(hedge)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None]
+                if not winners:
+                    error = error or next(iter(done)).exception()
+                    continue
+                winner = winners[0]
+                for loser in winners[1:]:
+                    if discard is not None:
+                        await discard(loser.result())
+                if winner is hedge:
+                    self.wins += 1
+                self.__record(kind, time.monotonic() - starts[winner])
+                logging.debug(f'Hedge stats: {self.stats()}')
+                return winner.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        """
+        Gets the hedging statistics.
+        :return: A dictionary with the number of requests, hedges and hedges that answered first,
+                 the hedge and win rates, and the current delay of each kind of request
+        """
+        return {
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'wins': self.wins,
+            'hedge_rate': self.hedges / self.requests if self.requests else 0.0,
+            'win_rate': self.wins / self.hedges if self.hedges else 0.0,
+            'delays': {kind: self.delay(kind) for kind in self.latencies},
+        }
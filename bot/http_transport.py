@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import logging
+import os
+import urllib.request
+
+import httpx
+
+from cassette import CassetteTransport
+
+
+class PooledTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps the transport of an HTTP client to keep track of how much of its connection pool is used.
+    """
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport | EnvironmentProxyTransport, limits: httpx.Limits):
+        """
+        Initializes the transport.
+        :param transport: The transport that sends the requests
+        :param limits: The limits of its connection pool
+        """
+        self.transport = transport
+        self.limits = limits
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.saturated = 0  # requests sent while every connection was busy
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        if self.limits.max_connections is not None and self.in_flight > self.limits.max_connections:
+            self.saturated += 1
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self.in_flight -= 1
+            raise
+        # The connection stays in use until the response, which may be streamed, is closed
+        response.stream = _TrackedStream(response.stream, self.__done)
+        return response
+
+    def __done(self):
+        self.in_flight -= 1
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    def stats(self) -> dict:
+        """
+        Gets the pool statistics.
+        :return: A dictionary with the pool limits, the open and idle connections,
+                 the requests in flight, the peak of requests in flight, the total number of requests
+                 and how many of them had to wait for a connection
+        """
+        transports = getattr(self.transport, 'transports', [self.transport])
+        connections = [connection for transport in transports
+                       for connection in list(getattr(getattr(transport, '_pool', None), 'connections', []))]
+        return {
+            'max_connections': self.limits.max_connections,
+            'max_keepalive_connections': self.limits.max_keepalive_connections,
+            'connections': len(connections),
+            'idle_connections': sum(1 for connection in connections if connection.is_idle()),
+            'in_flight': self.in_flight,
+            'peak_in_flight': self.peak_in_flight,
+            'requests': self.requests,
+            'saturated': self.saturated,
+        }
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """
+    A response stream that reports when it is closed.
+    """
+
+    def __init__(self, stream, on_close):
+        self.stream = stream
+        self.on_close = on_close
+        self.closed = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.closed:
+                self.closed = True
+                self.on_close()
+
+
+class EnvironmentProxyTransport(httpx.AsyncBaseTransport):
+    """
+    Sends each request through the proxy that the HTTP_PROXY, HTTPS_PROXY, ALL_PROXY and NO_PROXY
+    environment variables set for its URL, the way httpx does for clients without an explicit transport.
+    """
+
+    def __init__(self, proxies: dict[str, str], **kwargs):
+        """
+        Initializes the transport.
+        :param proxies: The proxy of each URL scheme, and the hosts that are not proxied under 'no',
+                        as returned by urllib's getproxies()
+        :param kwargs: The arguments of the transports, e.g. their limits
+        """
+        self.proxies = proxies
+        self.direct = httpx.AsyncHTTPTransport(**kwargs)
+        self.proxied = {
+            scheme: httpx.AsyncHTTPTransport(proxy=httpx.Proxy(url if '://' in url else f'http://{url}'), **kwargs)
+            for scheme, url in proxies.items() if scheme in ('http', 'https', 'all') and url
+        }
+        self.transports = [self.direct] + list(self.proxied.values())
+        self.routes: dict[tuple[str, str], httpx.AsyncHTTPTransport] = {}  # {(scheme, host): transport}
+
+    def route(self, url: httpx.URL) -> httpx.AsyncHTTPTransport:
+        """
+        Gets the transport a request to the given URL is sent with.
+        """
+        key = (url.scheme, url.host)
+        if key not in self.routes:
+            transport = self.proxied.get(url.scheme) or self.proxied.get('all')
+            if transport is None or urllib.request.proxy_bypass_environment(url.host, self.proxies):
+                transport = self.direct
+            self.routes[key] = transport
+        return self.routes[key]
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.route(request.url).handle_async_request(request)
+
+    async def aclose(self):
+        for transport in self.transports:
+            await transport.aclose()
+
+
+def http2_available() -> bool:
+    """
+    Checks if the h2 package, which httpx needs for HTTP/2, is installed.
+    """
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def create_http_client(config: dict, name: str = 'openai') -> tuple[httpx.AsyncClient, PooledTransport]:
+    """
+    Creates the HTTP client used for the OpenAI API, with a pooled transport configured from the given config.
+    Without a configured proxy, the proxy environment variables are respected.
+    If a cassette mode is set, the traffic of the client is recorded to or replayed from its cassette.
+    :param config: A dictionary containing the GPT configuration
+    :param name: The name of the client, which is also the name of its cassette
+    :return: The HTTP client and its transport, which exposes the pool statistics
+    """
+    limits = httpx.Limits(
+        max_connections=config.get('http_max_connections', 1000),
+        max_keepalive_connections=config.get('http_max_keepalive_connections', 100),
+        keepalive_expiry=config.get('http_keepalive_expiry', 5.0)
+    )
+    timeout = httpx.Timeout(
+        config.get('http_read_timeout', 600.0),
+        connect=config.get('http_connect_timeout', 5.0),
+        pool=config.get('http_pool_timeout', 600.0)
+    )
+
+    http2 = config.get('http2', False)
+    if http2 and not http2_available():
+        logging.warning('HTTP2 is set to true, but the h2 package is not installed. '
+                        'Falling back to HTTP/1.1, install it with `pip install httpx[http2]`.')
+        http2 = False
+
+    proxy = config.get('proxy')
+    environment_proxies = urllib.request.getproxies() if not proxy else {}
+    if any(scheme != 'no' for scheme in environment_proxies):
+        # An explicit transport makes httpx ignore the proxy environment variables, so they are applied here
+        transport = EnvironmentProxyTransport(environment_proxies, limits=limits, http2=http2)
+    else:
+        transport = httpx.AsyncHTTPTransport(
+            limits=limits,
+            http2=http2,
+            proxy=httpx.Proxy(proxy) if proxy else None
+        )
+    pooled_transport = PooledTransport(transport, limits)
+
+    client_transport = pooled_transport
+    cassette_mode = config.get('cassette_mode', 'off')
+    if cassette_mode != 'off':
+        client_transport = CassetteTransport(
+            os.path.join(config.get('cassette_dir', 'cassettes'), f'{name}.json'),
+            cassette_mode,
+            transport=pooled_transport,
+            preserve_latency=config.get('cassette_preserve_latency', True)
+        )
+    return httpx.AsyncClient(transport=client_transport, timeout=timeout), pooled_transport
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import hashlib
+import io
+
+from utils import encode_image
+
+
+class ImageStore:
+    """
+    Content-addressed store for the images of vision conversations.
+    Conversation history only keeps a reference to an image, the image itself is
+    kept here once and dropped when the last reference to it is released.
+    """
+
+    def __init__(self):
+        self.blobs: dict[str, bytes] = {}  # {ref: image bytes}
+        self.references: dict[str, int] = {}  # {ref: reference count}
+
+    def put(self, image: bytes) -> str:
+        """
+        Stores an image and takes a reference to it.
+        :param image: The image bytes
+        :return: The reference of the image
+        """
+        ref = hashlib.sha256(image).hexdigest()
+        if ref not in self.blobs:
+            self.blobs[ref] = image
+        self.acquire(ref)
+        return ref
+
+    def acquire(self, ref: str):
+        """
+        Takes another reference to a stored image.
+        """
+        self.references[ref] = self.references.get(ref, 0) + 1
+
+    def release(self, ref: str):
+        """
+        Releases a reference to an image, removing the image once it is no longer referenced.
+        """
+        if ref not in self.references:
+            return
+        self.references[ref] -= 1
+        if self.references[ref] <= 0:
+            del self.references[ref]
+            self.blobs.pop(ref, None)
+
+    def data_url(self, ref: str) -> str:
+        """
+        Gets the image as a base64 data URL, as expected by the API.
+        """
+        return encode_image(io.BytesIO(self.blobs[ref]))
+
+    def __len__(self) -> int:
+        return len(self.blobs)
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+
+
+class JobStore:
+    """
+    Keeps the state of long-running jobs as JSON files in a directory, so they can be resumed after a restart,
+    e.g. the batches that were submitted and are still being processed.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Initializes the store.
+        :param directory: The directory the jobs are kept in
+        """
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def __path(self, name: str) -> str:
+        return os.path.join(self.directory, f'{name}.json')
+
+    def get(self, name: str) -> dict | None:
+        """
+        Gets the state of a job, or None if there is none.
+        """
+        try:
+            with open(self.__path(name), 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError as e:
+            logging.warning(f'Ignoring the unreadable state of job {name}: {str(e)}')
+            return None
+
+    def set(self, name: str, state: dict):
+        """
+        Saves the state of a job. The file is replaced atomically, so a crash never leaves half a state behind.
+        """
+        path = self.__path(name)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as file:
+            json.dump(state, file, ensure_ascii=False)
+        os.replace(f'{path}.tmp', path)
+
+    def delete(self, name: str):
+        """
+        Forgets a job.
+        """
+        try:
+            os.remove(self.__path(name))
+        except FileNotFoundError:
+            pass
+
+    def names(self, prefix: str = '') -> list[str]:
+        """
+        Gets the names of the saved jobs that start with the given prefix.
+        """
+        return sorted(name[:-len('.json')] for name in os.listdir(self.directory)
+                      if name.startswith(prefix) and name.endswith('.json'))
@@ -5,6 +5,10 @@ from dotenv import load_dotenv
 
 from plugin_manager import PluginManager
 from openai_helper import OpenAIHelper, default_max_tokens, are_functions_available
+from encodings_registry import warm_up_encodings
+from model_registry import load_models
+from prompt_templates import load_prompts, warm_up_prompts
+from rate_limiter import RateLimiter
 from telegram_bot import ChatGPTTelegramBot
 
 
@@ -27,6 +31,10 @@ def main():
         exit(1)
 
     # Setup configurations
+    if os.environ.get('MODEL_REGISTRY_FILE'):
+        load_models(os.environ['MODEL_REGISTRY_FILE'])
+    if os.environ.get('PROMPT_TEMPLATES_FILE'):
+        load_prompts(os.environ['PROMPT_TEMPLATES_FILE'])
     model = os.environ.get('OPENAI_MODEL', 'gpt-3.5-turbo')
     functions_available = are_functions_available(model=model)
     max_tokens_default = default_max_tokens(model=model)
@@ -34,9 +42,63 @@ def main():
         'api_key': os.environ['OPENAI_API_KEY'],
         'show_usage': os.environ.get('SHOW_USAGE', 'false').lower() == 'true',
         'stream': os.environ.get('STREAM', 'true').lower() == 'true',
+        'stream_usage': os.environ.get('STREAM_USAGE', 'true').lower() == 'true',
         'proxy': os.environ.get('PROXY', None) or os.environ.get('OPENAI_PROXY', None),
+        'base_url': os.environ.get('OPENAI_BASE_URL', None),
+        'providers': [name.strip() for name in os.environ.get('LLM_PROVIDERS', 'openai').split(',') if name.strip()],
+        'yandexgpt_api_key': os.environ.get('YANDEXGPT_TOKEN', ''),
+        'yandexgpt_folder_id': os.environ.get('YANDEXGPT_FOLDER_ID', ''),
+        'yandexgpt_model': os.environ.get('YANDEXGPT_MODEL', 'yandexgpt-lite/latest'),
+        'yandexgpt_base_url': os.environ.get('YANDEXGPT_BASE_URL', ''),
+        'provider_slow_timeout': float(os.environ.get('PROVIDER_SLOW_TIMEOUT', 30.0)),
+        'provider_response_timeout': float(os.environ.get('PROVIDER_RESPONSE_TIMEOUT', 0)),
+        'provider_cooldown': float(os.environ.get('PROVIDER_COOLDOWN', 30.0)),
+        'http_max_connections': int(os.environ.get('HTTP_MAX_CONNECTIONS', 1000)),
+        'http_max_keepalive_connections': int(os.environ.get('HTTP_MAX_KEEPALIVE_CONNECTIONS', 100)),
+        'http_keepalive_expiry': float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', 5.0)),
+        'http_connect_timeout': float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5.0)),
+        'http_read_timeout': float(os.environ.get('HTTP_READ_TIMEOUT', 600.0)),
+        'http_pool_timeout': float(os.environ.get('HTTP_POOL_TIMEOUT', 600.0)),
+        'http2': os.environ.get('HTTP2', 'false').lower() == 'true',
+        'cassette_mode': os.environ.get('CASSETTE_MODE', 'off').lower(),
+        'cassette_dir': os.environ.get('CASSETTE_DIR', 'cassettes'),
+        'cassette_preserve_latency': os.environ.get('CASSETTE_PRESERVE_LATENCY', 'true').lower() == 'true',
         'max_history_size': int(os.environ.get('MAX_HISTORY_SIZE', 15)),
         'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
+        'conversation_store': os.environ.get('CONVERSATION_STORE', 'memory').lower(),
+        'conversation_store_path': os.environ.get('CONVERSATION_STORE_PATH', 'conversations.db'),
+        'conversation_store_flush_interval': float(os.environ.get('CONVERSATION_STORE_FLUSH_INTERVAL', 1.0)),
+        'max_conversations': int(os.environ.get('MAX_CONVERSATIONS', 1000)),
+        'max_conversations_bytes': int(float(os.environ.get('MAX_CONVERSATIONS_MB', 0)) * 1024 * 1024),
+        'coalesce_queued_messages': os.environ.get('COALESCE_QUEUED_MESSAGES', 'false').lower() == 'true',
+        'background_summarisation': os.environ.get('BACKGROUND_SUMMARISATION', 'false').lower() == 'true',
+        'summarisation_threshold': float(os.environ.get('SUMMARISATION_THRESHOLD', 0.8)),
+        'history_token_budget': int(os.environ.get('HISTORY_TOKEN_BUDGET', 0)),
+        'recent_history_tokens': int(os.environ.get('RECENT_HISTORY_TOKENS', 0)),
+        'summary_max_tokens': int(os.environ.get('SUMMARY_MAX_TOKENS', 500)),
+        'transcript_summary_model': os.environ.get('TRANSCRIPT_SUMMARY_MODEL', ''),
+        'transcript_chunk_tokens': int(os.environ.get('TRANSCRIPT_CHUNK_TOKENS', 3000)),
+        'transcript_summary_tokens': int(os.environ.get('TRANSCRIPT_SUMMARY_TOKENS', 400)),
+        'transcript_summary_concurrency': int(os.environ.get('TRANSCRIPT_SUMMARY_CONCURRENCY', 4)),
+        'response_cache': os.environ.get('RESPONSE_CACHE', 'memory').lower(),
+        'response_cache_dir': os.environ.get('RESPONSE_CACHE_DIR', 'response_cache'),
+        'response_cache_ttl': int(os.environ.get('RESPONSE_CACHE_TTL', 86400)),
+        'response_cache_max_entries': int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1000)),
+        'rate_limit_rpm': int(os.environ.get('RATE_LIMIT_RPM', 0)),
+        'rate_limit_tpm': int(os.environ.get('RATE_LIMIT_TPM', 0)),
+        'rate_limits': RateLimiter.parse_model_limits(os.environ.get('RATE_LIMITS', '')),
+        'retry_max_attempts': int(os.environ.get('RETRY_MAX_ATTEMPTS', 3)),
+        'retry_initial_wait': float(os.environ.get('RETRY_INITIAL_WAIT', 1.0)),
+        'retry_max_wait': float(os.environ.get('RETRY_MAX_WAIT', 60.0)),
+        'hedge_requests': os.environ.get('HEDGE_REQUESTS', 'false').lower() == 'true',
+        'hedge_budget_percent': float(os.environ.get('HEDGE_BUDGET_PERCENT', 5.0)),
+        'hedge_percentile': float(os.environ.get('HEDGE_PERCENTILE', 95.0)),
+        'hedge_initial_delay': float(os.environ.get('HEDGE_INITIAL_DELAY', 10.0)),
+        'hedge_min_delay': float(os.environ.get('HEDGE_MIN_DELAY', 1.0)),
+        'hedge_max_delay': float(os.environ.get('HEDGE_MAX_DELAY', 60.0)),
+        'batch_api': os.environ.get('BATCH_API', 'false').lower() == 'true',
+        'batch_poll_interval': int(os.environ.get('BATCH_POLL_INTERVAL', 60)),
+        'jobs_dir': os.environ.get('JOBS_DIR', 'jobs'),
         'assistant_prompt': os.environ.get('ASSISTANT_PROMPT', 'You are a helpful assistant.'),
         'max_tokens': int(os.environ.get('MAX_TOKENS', max_tokens_default)),
         'n_choices': int(os.environ.get('N_CHOICES', 1)),
@@ -46,6 +108,9 @@ def main():
         'image_style': os.environ.get('IMAGE_STYLE', 'vivid'),
         'image_size': os.environ.get('IMAGE_SIZE', '512x512'),
         'model': model,
+        'large_context_model': os.environ.get('LARGE_CONTEXT_MODEL', ''),
+        'small_prompt_model': os.environ.get('SMALL_PROMPT_MODEL', ''),
+        'small_prompt_tokens': int(os.environ.get('SMALL_PROMPT_TOKENS', 0)),
         'enable_functions': os.environ.get('ENABLE_FUNCTIONS', str(functions_available)).lower() == 'true',
         'functions_max_consecutive_calls': int(os.environ.get('FUNCTIONS_MAX_CONSECUTIVE_CALLS', 10)),
         'presence_penalty': float(os.environ.get('PRESENCE_PENALTY', 0.0)),
@@ -53,6 +118,7 @@ def main():
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
         'show_plugins_used': os.environ.get('SHOW_PLUGINS_USED', 'false').lower() == 'true',
         'whisper_prompt': os.environ.get('WHISPER_PROMPT', ''),
+        'transcription_concurrency': int(os.environ.get('TRANSCRIPTION_CONCURRENCY', 4)),
         'vision_model': os.environ.get('VISION_MODEL', 'gpt-4-vision-preview'),
         'enable_vision_follow_up_questions': os.environ.get('ENABLE_VISION_FOLLOW_UP_QUESTIONS', 'true').lower() == 'true',
         'vision_prompt': os.environ.get('VISION_PROMPT', 'What is in this image'),
@@ -60,6 +126,8 @@ def main():
         'vision_max_tokens': int(os.environ.get('VISION_MAX_TOKENS', '300')),
         'tts_model': os.environ.get('TTS_MODEL', 'tts-1'),
         'tts_voice': os.environ.get('TTS_VOICE', 'alloy'),
+        'tts_chunk_characters': int(os.environ.get('TTS_CHUNK_CHARACTERS', 1000)),
+        'tts_concurrency': int(os.environ.get('TTS_CONCURRENCY', 4)),
     }
 
     if openai_config['enable_functions'] and not functions_available:
@@ -99,6 +167,9 @@ def main():
         'tts_model': os.environ.get('TTS_MODEL', 'tts-1'),
         'tts_prices': [float(i) for i in os.environ.get('TTS_PRICES', "0.015,0.030").split(",")],
         'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
+        'transcription_chunk_seconds': int(os.environ.get('TRANSCRIPTION_CHUNK_SECONDS', 600)),
+        'transcription_chunk_overlap_seconds': float(os.environ.get('TRANSCRIPTION_CHUNK_OVERLAP_SECONDS', 2)),
+        'update_timeout': float(os.environ.get('UPDATE_TIMEOUT', 0)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
     }
 
@@ -106,6 +177,12 @@ def main():
         'plugins': os.environ.get('PLUGINS', '').split(',')
     }
 
+    # Load the tokenizer files before the first request needs them
+    warm_up_encodings([openai_config['model'], openai_config['vision_model'],
+                       openai_config['large_context_model'], openai_config['small_prompt_model'],
+                       openai_config['transcript_summary_model']])
+    warm_up_prompts([openai_config['model'], openai_config['transcript_summary_model']])
+
     # Setup and run ChatGPT and Telegram bot
     plugin_manager = PluginManager(config=plugin_config)
     openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager)
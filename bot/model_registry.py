@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import json
+import logging
+from dataclasses import dataclass, replace
+
+
+@dataclass(frozen=True)
+class ModelInfo:
+    """
+    What the bot needs to know about a chat model.
+    """
+    context_window: int  # tokens of prompt and completion together
+    max_output_tokens: int  # upper limit of max_tokens
+    default_max_tokens: int  # max_tokens used unless configured
+    functions: bool = True  # supports function and tool calls
+    vision: bool = False  # accepts images
+    tokens_per_message: int = 3  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+    tokens_per_name: int = 1
+
+
+_GPT_3 = ModelInfo(context_window=4096, max_output_tokens=4096, default_max_tokens=1200,
+                   tokens_per_message=4, tokens_per_name=-1)
+_GPT_3_16K = replace(_GPT_3, context_window=16384, default_max_tokens=4800)
+_GPT_4 = ModelInfo(context_window=8192, max_output_tokens=8192, default_max_tokens=2400)
+_GPT_4_32K = replace(_GPT_4, context_window=32768, max_output_tokens=32768, default_max_tokens=9600)
+_GPT_4_128K = ModelInfo(context_window=128000, max_output_tokens=4096, default_max_tokens=4096)
+
+# Models can be found here: https://platform.openai.com/docs/models/overview
+_models: dict[str, ModelInfo] = {
+    'gpt-3.5-turbo': _GPT_3,
+    'gpt-3.5-turbo-0301': replace(_GPT_3, functions=False),
+    'gpt-3.5-turbo-0613': replace(_GPT_3, functions=False),  # deprecated on June 13, 2024
+    'gpt-3.5-turbo-16k': _GPT_3_16K,
+    'gpt-3.5-turbo-16k-0613': replace(_GPT_3_16K, functions=False),  # deprecated on June 13, 2024
+    'gpt-3.5-turbo-1106': replace(_GPT_3_16K, max_output_tokens=4096, default_max_tokens=4096),
+    'gpt-3.5-turbo-0125': replace(_GPT_3_16K, max_output_tokens=4096, default_max_tokens=4096),
+    'gpt-4': _GPT_4,
+    'gpt-4-0314': replace(_GPT_4, functions=False),
+    'gpt-4-0613': _GPT_4,
+    'gpt-4-32k': _GPT_4_32K,
+    'gpt-4-32k-0314': replace(_GPT_4_32K, functions=False),
+    'gpt-4-32k-0613': _GPT_4_32K,
+    'gpt-4-vision-preview': replace(_GPT_4_128K, functions=False, vision=True),
+    'gpt-4-1106-preview': _GPT_4_128K,
+    'gpt-4-0125-preview': _GPT_4_128K,
+    'gpt-4-turbo-preview': _GPT_4_128K,
+    'gpt-4-turbo': replace(_GPT_4_128K, vision=True),
+    'gpt-4o': replace(_GPT_4_128K, vision=True),
+    'gpt-4o-mini': replace(_GPT_4_128K, max_output_tokens=16384, vision=True),
+}
+
+# Conservative assumptions for models the registry does not know about
+FALLBACK_MODEL = _GPT_3
+_warned: set[str] = set()
+
+
+def get_model_info(model: str) -> ModelInfo:
+    """
+    Gets the facts about the given model.
+    Unknown models are looked up by their longest known prefix (e.g. a dated snapshot of a known model),
+    and fall back to conservative defaults if there is none.
+    :param model: The model name
+    :return: The model info
+    """
+    info = _models.get(model)
+    if info is not None:
+        return info
+    prefixes = [name for name in _models if model.startswith(name + '-')]
+    if prefixes:
+        return _models[max(prefixes, key=len)]
+    if model not in _warned:
+        _warned.add(model)
+        logging.warning(f'Model {model} is not in the model registry, assuming a context window of '
+                        f'{FALLBACK_MODEL.context_window} tokens. Add it with MODEL_REGISTRY_FILE.')
+    return FALLBACK_MODEL
+
+
+def load_models(path: str) -> None:
+    """
+    Adds or overrides models from a JSON file of the form
+    {"model-name": {"context_window": 128000, "max_output_tokens": 4096, ...}}.
+    Fields that are left out are taken from the known model, or from the fallback for new models.
+    :param path: The path of the JSON file
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        models = json.load(file)
+    for model, fields in models.items():
+        base = _models.get(model, FALLBACK_MODEL)
+        _models[model] = replace(base, **fields)
+    logging.info(f'Loaded {len(models)} models from {path}')
@@ -1,34 +1,37 @@
 from __future__ import annotations
+import asyncio
 import datetime
 import logging
 import os
 
-import tiktoken
-
 import openai
 
 import requests
 import json
-import httpx
 import io
+from uuid import uuid4
 from datetime import date
 from calendar import monthrange
 from PIL import Image
+from pydub import AudioSegment
 
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
-
-from utils import is_direct_result, encode_image, decode_image
+from utils import is_direct_result, split_into_sentence_chunks
 from plugin_manager import PluginManager
-
-# Models can be found here: https://platform.openai.com/docs/models/overview
-# Models gpt-3.5-turbo-0613 and  gpt-3.5-turbo-16k-0613 will be deprecated on June 13, 2024
-GPT_3_MODELS = ("gpt-3.5-turbo", "gpt-3.5-turbo-0301", "gpt-3.5-turbo-0613")
-GPT_3_16K_MODELS = ("gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-3.5-turbo-1106", "gpt-3.5-turbo-0125")
-GPT_4_MODELS = ("gpt-4", "gpt-4-0314", "gpt-4-0613")
-GPT_4_32K_MODELS = ("gpt-4-32k", "gpt-4-32k-0314", "gpt-4-32k-0613")
-GPT_4_VISION_MODELS = ("gpt-4-vision-preview",)
-GPT_4_128K_MODELS = ("gpt-4-1106-preview","gpt-4-0125-preview","gpt-4-turbo-preview")
-GPT_ALL_MODELS = GPT_3_MODELS + GPT_3_16K_MODELS + GPT_4_MODELS + GPT_4_32K_MODELS + GPT_4_VISION_MODELS + GPT_4_128K_MODELS
+from conversation import Conversation
+from conversation_store import LRUConversationStore, SQLiteConversationStore
+from encodings_registry import get_encoding
+from model_registry import get_model_info
+from image_store import ImageStore
+from response_cache import ResponseCache
+from rate_limiter import RateLimiter, Reservation
+from chat_queue import ChatQueue
+from retry_policy import RetryPolicy
+from http_transport import create_http_client
+from job_store import JobStore
+from usage_stream import UsageStream
+from prompt_templates import render_prompt
+from hedging import HedgePolicy
+from providers import ProviderRouter, OpenAIProvider, YandexGPTProvider, YANDEXGPT_BASE_URL
 
 
 def default_max_tokens(model: str) -> int:
@@ -37,39 +40,14 @@ def default_max_tokens(model: str) -> int:
     :param model: The model name
     :return: The default number of max tokens
     """
-    base = 1200
-    if model in GPT_3_MODELS:
-        return base
-    elif model in GPT_4_MODELS:
-        return base * 2
-    elif model in GPT_3_16K_MODELS:    
-        if model == "gpt-3.5-turbo-1106":
-            return 4096
-        return base * 4
-    elif model in GPT_4_32K_MODELS:
-        return base * 8
-    elif model in GPT_4_VISION_MODELS:
-        return 4096
-    elif model in GPT_4_128K_MODELS:
-        return 4096
+    return get_model_info(model).default_max_tokens
 
 
 def are_functions_available(model: str) -> bool:
     """
     Whether the given model supports functions
     """
-    # Deprecated models
-    if model in ("gpt-3.5-turbo-0301", "gpt-4-0314", "gpt-4-32k-0314"):
-        return False
-    # Stable models will be updated to support functions on June 27, 2023
-    if model in ("gpt-3.5-turbo", "gpt-3.5-turbo-1106", "gpt-4", "gpt-4-32k","gpt-4-1106-preview","gpt-4-0125-preview","gpt-4-turbo-preview"):
-        return datetime.date.today() > datetime.date(2023, 6, 27)
-    # Models gpt-3.5-turbo-0613 and  gpt-3.5-turbo-16k-0613 will be deprecated on June 13, 2024
-    if model in ("gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k-0613"):
-        return datetime.date.today() < datetime.date(2024, 6, 13)
-    if model == 'gpt-4-vision-preview':
-        return False
-    return True
+    return get_model_info(model).functions
 
 
 # Load translations
@@ -108,13 +86,100 @@ class OpenAIHelper:
         :param config: A dictionary containing the GPT configuration
         :param plugin_manager: The plugin manager
         """
-        http_client = httpx.AsyncClient(proxies=config['proxy']) if 'proxy' in config else None
-        self.client = openai.AsyncOpenAI(api_key=config['api_key'], http_client=http_client)
+        self.http_client, self.http_transport = create_http_client(config)
+        self.client = openai.AsyncOpenAI(api_key=config['api_key'], base_url=config.get('base_url'),
+                                         http_client=self.http_client, timeout=self.http_client.timeout)
         self.config = config
         self.plugin_manager = plugin_manager
-        self.conversations: dict[int: list] = {}  # {chat_id: history}
-        self.conversations_vision: dict[int: bool] = {}  # {chat_id: is_vision}
-        self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
+        self.image_store = ImageStore()
+        self.chat_queue = ChatQueue(coalesce=config.get('coalesce_queued_messages', False))
+        self.conversations = self.__create_conversation_store()  # {chat_id: history}
+        self.jobs = JobStore(config.get('jobs_dir', 'jobs'))
+        self.providers = self.__create_provider_router()
+        self.transcription_semaphore = asyncio.Semaphore(config.get('transcription_concurrency', 4))
+        self.tts_semaphore = asyncio.Semaphore(config.get('tts_concurrency', 4))
+        self.transcript_semaphore = asyncio.Semaphore(config.get('transcript_summary_concurrency', 4))
+        self.summarisation_tasks: dict[int, asyncio.Task] = {}  # {chat_id: background summarisation}
+        self.response_cache = ResponseCache(
+            backend=config.get('response_cache', 'memory'),
+            directory=config.get('response_cache_dir', 'response_cache'),
+            ttl_seconds=config.get('response_cache_ttl', 86400),
+            max_entries=config.get('response_cache_max_entries', 1000)
+        ) if config.get('response_cache', 'memory') != 'off' else None
+        self.rate_limiter = RateLimiter(
+            requests_per_minute=config.get('rate_limit_rpm', 0),
+            tokens_per_minute=config.get('rate_limit_tpm', 0),
+            model_limits=config.get('rate_limits', {})
+        )
+        self.retry_policy = RetryPolicy(
+            max_attempts=config.get('retry_max_attempts', 3),
+            initial_wait=config.get('retry_initial_wait', 1.0),
+            max_wait=config.get('retry_max_wait', 60.0)
+        )
+        self.hedge_policy = HedgePolicy(
+            budget_percent=config.get('hedge_budget_percent', 5.0),
+            percentile=config.get('hedge_percentile', 95.0),
+            initial_delay=config.get('hedge_initial_delay', 10.0),
+            min_delay=config.get('hedge_min_delay', 1.0),
+            max_delay=config.get('hedge_max_delay', 60.0)
+        ) if config.get('hedge_requests', False) else None
+
+    def __create_conversation_store(self):
+        """
+        Creates the configured conversation store.
+        Evicted conversations give back their images to the image store,
+        and the conversations of chats with a request in flight are not evicted.
+        """
+        limits = {
+            'max_conversations': self.config.get('max_conversations', 1000),
+            'max_bytes': self.config.get('max_conversations_bytes', 0),
+            'max_age_minutes': self.config['max_conversation_age_minutes'],
+            'on_evict': lambda chat_id, conversation: self.__release_images(conversation.messages),
+            'in_use': self.chat_queue.busy
+        }
+        if self.config.get('conversation_store', 'memory') == 'sqlite':
+            return SQLiteConversationStore(self.config.get('conversation_store_path', 'conversations.db'),
+                                           self.image_store,
+                                           flush_interval=self.config.get('conversation_store_flush_interval', 1.0),
+                                           **limits)
+        return LRUConversationStore(**limits)
+
+    def __create_provider_router(self) -> ProviderRouter:
+        """
+        Creates the router of chat completion requests, with the configured providers in order of preference.
+        """
+        providers = []
+        for name in self.config.get('providers', ['openai']):
+            if name == 'openai':
+                providers.append(OpenAIProvider(name, self.client))
+            elif name == 'yandexgpt':
+                if not self.config.get('yandexgpt_api_key') or not self.config.get('yandexgpt_folder_id'):
+                    logging.warning('YandexGPT needs YANDEXGPT_TOKEN and YANDEXGPT_FOLDER_ID, skipping it')
+                    continue
+                http_client, _ = create_http_client(self.config, name)
+                providers.append(YandexGPTProvider(
+                    name,
+                    http_client,
+                    api_key=self.config['yandexgpt_api_key'],
+                    folder_id=self.config['yandexgpt_folder_id'],
+                    model=self.config.get('yandexgpt_model', 'yandexgpt-lite/latest'),
+                    base_url=self.config.get('yandexgpt_base_url') or YANDEXGPT_BASE_URL
+                ))
+            else:
+                logging.warning(f'Unknown provider {name}, skipping it')
+        if not providers:
+            providers.append(OpenAIProvider('openai', self.client))
+        return ProviderRouter(providers,
+                              slow_timeout=self.config.get('provider_slow_timeout', 30.0),
+                              response_timeout=self.config.get('provider_response_timeout', 0),
+                              cooldown=self.config.get('provider_cooldown', 30.0))
+
+    def get_provider_stats(self) -> dict:
+        """
+        Gets the latency and health of the chat completion providers.
+        :return: A dictionary with the statistics of each provider
+        """
+        return self.providers.stats()
 
     def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
         """
@@ -124,35 +189,49 @@ class OpenAIHelper:
         """
         if chat_id not in self.conversations:
             self.reset_chat_history(chat_id)
-        return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
+        return len(self.conversations[chat_id]), self.__history_tokens(chat_id)
+
+    def get_http_pool_stats(self) -> dict:
+        """
+        Gets the utilisation of the connection pool of the OpenAI client.
+        :return: A dictionary with the pool statistics
+        """
+        return self.http_transport.stats()
 
     async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
         """
         Gets a full response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
-        :return: The answer from the model and the number of tokens used
+        :return: The answer from the model and the number of tokens used,
+                 or None if the query has been merged into an earlier queued one
         """
         plugins_used = ()
-        response = await self.__common_get_chat_response(chat_id, query)
-        if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-            response, plugins_used = await self.__handle_function_call(chat_id, response)
-            if is_direct_result(response):
-                return response, '0'
-
-        answer = ''
-
-        if len(response.choices) > 1 and self.config['n_choices'] > 1:
-            for index, choice in enumerate(response.choices):
-                content = choice.message.content.strip()
-                if index == 0:
-                    self.__add_to_history(chat_id, role="assistant", content=content)
-                answer += f'{index + 1}\u20e3\n'
-                answer += content
-                answer += '\n\n'
-        else:
-            answer = response.choices[0].message.content.strip()
-            self.__add_to_history(chat_id, role="assistant", content=answer)
+        async with self.chat_queue.turn(chat_id, query) as query:
+            if query is None:
+                # The query has been sent along with an earlier one
+                return None, 0
+            response = await self.__common_get_chat_response(chat_id, query)
+            if self.config['enable_functions'] and not self.conversations[chat_id].vision:
+                response, plugins_used = await self.__handle_function_call(chat_id, response)
+                if is_direct_result(response):
+                    return response, '0'
+
+            answer = ''
+
+            if len(response.choices) > 1 and self.config['n_choices'] > 1:
+                for index, choice in enumerate(response.choices):
+                    content = choice.message.content.strip()
+                    if index == 0:
+                        self.__add_to_history(chat_id, role="assistant", content=content)
+                    answer += f'{index + 1}\u20e3\n'
+                    answer += content
+                    answer += '\n\n'
+            else:
+                answer = response.choices[0].message.content.strip()
+                self.__add_to_history(chat_id, role="assistant", content=answer)
+            self.conversations.save(chat_id)
+            self.__schedule_summarisation(chat_id)
 
         bot_language = self.config['bot_language']
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
@@ -172,29 +251,40 @@ class OpenAIHelper:
     async def get_chat_response_stream(self, chat_id: int, query: str):
         """
         Stream response from the GPT model.
+        Nothing is streamed if the query has been merged into an earlier queued one.
         :param chat_id: The chat ID
         :param query: The query to send to the model
         :return: The answer from the model and the number of tokens used, or 'not_finished'
         """
         plugins_used = ()
-        response = await self.__common_get_chat_response(chat_id, query, stream=True)
-        if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-            response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
-            if is_direct_result(response):
-                yield response, '0'
+        async with self.chat_queue.turn(chat_id, query) as query:
+            if query is None:
+                # The query has been sent along with an earlier one
                 return
-
-        answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
-        answer = answer.strip()
-        self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+            response = await self.__common_get_chat_response(chat_id, query, stream=True)
+            if self.config['enable_functions'] and not self.conversations[chat_id].vision:
+                response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
+                if is_direct_result(response):
+                    yield response, '0'
+                    return
+
+            answer = ''
+            try:
+                async for chunk in response:
+                    if len(chunk.choices) == 0:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        answer += delta.content
+                        yield answer, 'not_finished'
+            finally:
+                # Aborts the HTTP stream if the reply is cancelled before it is complete
+                await response.close()
+            answer = answer.strip()
+            self.__add_to_history(chat_id, role="assistant", content=answer)
+            tokens_used = str(self.__stream_tokens(chat_id, response))
+            self.conversations.save(chat_id)
+            self.__schedule_summarisation(chat_id)
 
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
@@ -207,12 +297,272 @@ class OpenAIHelper:
 
         yield answer, tokens_used
 
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(openai.RateLimitError),
-        wait=wait_fixed(20),
-        stop=stop_after_attempt(3)
-    )
+    def render_prompt(self, name: str, model: str | None = None, max_tokens: int | None = None,
+                      follow_up_tokens: int = 0, **values) -> tuple[str, int]:
+        """
+        Fills in a prompt template for a one-shot request with complete(). The budget of the template is capped
+        at the tokens left in the context window of the model that will serve the request, once the system prompt
+        and the completion are taken into account, so a long value is cut instead of squeezing out the answer.
+        :param name: The name of the template
+        :param model: The model the request is meant for, defaults to the configured model
+        :param max_tokens: The maximum number of tokens the request generates, defaults to the configured value
+        :param follow_up_tokens: The tokens of a follow-up prompt that is sent later together with this prompt
+                                 and its answer, e.g. as returned by render_prompt(). If set, room is also kept
+                                 for the answer and the follow-up, so the follow-up request fits as well
+        :param values: The values of the variables
+        :return: The prompt and the number of tokens of the user message that carries it,
+                 to be passed on to complete() as prompt_tokens
+        """
+        model = model or self.config['model']
+        max_tokens = max_tokens or self.config['max_tokens']
+        system_tokens = self.__count_message_tokens({'role': 'system', 'content': self.config['assistant_prompt']})
+        message_tokens = self.__count_message_tokens({'role': 'user', 'content': ''})
+        limit = self.__prompt_room(model, max_tokens) - system_tokens - message_tokens
+        if follow_up_tokens:
+            answer_tokens = self.__count_message_tokens({'role': 'assistant', 'content': ''}) + max_tokens
+            limit -= answer_tokens + follow_up_tokens
+        prompt, tokens = render_prompt(name, model, limit=limit, **values)
+        return prompt, tokens + message_tokens
+
+    def __prompt_room(self, model: str, max_tokens: int) -> int:
+        """
+        Gets the number of tokens left for the prompt of a request next to its completion,
+        in the largest context window the request can be routed to.
+        :param model: The model the request is meant for
+        :param max_tokens: The requested maximum number of tokens to generate
+        :return: The number of tokens
+        """
+        models = [model]
+        if model == self.config['model'] and self.config.get('large_context_model'):
+            models.append(self.config['large_context_model'])
+        return max(get_model_info(name).context_window - min(max_tokens, get_model_info(name).max_output_tokens)
+                   for name in models)
+
+    async def complete(self, messages: list[dict], context: dict[str, str] | None = None,
+                       model: str | None = None, max_tokens: int | None = None,
+                       temperature: float | None = None, cache=False, batch=False,
+                       prompt_tokens: int | None = None) -> tuple[str, int]:
+        """
+        Gets a one-shot response from the GPT model, without using or updating any chat history.
+        :param messages: The messages to send, e.g. a single user prompt or a chain of prompts and answers
+        :param context: Optional named context slots, sent as system messages before the messages
+        :param model: The model to use, defaults to the configured model
+        :param max_tokens: The maximum number of tokens to generate, defaults to the configured value
+        :param temperature: The temperature to use, defaults to the configured value
+        :param cache: Whether the answer may be served from and stored in the response cache,
+                      only for prompts that are fully determined by their inputs
+        :param batch: Whether the request is not urgent and may go through the Batch API, if enabled.
+                      Batch requests are cheaper and do not count towards the rate limits,
+                      but may take up to 24 hours
+        :param prompt_tokens: The number of tokens of the messages, if already known, e.g. from render_prompt()
+        :return: The answer from the model and the number of tokens used (0 if served from the cache)
+        """
+        bot_language = self.config['bot_language']
+        system_messages = [{"role": "system", "content": self.config['assistant_prompt']}]
+        for name, value in (context or {}).items():
+            system_messages.append({"role": "system", "content": f"{name}:\n{value}"})
+
+        request = {
+            'model': model or self.config['model'],
+            'messages': system_messages + messages,
+            'temperature': self.config['temperature'] if temperature is None else temperature,
+            'max_tokens': max_tokens or self.config['max_tokens'],
+            'presence_penalty': self.config['presence_penalty'],
+            'frequency_penalty': self.config['frequency_penalty']
+        }
+
+        cache_key = None
+        if cache and self.response_cache is not None:
+            cache_key = ResponseCache.key(**request)
+            answer = self.response_cache.get(cache_key)
+            if answer is not None:
+                logging.debug(f'Response cache hit: {self.response_cache.stats()}')
+                return answer, 0
+
+        try:
+            if prompt_tokens is None:
+                prompt_tokens = sum(self.__count_message_tokens(message) for message in messages)
+            prompt_tokens += sum(self.__count_message_tokens(message) for message in system_messages)
+            if batch and self.config.get('batch_api', False):
+                # Batches are routed and fitted like real-time requests, since a rejected batch is only
+                # reported once it has been processed, which may take hours
+                request['model'] = self.__route_model(request['model'], prompt_tokens, request['max_tokens'])
+                request['max_tokens'] = self.__fit_max_tokens(request['model'], prompt_tokens, request['max_tokens'])
+                answer, total_tokens = await self.__complete_in_batch(request)
+            else:
+                response = await self.__create_chat_completion(prompt_tokens, **request)
+                answer, total_tokens = response.choices[0].message.content.strip(), response.usage.total_tokens
+        except openai.RateLimitError as e:
+            raise e
+
+        except openai.BadRequestError as e:
+            raise Exception(f"⚠️ _{localized_text('openai_invalid', bot_language)}._ ⚠️\n{str(e)}") from e
+
+        except Exception as e:
+            raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
+
+        if cache_key is not None:
+            self.response_cache.set(cache_key, answer)
+        return answer, total_tokens
+
+    async def summarise_transcript(self, transcript: str) -> tuple[str, int]:
+        """
+        Condenses a long video transcript with map-reduce: the transcript is split into chunks of
+        transcript_chunk_tokens, which are summarised concurrently with the transcript summary model,
+        and the partial summaries are joined in order. If they are still too long, they are condensed again.
+        At most transcript_summary_concurrency chunks are summarised at a time across all requests,
+        and the summary of each chunk is cached, so the same video is only summarised once.
+        :param transcript: The transcript
+        :return: The transcript, or its summary if it is longer than one chunk, and the number of tokens used
+        """
+        model = self.config.get('transcript_summary_model') or self.config['model']
+        chunk_tokens = self.config.get('transcript_chunk_tokens', 3000)
+        encoding = get_encoding(model)
+        tokens = encoding.encode(transcript)
+        if len(tokens) <= chunk_tokens:
+            return transcript, 0
+
+        chunks = [encoding.decode(tokens[start:start + chunk_tokens])
+                  for start in range(0, len(tokens), chunk_tokens)]
+
+        async def _summarise(index, chunk):
+            max_tokens = self.config.get('transcript_summary_tokens', 400)
+            prompt, prompt_tokens = self.render_prompt('transcript_chunk_summary', model, max_tokens,
+                                                       part=index + 1, parts=len(chunks), transcript=chunk)
+            async with self.transcript_semaphore:
+                return await self.complete([{"role": "user", "content": prompt}], model=model,
+                                           max_tokens=max_tokens, temperature=0.3, cache=True,
+                                           prompt_tokens=prompt_tokens)
+
+        logging.info(f'Summarising a transcript of {len(tokens)} tokens in {len(chunks)} chunks')
+        results = await asyncio.gather(*(_summarise(index, chunk) for index, chunk in enumerate(chunks)))
+        summary = '\n\n'.join(answer for answer, _ in results)
+        total_tokens = sum(used for _, used in results)
+        if len(results) > 1 and len(encoding.encode(summary)) > chunk_tokens:
+            summary, used = await self.summarise_transcript(summary)
+            total_tokens += used
+        return summary, total_tokens
+
+    async def complete_chain(self, job_id: str, prompts: list[str], metadata: dict | None = None,
+                             batch=False) -> str:
+        """
+        Sends a chain of prompts, each together with the previous prompts and their answers,
+        e.g. a pipeline that refines its answer step by step. The chain is saved after every step,
+        so a chain that was interrupted, e.g. by a restart, can be resumed with resume_chain().
+        Once the caller has handled the answer, it should forget the chain with finish_chain().
+        :param job_id: The ID of the chain, unique among the pending chains
+        :param prompts: The prompts, in order
+        :param metadata: Whatever the caller needs to resume the chain, saved with it
+        :param batch: Whether the steps are not urgent and may go through the Batch API, if enabled
+        :return: The answer to the last prompt
+        """
+        self.jobs.set(f'chain-{job_id}', {'prompts': prompts, 'answers': [], 'metadata': metadata or {},
+                                          'batch': batch})
+        return await self.resume_chain(job_id)
+
+    async def resume_chain(self, job_id: str) -> str:
+        """
+        Runs the steps of a saved chain that have not been answered yet.
+        The batch of a step that was still being processed is not submitted again, but waited for.
+        :param job_id: The ID of the chain
+        :return: The answer to the last prompt
+        """
+        job = self.jobs.get(f'chain-{job_id}')
+        if job is None:
+            raise KeyError(f'There is no pending chain {job_id}')
+        messages = []
+        for index, prompt in enumerate(job['prompts']):
+            messages.append({"role": "user", "content": prompt})
+            if index == len(job['answers']):
+                answer, _ = await self.complete(messages, batch=job['batch'])
+                job['answers'].append(answer)
+                self.jobs.set(f'chain-{job_id}', job)
+            messages.append({"role": "assistant", "content": job['answers'][index]})
+        return job['answers'][-1]
+
+    def pending_chains(self) -> dict[str, dict]:
+        """
+        Gets the chains that have not been finished, e.g. to resume them after a restart.
+        :return: The metadata of each chain, by chain ID
+        """
+        chains = {}
+        for name in self.jobs.names('chain-'):
+            job = self.jobs.get(name)
+            if job is not None:
+                chains[name[len('chain-'):]] = job['metadata']
+        return chains
+
+    def finish_chain(self, job_id: str):
+        """
+        Forgets a chain whose answer has been handled.
+        """
+        self.jobs.delete(f'chain-{job_id}')
+
+    async def __complete_in_batch(self, request: dict) -> tuple[str, int]:
+        """
+        Sends a chat completion request through the Batch API and waits until its result is ready.
+        The submitted batch is saved until it is done, so the same request sent again after a restart
+        waits for it instead of submitting it again.
+        :param request: The arguments of the chat completion request
+        :return: The answer from the model and the number of tokens used
+        """
+        endpoint = '/v1/chat/completions'
+        job_name = f'batch-{ResponseCache.key(**request)}'
+        job = self.jobs.get(job_name)
+        batch = None
+        if job is not None:
+            try:
+                batch = await self.retry_policy.call(self.client.batches.retrieve, job['batch_id'])
+                logging.info(f'Resuming batch {batch.id}, {batch.status}')
+            except openai.NotFoundError:
+                logging.warning(f"Batch {job['batch_id']} no longer exists, submitting the request again")
+                self.jobs.delete(job_name)
+        if batch is None:
+            line = json.dumps({'custom_id': f'request-{uuid4().hex}', 'method': 'POST', 'url': endpoint,
+                               'body': request})
+            input_file = await self.retry_policy.call(self.client.files.create,
+                                                      file=('batch.jsonl', line.encode('utf-8')), purpose='batch')
+            try:
+                batch = await self.retry_policy.call(self.client.batches.create, input_file_id=input_file.id,
+                                                     endpoint=endpoint, completion_window='24h')
+            except BaseException:
+                await self.__delete_batch_file(input_file.id)
+                raise
+            job = {'batch_id': batch.id, 'input_file_id': input_file.id}
+            self.jobs.set(job_name, job)
+            logging.info(f'Submitted batch {batch.id}')
+
+        # If the wait is cancelled, e.g. because the bot shuts down, the batch is left running to be resumed
+        while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+            await asyncio.sleep(self.config.get('batch_poll_interval', 60))
+            batch = await self.retry_policy.call(self.client.batches.retrieve, batch.id)
+        logging.info(f'Batch {batch.id} {batch.status}')
+
+        try:
+            if batch.status != 'completed' or not batch.output_file_id:
+                errors = ''
+                if batch.error_file_id:
+                    errors = (await self.client.files.content(batch.error_file_id)).text
+                elif batch.errors and batch.errors.data:
+                    errors = '; '.join(error.message for error in batch.errors.data)
+                raise Exception(f'Batch {batch.id} {batch.status}: {errors}')
+
+            output = await self.retry_policy.call(self.client.files.content, batch.output_file_id)
+            result = json.loads(output.text.splitlines()[0])
+            if result.get('error') or result['response']['status_code'] != 200:
+                raise Exception(f"Batch {batch.id} request failed: {result.get('error') or result['response']['body']}")
+            body = result['response']['body']
+            return body['choices'][0]['message']['content'].strip(), body['usage']['total_tokens']
+        finally:
+            self.jobs.delete(job_name)
+            await self.__delete_batch_file(job['input_file_id'])
+
+    async def __delete_batch_file(self, file_id: str):
+        try:
+            await self.client.files.delete(file_id)
+        except Exception as e:
+            logging.warning(f'Failed to delete batch input file {file_id}: {str(e)}')
+
     async def __common_get_chat_response(self, chat_id: int, query: str, stream=False):
         """
         Request a response from the GPT model.
@@ -225,30 +575,25 @@ class OpenAIHelper:
             if chat_id not in self.conversations or self.__max_age_reached(chat_id):
                 self.reset_chat_history(chat_id)
 
-            self.last_updated[chat_id] = datetime.datetime.now()
+            self.conversations[chat_id].last_updated = datetime.datetime.now()
 
             self.__add_to_history(chat_id, role="user", content=query)
 
             # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
+            if self.__exceeds_history_limits(chat_id):
+                await self.__wait_for_summarisation(chat_id)
 
-            if exceeded_max_tokens or exceeded_max_history_size:
+            if self.__exceeds_history_limits(chat_id):
                 logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
                 try:
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.__add_to_history(chat_id, role="user", content=query)
+                    await self.__compact_history(chat_id)
                 except Exception as e:
                     logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                    self.__release_images(self.conversations[chat_id].truncate(self.config['max_history_size']))
 
             common_args = {
-                'model': self.config['model'] if not self.conversations_vision[chat_id] else self.config['vision_model'],
-                'messages': self.conversations[chat_id],
+                'model': self.config['model'] if not self.conversations[chat_id].vision else self.config['vision_model'],
+                'messages': self.__expand_images(self.conversations[chat_id].messages),
                 'temperature': self.config['temperature'],
                 'n': self.config['n_choices'],
                 'max_tokens': self.config['max_tokens'],
@@ -257,12 +602,12 @@ class OpenAIHelper:
                 'stream': stream
             }
 
-            if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
+            if self.config['enable_functions'] and not self.conversations[chat_id].vision:
                 functions = self.plugin_manager.get_functions_specs()
                 if len(functions) > 0:
-                    common_args['functions'] = self.plugin_manager.get_functions_specs()
-                    common_args['function_call'] = 'auto'
-            return await self.client.chat.completions.create(**common_args)
+                    common_args['tools'] = self.__tools_specs()
+                    common_args['tool_choice'] = 'auto'
+            return await self.__create_chat_completion(self.__history_tokens(chat_id), hedge=True, **common_args)
 
         except openai.RateLimitError as e:
             raise e
@@ -273,58 +618,244 @@ class OpenAIHelper:
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
-    async def __handle_function_call(self, chat_id, response, stream=False, times=0, plugins_used=()):
-        function_name = ''
-        arguments = ''
-        if stream:
-            async for item in response:
-                if len(item.choices) > 0:
-                    first_choice = item.choices[0]
-                    if first_choice.delta and first_choice.delta.function_call:
-                        if first_choice.delta.function_call.name:
-                            function_name += first_choice.delta.function_call.name
-                        if first_choice.delta.function_call.arguments:
-                            arguments += first_choice.delta.function_call.arguments
-                    elif first_choice.finish_reason and first_choice.finish_reason == 'function_call':
-                        break
-                    else:
-                        return response, plugins_used
-                else:
-                    return response, plugins_used
-        else:
-            if len(response.choices) > 0:
-                first_choice = response.choices[0]
-                if first_choice.message.function_call:
-                    if first_choice.message.function_call.name:
-                        function_name += first_choice.message.function_call.name
-                    if first_choice.message.function_call.arguments:
-                        arguments += first_choice.message.function_call.arguments
-                else:
-                    return response, plugins_used
-            else:
+    def __tools_specs(self) -> list[dict]:
+        """
+        Gets the plugin functions in the format of the tools API.
+        """
+        return [{'type': 'function', 'function': spec} for spec in self.plugin_manager.get_functions_specs()]
+
+    async def __handle_function_call(self, chat_id, response, stream=False, plugins_used=()):
+        """
+        Runs the tools the model asks for until it answers, feeding their results back to it.
+        All tool calls of one assistant turn run concurrently, up to functions_max_consecutive_calls in total.
+        The calls beyond that get an error as their result, and the model is asked to answer.
+        :param chat_id: The chat ID
+        :param response: The response of the model, or the stream of response chunks
+        :param stream: Whether the response is streamed
+        :param plugins_used: The plugins used so far
+        :return: The final response of the model, or a direct result of a plugin, and the plugins used
+        """
+        max_calls = self.config['functions_max_consecutive_calls']
+        calls = 0
+        while True:
+            tool_calls = await self.__read_tool_calls(response, stream)
+            if not tool_calls:
                 return response, plugins_used
 
-        logging.info(f'Calling function {function_name} with arguments {arguments}')
-        function_response = await self.plugin_manager.call_function(function_name, self, arguments)
+            self.__add_tool_calls_to_history(chat_id, tool_calls)
+            remaining = max(max_calls - calls, 0)
+            allowed, skipped = tool_calls[:remaining], tool_calls[remaining:]
+            for tool_call in allowed:
+                logging.info(f"Calling function {tool_call['function']['name']} "
+                             f"with arguments {tool_call['function']['arguments']}")
+            results = await asyncio.gather(*(
+                self.plugin_manager.call_function(tool_call['function']['name'], self,
+                                                  tool_call['function']['arguments'])
+                for tool_call in allowed
+            ))
+
+            direct_result = None
+            for tool_call, result in zip(allowed, results):
+                function_name = tool_call['function']['name']
+                if function_name not in plugins_used:
+                    plugins_used += (function_name,)
+                if is_direct_result(result):
+                    direct_result = direct_result or result
+                    result = json.dumps({'result': 'Done, the content has been sent to the user.'})
+                self.__add_tool_result_to_history(chat_id, tool_call_id=tool_call['id'], content=result)
+            # Every tool call needs a result, or the history cannot be sent anymore
+            for tool_call in skipped:
+                logging.warning(f"Not calling function {tool_call['function']['name']}, "
+                                f"the maximum of {max_calls} consecutive function calls has been reached")
+                self.__add_tool_result_to_history(chat_id, tool_call_id=tool_call['id'], content=json.dumps(
+                    {'error': 'The maximum number of function calls has been reached, answer without them.'}))
+            if direct_result is not None:
+                return direct_result, plugins_used
+
+            calls += len(allowed)
+            response = await self.__create_chat_completion(
+                self.__history_tokens(chat_id),
+                model=self.config['model'],
+                messages=self.conversations[chat_id].messages,
+                tools=self.__tools_specs(),
+                tool_choice='auto' if calls < max_calls else 'none',
+                stream=stream
+            )
 
-        if function_name not in plugins_used:
-            plugins_used += (function_name,)
+    @staticmethod
+    async def __read_tool_calls(response, stream=False) -> list[dict]:
+        """
+        Reads the tool calls the model asks for.
+        When streaming, the chunks of the tool calls are consumed from the stream.
+        :param response: The response of the model, or the stream of response chunks
+        :param stream: Whether the response is streamed
+        :return: The tool calls, empty if the model answers right away
+        """
+        if not stream:
+            if len(response.choices) == 0 or not response.choices[0].message.tool_calls:
+                return []
+            return [{'id': tool_call.id, 'type': 'function',
+                     'function': {'name': tool_call.function.name, 'arguments': tool_call.function.arguments}}
+                    for tool_call in response.choices[0].message.tool_calls]
+
+        tool_calls: dict[int, dict] = {}  # {index: tool call}
+        async for item in response:
+            if len(item.choices) == 0:
+                # e.g. the final chunk with the usage, which has to be read to settle the request
+                continue
+            first_choice = item.choices[0]
+            if first_choice.delta and first_choice.delta.tool_calls:
+                for delta in first_choice.delta.tool_calls:
+                    tool_call = tool_calls.setdefault(delta.index, {
+                        'id': '', 'type': 'function', 'function': {'name': '', 'arguments': ''}
+                    })
+                    if delta.id:
+                        tool_call['id'] += delta.id
+                    if delta.function and delta.function.name:
+                        tool_call['function']['name'] += delta.function.name
+                    if delta.function and delta.function.arguments:
+                        tool_call['function']['arguments'] += delta.function.arguments
+            elif first_choice.finish_reason and first_choice.finish_reason == 'tool_calls':
+                continue  # read on to the usage, if it was requested
+            else:
+                return []
+        return [tool_calls[index] for index in sorted(tool_calls)]
 
-        if is_direct_result(function_response):
-            self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name,
-                                                content=json.dumps({'result': 'Done, the content has been sent'
-                                                                              'to the user.'}))
-            return function_response, plugins_used
+    def __route_model(self, model: str, prompt_tokens: int, max_tokens: int, needs_functions=False) -> str:
+        """
+        Picks the model for a request to the configured chat model, based on the size of its prompt.
+        Prompts that do not fit the context window go to the configured large context model,
+        small prompts go to the configured small prompt model, if any.
+        Requests to other models, e.g. the vision model, are sent as they are.
+        :param model: The model the request is meant for
+        :param prompt_tokens: The estimated number of tokens of the prompt
+        :param max_tokens: The requested maximum number of tokens to generate
+        :param needs_functions: Whether the request offers tools to the model
+        :return: The model to send the request to
+        """
+        if model != self.config['model']:
+            return model
+
+        routed, reason = model, None
+        large_model = self.config.get('large_context_model')
+        small_model = self.config.get('small_prompt_model')
+        if prompt_tokens + max_tokens > get_model_info(model).context_window:
+            if large_model and prompt_tokens + max_tokens <= get_model_info(large_model).context_window:
+                routed, reason = large_model, 'prompt does not fit the context window'
+        elif small_model and prompt_tokens <= self.config.get('small_prompt_tokens', 0):
+            routed, reason = small_model, 'small prompt'
+
+        if routed != model and needs_functions and not get_model_info(routed).functions:
+            return model
+        if routed != model:
+            logging.info(f'Routing request of {prompt_tokens} prompt tokens and up to {max_tokens} completion tokens '
+                         f'from {model} to {routed} ({reason})')
+        return routed
+
+    @staticmethod
+    def __fit_max_tokens(model: str, prompt_tokens: int, max_tokens: int) -> int:
+        """
+        Shrinks max_tokens so that the prompt and the completion fit the context window of the model.
+        :param model: The model name
+        :param prompt_tokens: The estimated number of tokens of the prompt
+        :param max_tokens: The requested maximum number of tokens to generate
+        :return: The maximum number of tokens to generate that fits
+        """
+        info = get_model_info(model)
+        fitting = min(max_tokens, info.max_output_tokens, info.context_window - prompt_tokens)
+        if fitting <= 0:
+            raise ValueError(f'The prompt of {prompt_tokens} tokens does not fit the context window of {model} '
+                             f'({info.context_window} tokens)')
+        if fitting < max_tokens:
+            logging.info(f'Reducing max_tokens from {max_tokens} to {fitting} to fit the context window of {model}')
+        return fitting
+
+    async def __create_chat_completion(self, prompt_tokens: int, hedge=False, **kwargs):
+        """
+        Sends a chat completion request once the rate limiter has budget for it,
+        retrying transient failures according to the retry policy.
+        Streams are only retried until the response starts.
+        :param prompt_tokens: The estimated number of tokens of the prompt
+        :param hedge: Whether a duplicate request may be sent if this one is slow to answer, if hedging is enabled
+        :param kwargs: The arguments of the request
+        :return: The response, or the stream of response chunks
+        """
+        max_tokens = kwargs.get('max_tokens') or self.config['max_tokens']
+        kwargs['model'] = self.__route_model(kwargs['model'], prompt_tokens, max_tokens, 'tools' in kwargs)
+        completion_tokens = self.__fit_max_tokens(kwargs['model'], prompt_tokens, max_tokens)
+        kwargs['max_tokens'] = completion_tokens
+        estimate = prompt_tokens + completion_tokens * kwargs.get('n', 1)
+        stream = kwargs.get('stream', False)
+        if stream and self.config.get('stream_usage', True):
+            # The final chunk reports the usage, instead of estimating it locally
+            kwargs['stream_options'] = {'include_usage': True}
+
+        if hedge and self.hedge_policy is not None:
+            kind = f"{kwargs['model']}{' stream' if stream else ''}"
+            # Each attempt waits for its own reservation, and is only timed once it has been granted
+            return await self.hedge_policy.call(
+                kind, lambda reservation: self.__send_chat_completion(reservation, prompt_tokens, **kwargs),
+                discard=self.__discard_response,
+                admit=lambda: self.rate_limiter.acquire(kwargs['model'], estimate)
+            )
+        reservation = await self.rate_limiter.acquire(kwargs['model'], estimate)
+        return await self.__send_chat_completion(reservation, prompt_tokens, **kwargs)
 
-        self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name, content=function_response)
-        response = await self.client.chat.completions.create(
-            model=self.config['model'],
-            messages=self.conversations[chat_id],
-            functions=self.plugin_manager.get_functions_specs(),
-            function_call='auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
-            stream=stream
-        )
-        return await self.__handle_function_call(chat_id, response, stream, times + 1, plugins_used)
+    async def __send_chat_completion(self, reservation: Reservation, prompt_tokens: int, **kwargs):
+        """
+        Sends a chat completion request to the best provider and waits for its first token.
+        :param reservation: The rate limiter reservation of the request, released if the request fails
+        :param prompt_tokens: The estimated number of tokens of the prompt
+        :param kwargs: The arguments of the request
+        :return: The response, or the stream of response chunks
+        """
+        stream = kwargs.get('stream', False)
+
+        async def _attempt(provider):
+            response = await self.retry_policy.call(provider.create_chat_completion, **kwargs)
+            if stream:
+                # A stream that is closed early, e.g. because its flow was cancelled, only keeps its prompt reserved.
+                # One that was read to the end without reporting its usage is settled with its counted tokens
+                encoding = get_encoding(kwargs['model'])
+                response = UsageStream(response,
+                                       on_usage=lambda usage: self.rate_limiter.settle(reservation, usage.total_tokens),
+                                       on_abort=lambda: self.rate_limiter.settle(reservation, prompt_tokens),
+                                       on_end=lambda text: self.rate_limiter.settle(
+                                           reservation, prompt_tokens + len(encoding.encode(text))))
+                try:
+                    await response.prime()
+                except BaseException:
+                    # Abandoned, e.g. because the provider was too slow or the hedge lost the race,
+                    # so the server stops generating. The reservation is released or passed on by the caller
+                    response.on_abort = None
+                    await response.close()
+                    raise
+            return response
+
+        try:
+            response = await self.providers.call(_attempt, **kwargs)
+        except BaseException:
+            # Also gives back the tokens of a hedged request that lost the race and was cancelled
+            self.rate_limiter.release(reservation)
+            raise
+        if not stream and response.usage is not None:
+            self.rate_limiter.settle(reservation, response.usage.total_tokens)
+        return response
+
+    @staticmethod
+    async def __discard_response(response):
+        """
+        Closes the response of a hedged request that lost the race.
+        """
+        if isinstance(response, UsageStream):
+            await response.close()
+
+    def get_hedge_stats(self) -> dict:
+        """
+        Gets how often chat requests were hedged and how often the hedge answered first.
+        :return: A dictionary with the hedging statistics, empty if hedging is disabled
+        """
+        return self.hedge_policy.stats() if self.hedge_policy is not None else {}
 
     async def generate_image(self, prompt: str) -> tuple[str, str]:
         """
@@ -357,25 +888,70 @@ class OpenAIHelper:
     async def generate_speech(self, text: str) -> tuple[any, int]:
         """
         Generates an audio from the given text using TTS model.
+        Long texts are synthesised in concurrent chunks and joined into one opus stream.
         :param prompt: The text to send to the model
         :return: The audio in bytes and the text size
         """
+        parts = [speech_file async for speech_file, _ in self.generate_speech_chunks(text)]
+        if len(parts) == 1:
+            return parts[0], len(text)
+        try:
+            return await asyncio.to_thread(self.__concatenate_speech, parts), len(text)
+        except Exception as e:
+            raise Exception(f"⚠️ _{localized_text('error', self.config['bot_language'])}._ ⚠️\n{str(e)}") from e
+        finally:
+            for part in parts:
+                part.close()
+
+    async def generate_speech_chunks(self, text: str):
+        """
+        Generates audios from the given text using TTS model, split at sentence boundaries.
+        All chunks are synthesised concurrently, with at most tts_concurrency requests running
+        at a time across all chats, and each one is yielded as soon as it and the ones before it are ready.
+        :param text: The text to send to the model
+        :return: An async generator of the audio of each chunk in bytes and the chunk size, in order
+        """
+        chunks = split_into_sentence_chunks(text, self.config.get('tts_chunk_characters', 1000)) or [text]
+        tasks = [asyncio.create_task(self.__synthesise(chunk)) for chunk in chunks]
+        try:
+            for chunk, task in zip(chunks, tasks):
+                yield await task, len(chunk)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def __synthesise(self, text: str) -> io.BytesIO:
+        """
+        Synthesises a single chunk of text.
+        """
         bot_language = self.config['bot_language']
         try:
-            response = await self.client.audio.speech.create(
-                model=self.config['tts_model'],
-                voice=self.config['tts_voice'],
-                input=text,
-                response_format='opus'
-            )
+            async with self.tts_semaphore:
+                response = await self.client.audio.speech.create(
+                    model=self.config['tts_model'],
+                    voice=self.config['tts_voice'],
+                    input=text,
+                    response_format='opus'
+                )
 
             temp_file = io.BytesIO()
             temp_file.write(response.read())
             temp_file.seek(0)
-            return temp_file, len(text)
+            return temp_file
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
+    @staticmethod
+    def __concatenate_speech(parts: list[io.BytesIO]) -> io.BytesIO:
+        """
+        Joins the audios of the chunks into one opus stream.
+        """
+        speech = sum((AudioSegment.from_file(part, format='ogg') for part in parts), AudioSegment.empty())
+        temp_file = io.BytesIO()
+        speech.export(temp_file, format='ogg', codec='libopus')
+        temp_file.seek(0)
+        return temp_file
+
     async def transcribe(self, filename):
         """
         Transcribes the audio file using the Whisper model.
@@ -389,12 +965,19 @@ class OpenAIHelper:
             logging.exception(e)
             raise Exception(f"⚠️ _{localized_text('error', self.config['bot_language'])}._ ⚠️\n{str(e)}") from e
 
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(openai.RateLimitError),
-        wait=wait_fixed(20),
-        stop=stop_after_attempt(3)
-    )
+    async def transcribe_chunks(self, filenames) -> list[str]:
+        """
+        Transcribes the chunks of a long recording concurrently, with at most
+        transcription_concurrency transcriptions running at a time across all chats.
+        :param filenames: The audio files of the chunks, in order
+        :return: The transcripts of the chunks, in the same order
+        """
+        async def _transcribe(filename):
+            async with self.transcription_semaphore:
+                return await self.transcribe(filename)
+
+        return list(await asyncio.gather(*(_transcribe(filename) for filename in filenames)))
+
     async def __common_get_chat_response_vision(self, chat_id: int, content: list, stream=False):
         """
         Request a response from the GPT model.
@@ -407,10 +990,10 @@ class OpenAIHelper:
             if chat_id not in self.conversations or self.__max_age_reached(chat_id):
                 self.reset_chat_history(chat_id)
 
-            self.last_updated[chat_id] = datetime.datetime.now()
+            self.conversations[chat_id].last_updated = datetime.datetime.now()
 
             if self.config['enable_vision_follow_up_questions']:
-                self.conversations_vision[chat_id] = True
+                self.conversations[chat_id].vision = True
                 self.__add_to_history(chat_id, role="user", content=content)
             else:
                 for message in content:
@@ -420,29 +1003,22 @@ class OpenAIHelper:
                 self.__add_to_history(chat_id, role="user", content=query)
 
             # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
+            if self.__exceeds_history_limits(chat_id):
+                await self.__wait_for_summarisation(chat_id)
 
-            if exceeded_max_tokens or exceeded_max_history_size:
+            if self.__exceeds_history_limits(chat_id):
                 logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
                 try:
-                    
-                    last = self.conversations[chat_id][-1]
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.conversations[chat_id] += [last]
+                    await self.__compact_history(chat_id)
                 except Exception as e:
                     logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                    self.__release_images(self.conversations[chat_id].truncate(self.config['max_history_size']))
 
             message = {'role':'user', 'content':content}
 
             common_args = {
                 'model': self.config['vision_model'],
-                'messages': self.conversations[chat_id][:-1] + [message],
+                'messages': self.__expand_images(self.conversations[chat_id].messages[:-1] + [message]),
                 'temperature': self.config['temperature'],
                 'n': 1, # several choices is not implemented yet
                 'max_tokens': self.config['vision_max_tokens'],
@@ -460,7 +1036,7 @@ class OpenAIHelper:
             #         common_args['functions'] = self.plugin_manager.get_functions_specs()
             #         common_args['function_call'] = 'auto'
             
-            return await self.client.chat.completions.create(**common_args)
+            return await self.__create_chat_completion(self.__history_tokens(chat_id), **common_args)
 
         except openai.RateLimitError as e:
             raise e
@@ -476,36 +1052,41 @@ class OpenAIHelper:
         """
         Interprets a given PNG image file using the Vision model.
         """
-        image = encode_image(fileobj)
-        prompt = self.config['vision_prompt'] if prompt is None else prompt
+        async with self.chat_queue.turn(chat_id):
+            image = self.__store_image(fileobj)
+            prompt = self.config['vision_prompt'] if prompt is None else prompt
 
-        content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
-                    'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
+            content = [{'type':'text', 'text':prompt}, image]
 
-        response = await self.__common_get_chat_response_vision(chat_id, content)
+            try:
+                response = await self.__common_get_chat_response_vision(chat_id, content)
+            finally:
+                self.image_store.release(image['ref'])
 
         
 
-        # functions are not available for this model
+            # functions are not available for this model
         
-        # if self.config['enable_functions']:
-        #     response, plugins_used = await self.__handle_function_call(chat_id, response)
-        #     if is_direct_result(response):
-        #         return response, '0'
-
-        answer = ''
-
-        if len(response.choices) > 1 and self.config['n_choices'] > 1:
-            for index, choice in enumerate(response.choices):
-                content = choice.message.content.strip()
-                if index == 0:
-                    self.__add_to_history(chat_id, role="assistant", content=content)
-                answer += f'{index + 1}\u20e3\n'
-                answer += content
-                answer += '\n\n'
-        else:
-            answer = response.choices[0].message.content.strip()
-            self.__add_to_history(chat_id, role="assistant", content=answer)
+            # if self.config['enable_functions']:
+            #     response, plugins_used = await self.__handle_function_call(chat_id, response)
+            #     if is_direct_result(response):
+            #         return response, '0'
+
+            answer = ''
+
+            if len(response.choices) > 1 and self.config['n_choices'] > 1:
+                for index, choice in enumerate(response.choices):
+                    content = choice.message.content.strip()
+                    if index == 0:
+                        self.__add_to_history(chat_id, role="assistant", content=content)
+                    answer += f'{index + 1}\u20e3\n'
+                    answer += content
+                    answer += '\n\n'
+            else:
+                answer = response.choices[0].message.content.strip()
+                self.__add_to_history(chat_id, role="assistant", content=answer)
+            self.conversations.save(chat_id)
+            self.__schedule_summarisation(chat_id)
 
         bot_language = self.config['bot_language']
         # Plugins are not enabled either
@@ -527,33 +1108,42 @@ class OpenAIHelper:
         """
         Interprets a given PNG image file using the Vision model.
         """
-        image = encode_image(fileobj)
-        prompt = self.config['vision_prompt'] if prompt is None else prompt
+        async with self.chat_queue.turn(chat_id):
+            image = self.__store_image(fileobj)
+            prompt = self.config['vision_prompt'] if prompt is None else prompt
 
-        content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
-                    'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
+            content = [{'type':'text', 'text':prompt}, image]
 
-        response = await self.__common_get_chat_response_vision(chat_id, content, stream=True)
+            try:
+                response = await self.__common_get_chat_response_vision(chat_id, content, stream=True)
+            finally:
+                self.image_store.release(image['ref'])
 
         
 
-        # if self.config['enable_functions']:
-        #     response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
-        #     if is_direct_result(response):
-        #         yield response, '0'
-        #         return
-
-        answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
-        answer = answer.strip()
-        self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+            # if self.config['enable_functions']:
+            #     response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
+            #     if is_direct_result(response):
+            #         yield response, '0'
+            #         return
+
+            answer = ''
+            try:
+                async for chunk in response:
+                    if len(chunk.choices) == 0:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        answer += delta.content
+                        yield answer, 'not_finished'
+            finally:
+                # Aborts the HTTP stream if the reply is cancelled before it is complete
+                await response.close()
+            answer = answer.strip()
+            self.__add_to_history(chat_id, role="assistant", content=answer)
+            tokens_used = str(self.__stream_tokens(chat_id, response))
+            self.conversations.save(chat_id)
+            self.__schedule_summarisation(chat_id)
 
         #show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         #plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
@@ -572,8 +1162,11 @@ class OpenAIHelper:
         """
         if content == '':
             content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [{"role": "system", "content": content}]
-        self.conversations_vision[chat_id] = False
+        if chat_id in self.conversations:
+            self.__release_images(self.conversations[chat_id].messages)
+        self.conversations[chat_id] = Conversation()
+        self.__add_to_history(chat_id, role="system", content=content)
+        self.conversations.save(chat_id)
 
     def __max_age_reached(self, chat_id) -> bool:
         """
@@ -581,18 +1174,26 @@ class OpenAIHelper:
         :param chat_id: The chat ID
         :return: A boolean indicating whether the maximum conversation age has been reached
         """
-        if chat_id not in self.last_updated:
+        if chat_id not in self.conversations:
             return False
-        last_updated = self.last_updated[chat_id]
+        last_updated = self.conversations[chat_id].last_updated
         now = datetime.datetime.now()
         max_age_minutes = self.config['max_conversation_age_minutes']
         return last_updated < now - datetime.timedelta(minutes=max_age_minutes)
 
-    def __add_function_call_to_history(self, chat_id, function_name, content):
+    def __add_tool_calls_to_history(self, chat_id, tool_calls):
         """
-        Adds a function call to the conversation history
+        Adds the tool calls of an assistant turn to the conversation history
         """
-        self.conversations[chat_id].append({"role": "function", "name": function_name, "content": content})
+        message = {"role": "assistant", "content": None, "tool_calls": tool_calls}
+        self.conversations[chat_id].append(message, self.__count_message_tokens(message))
+
+    def __add_tool_result_to_history(self, chat_id, tool_call_id, content):
+        """
+        Adds the result of a tool call to the conversation history
+        """
+        message = {"role": "tool", "tool_call_id": tool_call_id, "content": content}
+        self.conversations[chat_id].append(message, self.__count_message_tokens(message))
 
     def __add_to_history(self, chat_id, role, content):
         """
@@ -601,100 +1202,288 @@ class OpenAIHelper:
         :param role: The role of the message sender
         :param content: The message content
         """
-        self.conversations[chat_id].append({"role": role, "content": content})
+        message = {"role": role, "content": content}
+        if isinstance(content, list):
+            for part in content:
+                if part['type'] == 'image_ref':
+                    self.image_store.acquire(part['ref'])
+        self.conversations[chat_id].append(message, self.__count_message_tokens(message))
+
+    def __store_image(self, fileobj) -> dict:
+        """
+        Puts an image into the image store and describes it for the conversation history.
+        The image size and its token cost are computed once, here.
+        :param fileobj: The image file
+        :return: The message content part referencing the image
+        """
+        image_bytes = fileobj.getvalue()
+        width, height = Image.open(io.BytesIO(image_bytes)).size
+        return {
+            'type': 'image_ref',
+            'ref': self.image_store.put(image_bytes),
+            'width': width,
+            'height': height,
+            'detail': self.config['vision_detail'],
+            'tokens': self.__count_tokens_vision(width, height),
+        }
+
+    def __expand_images(self, messages) -> list:
+        """
+        Builds the messages of an API request, replacing image references with the images themselves.
+        :param messages: The messages from the conversation history
+        :return: The messages to send
+        """
+        expanded = []
+        for message in messages:
+            if isinstance(message.get('content'), list):
+                content = [
+                    {'type': 'image_url', 'image_url': {'url': self.image_store.data_url(part['ref']),
+                                                        'detail': part['detail']}}
+                    if part['type'] == 'image_ref' else part
+                    for part in message['content']
+                ]
+                message = {**message, 'content': content}
+            expanded.append(message)
+        return expanded
+
+    def __release_images(self, messages):
+        """
+        Releases the images referenced by messages that left the conversation history.
+        :param messages: The removed messages
+        """
+        for message in messages:
+            if isinstance(message.get('content'), list):
+                for part in message['content']:
+                    if part['type'] == 'image_ref':
+                        self.image_store.release(part['ref'])
 
-    async def __summarise(self, conversation) -> str:
+    def __history_token_budget(self) -> int:
         """
-        Summarises the conversation history.
+        Gets the number of tokens the conversation history may take up.
+        :return: The configured budget, or what is left of the context window after the reply
+        """
+        budget = self.config.get('history_token_budget', 0)
+        if budget > 0:
+            return budget
+        return self.__max_model_tokens() - self.config['max_tokens']
+
+    def __exceeds_history_limits(self, chat_id, fraction=1.0) -> bool:
+        """
+        Checks if the conversation history is too long to be sent as is.
+        :param chat_id: The chat ID
+        :param fraction: The fraction of the token and history size limits to check against
+        :return: A boolean indicating whether the history exceeds the limits
+        """
+        exceeded_max_tokens = self.__history_tokens(chat_id) > fraction * self.__history_token_budget()
+        exceeded_max_history_size = len(self.conversations[chat_id]) > fraction * self.config['max_history_size']
+        return exceeded_max_tokens or exceeded_max_history_size
+
+    def __schedule_summarisation(self, chat_id):
+        """
+        Starts summarising the conversation history in the background once it gets close to the limits,
+        so that the next request does not have to wait for the summary.
+        :param chat_id: The chat ID
+        """
+        if not self.config.get('background_summarisation', False):
+            return
+        task = self.summarisation_tasks.get(chat_id)
+        if task is not None and not task.done():
+            return
+        if self.__exceeds_history_limits(chat_id, self.config['summarisation_threshold']):
+            logging.info(f'Chat history for chat ID {chat_id} is getting long. Summarising in the background...')
+            self.summarisation_tasks[chat_id] = asyncio.create_task(self.__summarise_in_background(chat_id))
+
+    async def __wait_for_summarisation(self, chat_id):
+        """
+        Waits for a running background summarisation of the conversation history, if any.
+        :param chat_id: The chat ID
+        """
+        task = self.summarisation_tasks.get(chat_id)
+        if task is not None and not task.done():
+            await asyncio.shield(task)
+
+    async def __summarise_in_background(self, chat_id):
+        """
+        Compacts the conversation history without blocking the current request.
+        :param chat_id: The chat ID
+        """
+        try:
+            await self.__compact_history(chat_id)
+        except Exception as e:
+            logging.warning(f'Error while summarising chat history in the background: {str(e)}')
+        finally:
+            self.summarisation_tasks.pop(chat_id, None)
+
+    def __compaction_split(self, conversation: Conversation) -> int:
+        """
+        Finds where the recent turns, which are kept verbatim, start.
+        Recent turns are kept as long as they fit the recent history budget
+        and half of the maximum history size, the last turn is always kept.
         :param conversation: The conversation history
+        :return: The index of the first message to keep verbatim
+        """
+        start = conversation.preamble_size
+        recent_budget = self.config.get('recent_history_tokens', 0) or self.__history_token_budget() // 2
+        recent_messages = max(self.config['max_history_size'] // 2, 1)
+
+        split = len(conversation) - 1
+        recent_tokens = conversation.token_counts[split]
+        while split - 1 >= start and len(conversation) - split < recent_messages \
+                and recent_tokens + conversation.token_counts[split - 1] <= recent_budget:
+            split -= 1
+            recent_tokens += conversation.token_counts[split]
+
+        # Function results are meaningless without the call that requested them
+        while split < len(conversation) - 1 and conversation.messages[split]['role'] in ('function', 'tool'):
+            split += 1
+        return split
+
+    async def __compact_history(self, chat_id):
+        """
+        Collapses the older turns of the conversation into the rolling summary.
+        The existing summary is extended with the collapsed turns instead of being
+        regenerated, and the recent turns stay verbatim.
+        :param chat_id: The chat ID
+        """
+        conversation = self.conversations[chat_id]
+        start = conversation.preamble_size
+        split = self.__compaction_split(conversation)
+        if split <= start:
+            return
+
+        summary = await self.__summarise(conversation.messages[start:split], conversation.summary)
+        logging.debug(f'Summary: {summary}')
+
+        if self.conversations.get(chat_id) is not conversation:
+            # The history was reset or replaced in the meantime
+            return
+
+        # Swap in the compacted history, keeping the turns that were added in the meantime
+        compacted = Conversation()
+        compacted.append(conversation.messages[0], conversation.token_counts[0])
+        summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+        compacted.append(summary_message, self.__count_message_tokens(summary_message))
+        compacted.summary = summary
+        compacted.vision = conversation.vision
+        compacted.last_updated = conversation.last_updated
+        for message, tokens in zip(conversation.messages[split:], conversation.token_counts[split:]):
+            compacted.append(message, tokens)
+        self.__release_images(conversation.messages[start:split])
+        self.conversations[chat_id] = compacted
+
+    async def __summarise(self, turns, previous_summary=None) -> str:
+        """
+        Summarises conversation turns, extending the summary of the turns before them.
+        :param turns: The conversation turns to summarise
+        :param previous_summary: The summary of the earlier turns, if any
         :return: The summary
         """
+        transcript = '\n'.join(self.__format_turn(message) for message in turns)
+        if previous_summary:
+            transcript = f'Summary so far:\n{previous_summary}\n\nNew messages:\n{transcript}'
         messages = [
-            {"role": "assistant", "content": "Summarize this conversation in 700 characters or less"},
-            {"role": "user", "content": str(conversation)}
+            {"role": "system", "content": "Summarize this conversation in 700 characters or less. "
+                                          "If a summary so far is given, extend it with the new messages."},
+            {"role": "user", "content": transcript}
         ]
-        response = await self.client.chat.completions.create(
+        prompt_tokens = sum(self.__count_message_tokens(message) for message in messages)
+        response = await self.__create_chat_completion(
+            prompt_tokens,
             model=self.config['model'],
             messages=messages,
-            temperature=0.4
+            temperature=0.4,
+            max_tokens=self.config.get('summary_max_tokens', 500)
         )
         return response.choices[0].message.content
 
+    @staticmethod
+    def __format_turn(message) -> str:
+        """
+        Formats a conversation turn as a plain text line for summarisation.
+        :param message: The message to format
+        :return: The formatted message
+        """
+        content = message.get('content') or ''
+        if isinstance(content, list):
+            content = ' '.join(part['text'] if part['type'] == 'text' else '[image]' for part in content)
+        if message.get('tool_calls'):
+            calls = ', '.join(f"{tool_call['function']['name']}({tool_call['function']['arguments']})"
+                              for tool_call in message['tool_calls'])
+            return f"{message['role']}: [called {calls}]"
+        return f"{message['role']}: {content}"
+
+    def __stream_tokens(self, chat_id, response: UsageStream) -> int:
+        """
+        Gets the number of tokens a streamed response used, as reported by the server,
+        falling back to the size of the conversation history if it did not report it.
+        :param chat_id: The chat ID
+        :param response: The stream of response chunks, read to the end
+        :return: the number of tokens used
+        """
+        if response.usage is not None:
+            return response.usage.total_tokens
+        return self.__history_tokens(chat_id)
+
     def __max_model_tokens(self):
-        base = 4096
-        if self.config['model'] in GPT_3_MODELS:
-            return base
-        if self.config['model'] in GPT_3_16K_MODELS:
-            return base * 4
-        if self.config['model'] in GPT_4_MODELS:
-            return base * 2
-        if self.config['model'] in GPT_4_32K_MODELS:
-            return base * 8
-        if self.config['model'] in GPT_4_VISION_MODELS:
-            return base * 31
-        if self.config['model'] in GPT_4_128K_MODELS:
-            return base * 31
-        raise NotImplementedError(
-            f"Max tokens for model {self.config['model']} is not implemented yet."
-        )
+        return get_model_info(self.config['model']).context_window
+
+    def __history_tokens(self, chat_id) -> int:
+        """
+        Gets the number of tokens required to send the conversation history, using the
+        token counts stored alongside each message instead of re-encoding the history.
+        :param chat_id: The chat ID
+        :return: the number of tokens required
+        """
+        return self.conversations[chat_id].token_total + 3  # every reply is primed with <|start|>assistant<|message|>
 
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def __count_tokens(self, messages) -> int:
+    def __count_message_tokens(self, message) -> int:
         """
-        Counts the number of tokens required to send the given messages.
-        :param messages: the messages to send
+        Counts the number of tokens a single message takes up in a request.
+        :param message: the message to count
         :return: the number of tokens required
         """
         model = self.config['model']
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("gpt-3.5-turbo")
-
-        if model in GPT_3_MODELS + GPT_3_16K_MODELS:
-            tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-            tokens_per_name = -1  # if there's a name, the role is omitted
-        elif model in GPT_4_MODELS + GPT_4_32K_MODELS + GPT_4_VISION_MODELS + GPT_4_128K_MODELS:
-            tokens_per_message = 3
-            tokens_per_name = 1
-        else:
-            raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}.""")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                if key == 'content':
-                    if isinstance(value, str):
-                        num_tokens += len(encoding.encode(value))
-                    else:
-                        for message1 in value:
-                            if message1['type'] == 'image_url':
-                                image = decode_image(message1['image_url']['url'])
-                                num_tokens += self.__count_tokens_vision(image)
-                            else:
-                                num_tokens += len(encoding.encode(message1['text']))
-                else:
+        encoding = get_encoding(model)
+        info = get_model_info(model)
+
+        num_tokens = info.tokens_per_message
+        for key, value in message.items():
+            if value is None:
+                continue
+            if key == 'tool_calls':
+                for tool_call in value:
+                    num_tokens += len(encoding.encode(tool_call['function']['name']))
+                    num_tokens += len(encoding.encode(tool_call['function']['arguments']))
+            elif key == 'content':
+                if isinstance(value, str):
                     num_tokens += len(encoding.encode(value))
-                    if key == "name":
-                        num_tokens += tokens_per_name
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+                else:
+                    for message1 in value:
+                        if message1['type'] == 'image_ref':
+                            num_tokens += message1['tokens']
+                        else:
+                            num_tokens += len(encoding.encode(message1['text']))
+            else:
+                num_tokens += len(encoding.encode(value))
+                if key == "name":
+                    num_tokens += info.tokens_per_name
         return num_tokens
 
     # no longer needed
 
-    def __count_tokens_vision(self, image_bytes: bytes) -> int:
+    def __count_tokens_vision(self, width: int, height: int) -> int:
         """
         Counts the number of tokens for interpreting an image.
-        :param image_bytes: image to interpret
+        :param width: width of the image to interpret
+        :param height: height of the image to interpret
         :return: the number of tokens required
         """
-        image_file = io.BytesIO(image_bytes)
-        image = Image.open(image_file)
         model = self.config['vision_model']
-        if model not in GPT_4_VISION_MODELS:
-            raise NotImplementedError(f"""count_tokens_vision() is not implemented for model {model}.""")
-        
-        w, h = image.size
+        if not get_model_info(model).vision:
+            logging.warning(f'Model {model} is not known to support vision, counting image tokens as for GPT-4 Vision')
+
+        w, h = width, height
         if w > h: w, h = h, w
         # this computation follows https://platform.openai.com/docs/guides/vision and https://openai.com/pricing#gpt-4-turbo
         base_tokens = 85
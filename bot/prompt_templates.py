@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from string import Formatter
+
+from encodings_registry import get_encoding
+from model_registry import get_model_info
+
+
+class PromptTemplate:
+    """
+    A prompt with variables, e.g. 'Summarise these subtitles: {subtitles}'.
+    The tokens of its static text are counted once per model, so filling it in only
+    encodes the values, which are cut to the exact number of tokens left in its budget.
+    """
+
+    def __init__(self, name: str, text: str, budget: int | None = None):
+        """
+        Initializes the template.
+        :param name: The name of the template
+        :param text: The text of the template, with variables in braces
+        :param budget: The maximum number of tokens of the filled in prompt,
+                       None to fit the context window of the model
+        """
+        self.name = name
+        self.text = text
+        self.budget = budget
+        self.parts = [(literal, field) for literal, field, _, _ in Formatter().parse(text)]
+        self.fields = [field for _, field in self.parts if field is not None]
+        self.static_tokens: dict[str, int] = {}  # {model: tokens of the static text}
+
+    def static_cost(self, model: str) -> int:
+        """
+        Gets the number of tokens of the static text of the template.
+        :param model: The model the prompt is meant for
+        :return: The number of tokens
+        """
+        if model not in self.static_tokens:
+            encoding = get_encoding(model)
+            self.static_tokens[model] = sum(len(encoding.encode(literal)) for literal, _ in self.parts)
+        return self.static_tokens[model]
+
+    def render(self, model: str, budget: int | None = None, limit: int | None = None, **values) -> tuple[str, int]:
+        """
+        Fills in the template, cutting the values so that the prompt fits its budget.
+        When there is not enough room for all values, the shortest ones are kept whole
+        and the remaining tokens are shared equally among the longer ones.
+        :param model: The model the prompt is meant for
+        :param budget: The maximum number of tokens, overriding the budget of the template
+        :param limit: The number of tokens left for the prompt in the context window of the model
+                      that serves the request, which caps the budget
+        :param values: The values of the variables
+        :return: The prompt and its exact number of tokens
+        """
+        missing = [field for field in self.fields if field not in values]
+        if missing:
+            raise KeyError(f"Missing values for {', '.join(missing)} in prompt template {self.name}")
+
+        if budget is None:
+            budget = self.budget
+        if budget is None and limit is None:
+            info = get_model_info(model)
+            budget = info.context_window - info.default_max_tokens
+        if limit is not None:
+            budget = limit if budget is None else min(budget, limit)
+
+        encoding = get_encoding(model)
+        tokens = {field: encoding.encode(str(values[field])) for field in set(self.fields)}
+        room = budget - self.static_cost(model)
+        if room < 0:
+            raise ValueError(f'Prompt template {self.name} does not fit its budget of {budget} tokens')
+
+        limits = self.__share(room, {field: len(field_tokens) * self.fields.count(field)
+                                     for field, field_tokens in tokens.items()})
+        while True:
+            # A cut can split a multi-byte character, which would decode to a replacement character
+            filled = {
+                field: encoding.decode(field_tokens[:limits[field] // self.fields.count(field)]).rstrip('\ufffd')
+                for field, field_tokens in tokens.items()
+            }
+            prompt = ''.join(literal + (filled[field] if field is not None else '') for literal, field in self.parts)
+            total = len(encoding.encode(prompt))
+            # Tokens can merge across the seams of the parts, so the sum of the parts is only an estimate
+            over = total - budget
+            if over <= 0 or not any(limits.values()):
+                break
+            longest = max(limits, key=limits.get)
+            limits[longest] = max(limits[longest] - over, 0)
+        if total > budget:
+            raise ValueError(f'Prompt template {self.name} does not fit its budget of {budget} tokens')
+
+        cut = [field for field in tokens if len(filled[field]) < len(str(values[field]))]
+        if cut:
+            logging.info(f"Cut {', '.join(cut)} of prompt template {self.name} to fit {budget} tokens")
+        return prompt, total
+
+    @staticmethod
+    def __share(room: int, sizes: dict[str, int]) -> dict[str, int]:
+        """
+        Shares the tokens left in the budget among the values.
+        """
+        limits = {}
+        remaining = dict(sizes)
+        while remaining:
+            share = room // len(remaining)
+            fitting = {field: size for field, size in remaining.items() if size <= share}
+            if not fitting:
+                limits.update({field: share for field in remaining})
+                break
+            for field, size in fitting.items():
+                limits[field] = size
+                room -= size
+                del remaining[field]
+        return limits
+
+
+_templates: dict[str, PromptTemplate] = {}
+
+
+def load_prompts(path: str) -> None:
+    """
+    Adds or overrides prompt templates from a JSON file of the form
+    {"name": {"text": "Summarise these subtitles: {subtitles}", "budget": 12000}}.
+    :param path: The path of the JSON file
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        templates = json.load(file)
+    for name, fields in templates.items():
+        _templates[name] = PromptTemplate(name, fields['text'], fields.get('budget'))
+    logging.info(f'Loaded {len(templates)} prompt templates from {path}')
+
+
+def render_prompt(name: str, model: str, limit: int | None = None, **values) -> tuple[str, int]:
+    """
+    Fills in a prompt template, cutting the values to fit its budget.
+    :param name: The name of the template
+    :param model: The model the prompt is meant for
+    :param limit: The number of tokens left for the prompt in the context window, which caps the budget
+    :param values: The values of the variables
+    :return: The prompt and its exact number of tokens
+    """
+    return _templates[name].render(model, limit=limit, **values)
+
+
+def warm_up_prompts(models) -> None:
+    """
+    Counts the tokens of the static text of all templates for the given models eagerly.
+    :param models: The model names
+    """
+    for model in models:
+        if model:
+            for template in _templates.values():
+                template.static_cost(model)
+
+
+# Load the prompt templates
+load_prompts(os.path.join(os.path.dirname(__file__), os.pardir, 'prompts.json'))
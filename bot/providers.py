@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+
+import httpx
+import openai
+from openai.types.chat import ChatCompletion
+
+from retry_policy import is_retryable
+
+YANDEXGPT_BASE_URL = 'https://llm.api.cloud.yandex.net/foundationModels/v1'
+
+
+class Provider(ABC):
+    """
+    A service that answers chat completion requests in the format of the OpenAI API.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def supports(self, **kwargs) -> bool:
+        """
+        Checks if the provider can answer the given request.
+        :param kwargs: The arguments of the request
+        """
+        return True
+
+    @abstractmethod
+    async def create_chat_completion(self, **kwargs):
+        """
+        Sends a chat completion request.
+        :param kwargs: The arguments of the request, as for the OpenAI API
+        :return: The response, or the stream of response chunks
+        """
+        pass
+
+
+class OpenAIProvider(Provider):
+    """
+    The OpenAI API, or any API compatible with it.
+    """
+
+    def __init__(self, name: str, client: openai.AsyncOpenAI):
+        """
+        Initializes the provider.
+        :param name: The name of the provider
+        :param client: The OpenAI client
+        """
+        super().__init__(name)
+        # The retry policy replaces the retries of the client library
+        self.client = client.with_options(max_retries=0)
+
+    async def create_chat_completion(self, **kwargs):
+        return await self.client.chat.completions.create(**kwargs)
+
+
+class YandexGPTProvider(Provider):
+    """
+    The YandexGPT foundation models API. Only plain text requests without streaming are supported,
+    and every request is answered by the configured YandexGPT model.
+    """
+
+    def __init__(self, name: str, http_client: httpx.AsyncClient, api_key: str, folder_id: str,
+                 model: str = 'yandexgpt-lite/latest', base_url: str = YANDEXGPT_BASE_URL):
+        """
+        Initializes the provider.
+        :param name: The name of the provider
+        :param http_client: The HTTP client
+        :param api_key: The API key of the service account
+        :param folder_id: The ID of the Yandex Cloud folder
+        :param model: The model, e.g. 'yandexgpt/latest'
+        :param base_url: The URL of the API
+        """
+        super().__init__(name)
+        self.http_client = http_client
+        self.api_key = api_key
+        self.folder_id = folder_id
+        self.model = model
+        self.base_url = base_url.rstrip('/')
+
+    def supports(self, **kwargs) -> bool:
+        if kwargs.get('stream') or kwargs.get('tools') or kwargs.get('n', 1) > 1:
+            return False
+        for message in kwargs['messages']:
+            if message['role'] not in ('system', 'user', 'assistant') or message.get('tool_calls'):
+                return False
+            if isinstance(message.get('content'), list) and any(part['type'] != 'text' for part in message['content']):
+                return False
+        return True
+
+    async def create_chat_completion(self, **kwargs):
+        body = {
+            'modelUri': f'gpt://{self.folder_id}/{self.model}',
+            'completionOptions': {
+                'stream': False,
+                'temperature': min(kwargs.get('temperature', 0.6), 1.0),
+                'maxTokens': str(kwargs.get('max_tokens', 2000))
+            },
+            'messages': [{'role': message['role'], 'text': self.__text(message.get('content'))}
+                         for message in kwargs['messages']]
+        }
+        response = await self.http_client.post(
+            f'{self.base_url}/completion',
+            json=body,
+            headers={'Authorization': f'Api-Key {self.api_key}', 'x-folder-id': self.folder_id}
+        )
+        response.raise_for_status()
+        result = response.json()['result']
+        usage = result.get('usage', {})
+        return ChatCompletion.construct(
+            id=response.headers.get('x-request-id', ''),
+            object='chat.completion',
+            created=int(time.time()),
+            model=self.model,
+            choices=[{
+                'index': index,
+                'message': {'role': 'assistant', 'content': alternative['message']['text']},
+                'finish_reason': 'length' if alternative.get('status') == 'ALTERNATIVE_STATUS_TRUNCATED_FINAL'
+                else 'stop'
+            } for index, alternative in enumerate(result['alternatives'])],
+            usage={
+                'prompt_tokens': int(usage.get('inputTextTokens', 0)),
+                'completion_tokens': int(usage.get('completionTokens', 0)),
+                'total_tokens': int(usage.get('totalTokens', 0))
+            }
+        )
+
+    @staticmethod
+    def __text(content) -> str:
+        if isinstance(content, list):
+            return ' '.join(part['text'] for part in content)
+        return content or ''
+
+
+class ProviderHealth:
+    """
+    What the router knows about a provider: how fast it answers and whether it is failing.
+    """
+
+    def __init__(self):
+        self.latency: float | None = None  # moving average of the time to the first token of streams, in seconds
+        self.response_latency: float | None = None  # moving average of the time to whole responses, in seconds
+        self.failures = 0  # consecutive failures
+        self.unhealthy_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+
+class ProviderRouter:
+    """
+    Sends each request to the healthy provider that has been answering fastest,
+    and fails over to the next one when a provider fails in a way that may be transient or is too slow to answer.
+    Errors caused by the request itself, e.g. a prompt that is too long, are raised without failing over.
+    A failing provider is skipped for a cooldown that grows with its consecutive failures.
+    """
+
+    def __init__(self, providers: list[Provider], slow_timeout: float = 30.0, response_timeout: float = 0,
+                 cooldown: float = 30.0, smoothing: float = 0.2):
+        """
+        Initializes the router.
+        :param providers: The providers, in order of preference
+        :param slow_timeout: How long to wait for the first token of a stream before failing over, in seconds,
+                             0 to wait as long as the provider needs
+        :param response_timeout: How long to wait for a whole response that is not streamed before failing over,
+                                 in seconds, 0 to wait as long as the provider needs
+        :param cooldown: How long a failing provider is skipped after its first failure, in seconds
+        :param smoothing: The weight of the latest latency in the moving average
+        """
+        self.providers = providers
+        self.slow_timeout = slow_timeout
+        self.response_timeout = response_timeout
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.health = {provider.name: ProviderHealth() for provider in providers}
+
+    def candidates(self, **kwargs) -> list[Provider]:
+        """
+        Gets the providers that can answer the given request, in the order they should be tried.
+        Healthy providers come first, the fastest first, and providers that have not answered yet
+        are tried before they are compared. Streams are compared by their time to the first token,
+        other requests by their time to the whole response. Unhealthy providers are kept as a last resort.
+        :param kwargs: The arguments of the request
+        """
+        stream = kwargs.get('stream', False)
+
+        def key(item):
+            index, provider = item
+            health = self.health[provider.name]
+            latency = health.latency if stream else health.response_latency
+            return not health.healthy, latency if latency is not None else 0.0, index
+
+        supported = [(index, provider) for index, provider in enumerate(self.providers)
+                     if provider.supports(**kwargs)]
+        return [provider for _, provider in sorted(supported, key=key)]
+
+    def __succeeded(self, provider: Provider, latency: float, stream: bool):
+        health = self.health[provider.name]
+        health.failures = 0
+        health.unhealthy_until = 0.0
+        average = health.latency if stream else health.response_latency
+        average = latency if average is None else average + self.smoothing * (latency - average)
+        if stream:
+            health.latency = average
+        else:
+            health.response_latency = average
+
+    def __failed(self, provider: Provider, error: BaseException):
+        health = self.health[provider.name]
+        health.failures += 1
+        cooldown = min(self.cooldown * 2 ** (health.failures - 1), self.cooldown * 32)
+        health.unhealthy_until = time.monotonic() + cooldown
+        logging.warning(f'Provider {provider.name} failed with {error.__class__.__name__}: {str(error)}. '
+                        f'Skipping it for {cooldown:.0f}s')
+
+    async def call(self, attempt, **kwargs):
+        """
+        Sends a request to the best provider, failing over to the others.
+        :param attempt: An async function that sends the request to the given provider
+                        and returns once the first token of a stream, or the whole response, has arrived
+        :param kwargs: The arguments of the request
+        :return: The result of the first provider that answered
+        """
+        candidates = self.candidates(**kwargs)
+        if not candidates:
+            raise ValueError('No provider supports this request')
+        stream = kwargs.get('stream', False)
+        limit = self.slow_timeout if stream else self.response_timeout
+        for position, provider in enumerate(candidates):
+            last = position == len(candidates) - 1
+            start = time.monotonic()
+            try:
+                timeout = limit if limit > 0 and not last else None
+                result = await asyncio.wait_for(attempt(provider), timeout=timeout)
+            except asyncio.TimeoutError as e:
+                self.__failed(provider, e)
+                if last:
+                    raise
+                logging.warning(f'Provider {provider.name} did not answer within {limit}s, failing over')
+                continue
+            except Exception as e:
+                if not is_retryable(e):
+                    # Another provider would reject the request just the same
+                    raise
+                self.__failed(provider, e)
+                if last:
+                    raise
+                continue
+            self.__succeeded(provider, time.monotonic() - start, stream)
+            if position > 0:
+                logging.info(f'Request answered by provider {provider.name}')
+            return result
+
+    def stats(self) -> dict:
+        """
+        Gets the health of the providers.
+        :return: A dictionary with the latencies, consecutive failures and health of each provider
+        """
+        return {name: {'latency': health.latency, 'response_latency': health.response_latency,
+                       'failures': health.failures, 'healthy': health.healthy}
+                for name, health in self.health.items()}
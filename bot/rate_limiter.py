@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+
+
+class TokenBucket:
+    """
+    Budget that refills continuously up to its capacity over one minute.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Gets the number of seconds until the given amount is available.
+        """
+        self.refill()
+        missing = min(amount, self.capacity) - self.available
+        return max(missing, 0) * 60 / self.capacity
+
+    def consume(self, amount: float):
+        self.refill()
+        self.available -= amount
+
+    def refund(self, amount: float):
+        self.refill()
+        self.available = min(self.capacity, self.available + amount)
+
+
+@dataclass
+class Reservation:
+    """
+    Budget taken by a request, to be settled once its actual usage is known.
+    """
+    model: str
+    tokens: int
+
+
+class ModelRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets of a single model.
+    Requests wait in line: the first request in the queue is served first,
+    and no request can overtake it while it waits for the budget to refill.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.queue = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        async with self.queue:
+            while True:
+                wait = max(self.requests.wait_time(1) if self.requests else 0,
+                           self.tokens.wait_time(tokens) if self.tokens else 0)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.requests:
+                self.requests.consume(1)
+            if self.tokens:
+                self.tokens.consume(tokens)
+
+    def adjust(self, tokens: int):
+        """
+        Gives back (or takes, if negative) tokens after the actual usage of a request is known.
+        """
+        if self.tokens is None or tokens == 0:
+            return
+        if tokens > 0:
+            self.tokens.refund(tokens)
+        else:
+            self.tokens.consume(-tokens)
+
+
+class RateLimiter:
+    """
+    Client-side scheduler keeping requests within the rate limits of each model.
+    Requests reserve their estimated token usage up front (prompt plus maximum completion)
+    and the reservation is settled with the actual usage once the response arrives.
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0,
+                 model_limits: dict[str, tuple[int, int]] | None = None):
+        """
+        Initializes the rate limiter.
+        :param requests_per_minute: The default requests per minute of a model, 0 for no limit
+        :param tokens_per_minute: The default tokens per minute of a model, 0 for no limit
+        :param model_limits: Limits of specific models, as {model: (requests_per_minute, tokens_per_minute)}
+        """
+        self.default_limits = (requests_per_minute, tokens_per_minute)
+        self.model_limits = model_limits or {}
+        self.limiters: dict[str, ModelRateLimiter] = {}  # {model: limiter}
+
+    @staticmethod
+    def parse_model_limits(value: str) -> dict[str, tuple[int, int]]:
+        """
+        Parses per-model limits given as 'model:rpm:tpm,model:rpm:tpm'.
+        """
+        limits = {}
+        for item in value.split(','):
+            if not item.strip():
+                continue
+            try:
+                model, rpm, tpm = item.strip().rsplit(':', 2)
+                limits[model] = (int(rpm), int(tpm))
+            except ValueError:
+                logging.warning(f'Invalid rate limit {item}, expected model:rpm:tpm')
+        return limits
+
+    def __limiter(self, model: str) -> ModelRateLimiter | None:
+        if model not in self.limiters:
+            rpm, tpm = self.model_limits.get(model, self.default_limits)
+            self.limiters[model] = ModelRateLimiter(rpm, tpm) if rpm > 0 or tpm > 0 else None
+        return self.limiters[model]
+
+    async def acquire(self, model: str, tokens: int) -> Reservation:
+        """
+        Waits for its turn until the model has budget for the request, then takes it.
+        :param model: The model the request is sent to
+        :param tokens: The estimated number of tokens of the request
+        :return: The reservation
+        """
+        limiter = self.__limiter(model)
+        if limiter is not None:
+            await limiter.acquire(tokens)
+        return Reservation(model=model, tokens=tokens)
+
+    def settle(self, reservation: Reservation, used_tokens: int):
+        """
+        Corrects the reservation to the actual usage of the request.
+        :param reservation: The reservation of the request
+        :param used_tokens: The number of tokens the request actually used
+        """
+        limiter = self.__limiter(reservation.model)
+        if limiter is not None:
+            limiter.adjust(reservation.tokens - used_tokens)
+        reservation.tokens = used_tokens
+
+    def release(self, reservation: Reservation):
+        """
+        Gives back the tokens of a request that failed before using them.
+        :param reservation: The reservation of the request
+        """
+        self.settle(reservation, 0)
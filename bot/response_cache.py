@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+
+class MemoryCacheBackend:
+    """
+    Keeps cached responses in memory, evicting the least recently used entries first.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[float, object]] = OrderedDict()  # {key: (created, value)}
+
+    def get(self, key: str) -> tuple[float, object] | None:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key: str, created: float, value):
+        self.entries[key] = (created, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def delete(self, key: str):
+        self.entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class DiskCacheBackend:
+    """
+    Keeps cached responses as JSON files in a directory, so they survive restarts.
+    The oldest entries are evicted first.
+    """
+
+    def __init__(self, directory: str, max_entries: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key: str) -> tuple[float, object] | None:
+        try:
+            with open(self.__path(key), 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return entry['created'], entry['value']
+
+    def set(self, key: str, created: float, value):
+        with open(self.__path(key), 'w', encoding='utf-8') as file:
+            json.dump({'created': created, 'value': value}, file, ensure_ascii=False)
+        self.__evict()
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.__path(key))
+        except FileNotFoundError:
+            pass
+
+    def __files(self) -> list[str]:
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.json')]
+
+    def __evict(self):
+        files = self.__files()
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_entries]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __len__(self) -> int:
+        return len(self.__files())
+
+
+class ResponseCache:
+    """
+    Cache for model responses that are fully determined by their request.
+    Entries are addressed by a hash of the model, the messages and the sampling parameters,
+    and expire after a time-to-live.
+    """
+
+    def __init__(self, backend: str = 'memory', directory: str = 'response_cache',
+                 ttl_seconds: int = 86400, max_entries: int = 1000):
+        """
+        Initializes the response cache.
+        :param backend: Where to keep the cached responses, either 'memory' or 'disk'
+        :param directory: The directory for the disk backend
+        :param ttl_seconds: How long a cached response stays valid
+        :param max_entries: The maximum number of cached responses
+        """
+        if backend == 'disk':
+            self.backend = DiskCacheBackend(directory, max_entries)
+        else:
+            self.backend = MemoryCacheBackend(max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, messages: list[dict], **params) -> str:
+        """
+        Computes the cache key of a request.
+        :param model: The model name
+        :param messages: The messages sent to the model
+        :param params: The sampling parameters of the request
+        :return: The cache key
+        """
+        request = json.dumps({'model': model, 'messages': messages, 'params': params},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """
+        Gets a cached response.
+        :param key: The cache key
+        :return: The cached response, or None if there is no valid entry
+        """
+        entry = self.backend.get(key)
+        if entry is not None and time.time() - entry[0] > self.ttl_seconds:
+            self.backend.delete(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value):
+        """
+        Caches a response.
+        :param key: The cache key
+        :param value: The response, must be JSON serialisable
+        """
+        try:
+            self.backend.set(key, time.time(), value)
+        except OSError as e:
+            logging.warning(f'Failed to cache response: {str(e)}')
+
+    def stats(self) -> dict:
+        """
+        Gets the cache statistics.
+        :return: A dictionary with the number of entries, hits and misses
+        """
+        return {'entries': len(self.backend), 'hits': self.hits, 'misses': self.misses}
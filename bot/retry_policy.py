@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import datetime
+import logging
+import random
+import re
+from email.utils import parsedate_to_datetime
+
+import httpx
+import openai
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt
+
+# Status codes worth retrying: request timeout, lock conflict, rate limit and server errors
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+
+# Headers telling when the rate limit resets, in order of preference
+RESET_HEADERS = ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Checks if a failed request may succeed when sent again.
+    :param error: The error raised by the request
+    :return: A boolean indicating whether the request should be retried
+    """
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES or error.response.status_code >= 500
+    return isinstance(error, (httpx.TimeoutException, httpx.NetworkError))
+
+
+def parse_duration(value: str) -> float | None:
+    """
+    Parses a duration as used by the x-ratelimit-reset-* headers, e.g. '20ms', '1s' or '6m0s'.
+    :return: The duration in seconds, or None if it cannot be parsed
+    """
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts or ''.join(number + unit for number, unit in parts) != value.strip():
+        return None
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def retry_after(error: BaseException) -> float | None:
+    """
+    Gets how long the server asked to wait before retrying.
+    :param error: The error raised by the request
+    :return: The number of seconds to wait, or None if the server did not say
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    if 'retry-after-ms' in headers:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if 'retry-after' in headers:
+        value = headers['retry-after']
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)
+                return max(delay.total_seconds(), 0)
+            except (TypeError, ValueError):
+                pass
+    for header in RESET_HEADERS:
+        if header in headers:
+            delay = parse_duration(headers[header])
+            if delay is not None:
+                return delay
+    return None
+
+
+class RetryPolicy:
+    """
+    Retries transient failures of API requests.
+    Waits as long as the server asks for, otherwise backs off exponentially with full jitter.
+    """
+
+    def __init__(self, max_attempts: int = 3, initial_wait: float = 1.0, max_wait: float = 60.0):
+        """
+        Initializes the retry policy.
+        :param max_attempts: The maximum number of attempts, including the first one
+        :param initial_wait: The base of the exponential backoff, in seconds
+        :param max_wait: The maximum time to wait between attempts, in seconds
+        """
+        self.max_attempts = max_attempts
+        self.initial_wait = initial_wait
+        self.max_wait = max_wait
+
+    def wait_time(self, attempt: int, error: BaseException | None) -> float:
+        """
+        Gets how long to wait before the next attempt.
+        :param attempt: The number of the attempt that failed, starting at 1
+        :param error: The error raised by the attempt
+        :return: The number of seconds to wait
+        """
+        requested = retry_after(error) if error is not None else None
+        if requested is not None:
+            # A little jitter keeps the waiting requests from retrying all at once
+            return min(requested + random.uniform(0, self.initial_wait), self.max_wait)
+        return random.uniform(0, min(self.initial_wait * 2 ** (attempt - 1), self.max_wait))
+
+    def __wait(self, retry_state) -> float:
+        return self.wait_time(retry_state.attempt_number, retry_state.outcome.exception())
+
+    @staticmethod
+    def __log_retry(retry_state):
+        error = retry_state.outcome.exception()
+        logging.warning(f'Request failed with {error.__class__.__name__}: {str(error)}. '
+                        f'Retrying in {retry_state.next_action.sleep:.1f}s '
+                        f'(attempt {retry_state.attempt_number})...')
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Calls an async function, retrying it while it fails with a retryable error.
+        :param func: The async function to call
+        :return: The result of the function
+        """
+        retrying = AsyncRetrying(
+            reraise=True,
+            retry=retry_if_exception(is_retryable),
+            wait=self.__wait,
+            stop=stop_after_attempt(self.max_attempts),
+            before_sleep=self.__log_retry
+        )
+        return await retrying(func, *args, **kwargs)
@@ -17,9 +17,12 @@ from telegram import InputTextMessageContent, BotCommand
 from telegram.constants import ParseMode
 from telegram.error import RetryAfter, TimedOut, BadRequest, TelegramError
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, \
-    filters, CallbackQueryHandler, Application, ContextTypes, CallbackContext
+    filters, CallbackQueryHandler, Application, ContextTypes, CallbackContext, TypeHandler
 
 from openai_helper import OpenAIHelper, localized_text
+from audio_chunks import split_audio, stitch_transcripts
+from cancel_scope import CancelScopes
+from prompt_templates import render_prompt
 from usage_tracker import UsageTracker
 from utils import is_group_chat, get_thread_id, message_text, wrap_with_indicator, split_into_chunks, \
     edit_message_with_retry, get_stream_cutoff_values, is_allowed, get_remaining_budget, is_within_budget, \
@@ -234,6 +237,29 @@ class ChatGPTTelegramBot:
         self.user_contexts = {}
         self.user_states = {}
         self.user_input = {}
+        self.cancel_scopes = CancelScopes(timeout=config.get('update_timeout', 0))
+
+    async def open_cancel_scope(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Runs before the handlers of every update. A command of this bot starts a new flow, so it cancels
+        the updates of the same user in the chat that are still being handled, e.g. a reply that is still generated.
+        Then the update gets its own cancel scope, with the configured deadline.
+        """
+        if update.effective_chat is None:
+            return
+        key = (update.effective_chat.id, update.effective_user.id if update.effective_user else None)
+        if update.callback_query is None and self.is_bot_command(update, context.application):
+            self.cancel_scopes.cancel(key)
+        self.cancel_scopes.open(key)
+
+    @staticmethod
+    def is_bot_command(update: Update, application: Application) -> bool:
+        """
+        Checks if the update is a command that one of the command handlers of this bot handles,
+        addressed to this bot if it names one.
+        """
+        return any(isinstance(handler, CommandHandler) and handler.check_update(update)
+                   for handlers in application.handlers.values() for handler in handlers)
 
     async def check_subscription_status(self, user_id: int, feature: str) -> bool:
         # Проверяем наличие свободных попыток
@@ -499,7 +525,9 @@ class ChatGPTTelegramBot:
                 "Все! Как только генерация закончится, я пришлю и тебе и пользователю файл с сообщением. Например, 123-456-789? 123456789"
             )
             # task_id, chat_id = update.message.text.split(', ')
-            await self.monitor_task_and_get_data(update, context, update.message.text)
+            # The Octoparse task runs for hours, so the admin's next command must not cancel its monitoring
+            self.cancel_scopes.detach(self.monitor_task_and_get_data(update, context, update.message.text),
+                                      name=f'octoparse-{update.message.text}')
         elif state == 'admin_input_task_id_test':
             task_id, chat_id, *keys = update.message.text.split(', ')
 
@@ -784,9 +812,10 @@ class ChatGPTTelegramBot:
 
         titles_prompt = f"Придумай 50 версий названий для YouTube канала {user_input}. В названии должно содержаться от 2 до 4 слов, отражающих тематику канала, но они должны выглядеть как целостная фраза. Пожалуйста, кроме 50 названий ничего больше не пиши в этом ответе. На русском языке"
         description_prompt = f"Напиши описание к ютуб каналу про {user_description} В описании должно быть 400 слов. Укажи подробности о том, какой контент здесь люди смогут посмотреть и добавь призывы на подписку на канал и укажи, кому точно стоит оставаться на канале и смотреть его регулярно, чтобы не пропустить новых видео. Ответ должен быть на Русском языке."
-        titles_response, titles_total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=titles_prompt)
-        description_response, description_total_tokens = await self.openai.get_chat_response(chat_id=chat_id,
-                                                                                             query=description_prompt)
+        (titles_response, titles_total_tokens), (description_response, description_total_tokens) = await asyncio.gather(
+            self.openai.complete([{"role": "user", "content": titles_prompt}]),
+            self.openai.complete([{"role": "user", "content": description_prompt}])
+        )
         # await update.message.reply_text(
         #     f"Придумала для тебя 50 идей для названия, выбери любое понравившееся 👇\n\n{user_input}"
         # )
@@ -883,9 +912,9 @@ class ChatGPTTelegramBot:
             if not await self.check_and_handle_subscription_status(update, context, feature):
                 return
             user = session.query(User).filter(User.id == user_id).first()
-            shorts_query = f"Распиши 3 сценариев коротких видео по теме {user.channel_description} :: указав место съемки, раскадровку с числом секунд :: Полный текст, описание ролика с призывом к действию. Ответ должен быть на Русском языке. При создания сценария можно использовать один из методов по списку ниже: 1. Метод «скользкой горки» 2. Техника «шевеления занавеса» 3. Техника «Ложных следов» 4. Метод «Внутренний конфликт» 5. Техника «Крючок»"
-            shorts_response, shorts_total_tokens = await self.openai.get_chat_response(chat_id=chat_id,
-                                                                                       query=shorts_query)
+            shorts_query, shorts_query_tokens = self.openai.render_prompt('shorts', topic=user.channel_description)
+            shorts_response, shorts_total_tokens = await self.openai.complete(
+                [{"role": "user", "content": shorts_query}], prompt_tokens=shorts_query_tokens)
 
             keyboard = [
                 [InlineKeyboardButton("Создать еще шортсы", callback_data='create_new_shorts')],
@@ -912,8 +941,9 @@ class ChatGPTTelegramBot:
         feature = "shorts"
         if not await self.check_and_handle_subscription_status(update, context, feature):
             return
-        shorts_query = f"Распиши 3 сценариев коротких видео по теме {user_input} :: указав место съемки, раскадровку с числом секунд :: Полный текст, описание ролика с призывом к действию. Ответ должен быть на Русском языке. При создания сценария можно использовать один из методов по списку ниже: 1. Метод «скользкой горки» 2. Техника «шевеления занавеса» 3. Техника «Ложных следов» 4. Метод «Внутренний конфликт» 5. Техника «Крючок»"
-        shorts_response, shorts_total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=shorts_query)
+        shorts_query, shorts_query_tokens = self.openai.render_prompt('shorts', topic=user_input)
+        shorts_response, shorts_total_tokens = await self.openai.complete(
+            [{"role": "user", "content": shorts_query}], prompt_tokens=shorts_query_tokens)
         keyboard = [
             [InlineKeyboardButton("Создать еще shorts", callback_data='create_new_shorts')],
             [InlineKeyboardButton("Вернуться в меню", callback_data='view_features')]
@@ -986,58 +1016,62 @@ class ChatGPTTelegramBot:
             )
             subtitles = await self.get_subtitles(user_input)
             print(subtitles)
+            # Long videos are condensed instead of cut off after the first part
+            subtitles, _ = await self.openai.summarise_transcript(subtitles)
 
-            YANDEXGPT_TOKEN = os.environ['YANDEXGPT_TOKEN']
+            # The tags prompt is sent later in the same conversation, after the answer to the seo prompt,
+            # so the seo prompt leaves room for both
+            tags_query, tags_query_tokens = self.openai.render_prompt('tags')
+            seo_query, seo_query_tokens = self.openai.render_prompt('seo', follow_up_tokens=tags_query_tokens,
+                                                                    subtitles=subtitles)
 
-            # seo_query = f"Текст популярного видео: {subtitles[:25000]}. на основании представленного выше текста из видео сделай следующие шаги :: Создай seo оптимизацию для видео на YouTube по заданию ниже: Придумай название для видеоролика на YouTube. Количество слов в названии от 3 до 10. Предложи мне 5 идей :: Придумай описание к видео на ютюбу :: Описание должно состоять из 3 абзацев, первый должен отражать содержание и содержать ключевые слова для выдачи в поиске. Количество предложений от 10 до 15. Второй рассказывает про ролик и так же содержит ключевые слова для seo, количество предложений от 12 до 15. В третьем абзаце должно рассказывать о канале, количество предложений от 14 до 18. В конце описания должно быть 5 хэштегов по теме видео, каждый хэштег - 1 слово. В. Четвертом абзаце к описанию укажи ссылки на мои социальные сети Инстаграм - Телеграмм - :: Придумай 20 тегов к видео на YouTube и перечисли их через запятую :: Фразы могут содержать от 1 до 3 слов. Некоторые теги могут начинать со слова “как”, представь теги единым списком разделив их запятой. :: Также придумай на основе информации выше 10 идей концепции для превью картинок на видео на YouTube, какое должно быть фото на фоне, какого цвета фон, какие элементы расположить на картинке и какой должен быть указан текст. Ответ должен быть на русском языке и, если надо, то с использованием Markdown: вместо ### оборачивай ту часть сообщения, которую хочешь сделать жирным шрифтом, в ** перед началом предложения и ** в конце"
-            seo_query = f"Текст популярного видео: {subtitles[:25000]}. на основании представленного выше текста из видео сделай следующие шаги :: Создай seo оптимизацию для видео на YouTube по заданию ниже: Придумай название для видеоролика на YouTube. Количество слов в названии от 3 до 10. Предложи мне 5 идей :: Придумай описание к видео на ютюбу :: Описание должно состоять из 3 абзацев, первый должен отражать содержание и содержать ключевые слова для выдачи в поиске. Количество предложений от 10 до 15. Второй рассказывает про ролик и так же содержит ключевые слова для seo, количество предложений от 12 до 15. В третьем абзаце должно рассказывать о канале, количество предложений от 14 до 18. В конце описания должно быть 5 хэштегов по теме видео, каждый хэштег - 1 слово. В. Четвертом абзаце к описанию укажи ссылки на мои социальные сети Инстаграм - Телеграмq :: Также придумай на основе информации выше 10 идей концепции для превью картинок на видео на YouTube, какое должно быть фото на фоне, какого цвета фон, какие элементы расположить на картинке и какой должен быть указан текст. Ответ должен быть на русском языке и, если надо, то с использованием Markdown: вместо ### оборачивай ту часть сообщения, которую хочешь сделать жирным шрифтом, в ** перед началом предложения и ** в конце"
+            seo_messages = [{"role": "user", "content": seo_query}]
+            seo_response, seo_total_tokens = await self.openai.complete(seo_messages, cache=True,
+                                                                        prompt_tokens=seo_query_tokens)
 
-            seo_response, seo_total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=seo_query)
+            async def send(text, plain_text, reply_markup=None):
+                try:
+                    await context.bot.send_message(
+                        chat_id=update.effective_chat.id,
+                        text=text,
+                        reply_markup=reply_markup,
+                        parse_mode='Markdown'
+                    )
+                except Exception as e:
+                    # Если возникла ошибка, проверяем её тип
+                    if "can't parse entities" in str(e):
+                        # Если ошибка связана с невозможностью разбора сущностей, повторяем без Markdown
+                        try:
+                            await context.bot.send_message(
+                                chat_id=update.effective_chat.id,
+                                text=plain_text,
+                                reply_markup=reply_markup,
+                            )
+                        except Exception as e:
+                            # Обработка других потенциальных ошибок при повторной попытке
+                            print("Ошибка при отправке сообщения без Markdown: ", str(e))
+                            await context.bot.send_message(chat_id=chat_id, text=str(e))
+                    else:
+                        # Логирование или обработка других типов ошибок
+                        print("Ошибка при отправке сообщения: ", str(e))
+                        await context.bot.send_message(chat_id=chat_id, text=str(e))
 
-            tags_query = f"Хорошо, теперь напиши к этому же видео теги. Важно учесть следующие правила: Теги - это те запросы, которые часто делают люди в интернете, которым может быть интересно это видео, поэтому нам нужно учитывать, как содержание видео, так и потенциальные интересы аудитории. Люди не гуглят «бизнес идеи», они обычно гуглят «как заработать денег», здесь же нам надо использовать этот принцип. То есть представь, что ты человек, у него есть проблем, ты делаешь запросы в интернете, и твоя задача - через них найти вот такое видео. Поэтому в тегах может содержаться как 1 слово, отражающее тему видео, так и серия из 2,3,4 слов. Тегов должно быть около 50 штук, присылай их в столбик без лишних комментариев, как минимум 10 штук из них должны являться запросами людей и начинаться со слова как."
+            # The seo answer is sent right away, it is not lost if the tags request fails
+            await send(str(seo_response), str(seo_response))
 
-            tags_response, tags_total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=tags_query)
+            tags_messages = seo_messages + [
+                {"role": "assistant", "content": seo_response},
+                {"role": "user", "content": tags_query}
+            ]
+            tags_response, tags_total_tokens = await self.openai.complete(tags_messages)
 
             keyboard = [
                 [InlineKeyboardButton("Посмотреть функции", callback_data='view_features')],
             ]
 
             reply_markup = InlineKeyboardMarkup(keyboard)
-            try:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=str(seo_response),
-                    parse_mode='Markdown'
-                )
-
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"Теги, которые можешь использовать:\n\n{str(tags_response)}",
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
-            except Exception as e:
-                # Если возникла ошибка, проверяем её тип
-                if "can't parse entities" in str(e):
-                    # Если ошибка связана с невозможностью разбора сущностей, повторяем без Markdown
-                    try:
-                        await context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=str(seo_response),
-                        )
-                        await context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=f"Здесь я предложу теги для тебя:\n\n{str(tags_response)}",
-                            reply_markup=reply_markup,
-                        )
-                    except Exception as e:
-                        # Обработка других потенциальных ошибок при повторной попытке
-                        print("Ошибка при отправке сообщения без Markdown: ", str(e))
-                        await context.bot.send_message(chat_id=chat_id, text=str(e))
-                else:
-                    # Логирование или обработка других типов ошибок
-                    print("Ошибка при отправке сообщения: ", str(e))
-                    await context.bot.send_message(chat_id=chat_id, text=str(e))
+            await send(f"Теги, которые можешь использовать:\n\n{str(tags_response)}",
+                       f"Здесь я предложу теги для тебя:\n\n{str(tags_response)}", reply_markup)
         except ValueError as e:
             print(e)
             await context.bot.send_message(chat_id=chat_id, text=str(e))
@@ -1080,9 +1114,9 @@ class ChatGPTTelegramBot:
             if not await self.check_and_handle_subscription_status(update, context, feature):
                 return
             user = session.query(User).filter(User.id == user_id).first()
-            video_query = f"Распиши сценарий видео на 5-10 минут по теме {user.channel_description} :: указав место съемки, подробную раскадровку с числом секунд, внешний вид автора :: Напиши полный текст, по каждому промежутку раскадровки, который произнесет автор, с завершением ролика призывом к действию :: А после укажи рекомендации, на что обратить внимание при съемке. Ответ должен быть на Русском языке. При создания сценария можно использовать один из методов по списку ниже: 1. Метод «скользкой горки» 2. Техника «шевеления занавеса» 3. Техника «Ложных следов» 4. Метод «Внутренний конфликт» 5. Техника «Крючок»"
-            video_response, shorts_total_tokens = await self.openai.get_chat_response(chat_id=chat_id,
-                                                                                      query=video_query)
+            video_query, video_query_tokens = self.openai.render_prompt('video', topic=user.channel_description)
+            video_response, shorts_total_tokens = await self.openai.complete(
+                [{"role": "user", "content": video_query}], prompt_tokens=video_query_tokens)
 
             keyboard = [
                 [InlineKeyboardButton("Создать еще видео", callback_data='create_new_video')],
@@ -1114,8 +1148,9 @@ class ChatGPTTelegramBot:
         await update.message.reply_text(
             "Отлично! Ушла писать сценарий! 😇"
         )
-        video_query = f"Распиши сценарий видео на 5-10 минут по теме {user_input} :: указав место съемки, подробную раскадровку с числом секунд, внешний вид автора :: Напиши полный текст, по каждому промежутку раскадровки, который произнесет автор, с завершением ролика призывом к действию :: А после укажи рекомендации, на что обратить внимание при съемке. Ответ должен быть на Русском языке. При создания сценария можно использовать один из методов по списку ниже: 1. Метод «скользкой горки» 2. Техника «шевеления занавеса» 3. Техника «Ложных следов» 4. Метод «Внутренний конфликт» 5. Техника «Крючок»"
-        video_response, shorts_total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=video_query)
+        video_query, video_query_tokens = self.openai.render_prompt('video', topic=user_input)
+        video_response, shorts_total_tokens = await self.openai.complete(
+            [{"role": "user", "content": video_query}], prompt_tokens=video_query_tokens)
         await update.message.reply_text(
             "Вот твой ответ!"
         )
@@ -1177,20 +1212,17 @@ class ChatGPTTelegramBot:
                 reply_markup=reply_markup,
             )
 
-    async def send_notification_to_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message):
-        print("Тут ошибка")
-        chat_id = update.effective_chat.id if update.effective_chat else update.callback_query.message.chat_id
-
+    async def send_notification_to_admin(self, bot, chat_id, message):
         for admin_chat_id in ADMINS_CHAT_ID:
-            await context.bot.send_message(
+            await bot.send_message(
                 chat_id=admin_chat_id,
-                text=f"Пользователю ({update.effective_chat.id}, {chat_id}) нужен анализ с такими ключевыми словами:\n\n{message}"
+                text=f"Пользователю ({chat_id}) нужен анализ с такими ключевыми словами:\n\n{message}"
             )
-            await context.bot.send_message(
+            await bot.send_message(
                 chat_id=admin_chat_id,
                 text=f"Создай задачу в Octoparse, скопируй и введи сюда task_id:"
             )
-            self.user_states[update.effective_chat.id] = 'admin_input_task_id'
+            self.user_states[chat_id] = 'admin_input_task_id'
 
     async def send_excel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = [
@@ -1311,6 +1343,20 @@ class ChatGPTTelegramBot:
             reply_markup=reply_markup,
         )
 
+    async def health(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Sends the admin the health of the connections to the language models:
+        the latency and failures of each provider, the use of the connection pool and how often requests are hedged.
+        """
+        stats = {
+            'Провайдеры': self.openai.get_provider_stats(),
+            'Пул соединений': self.openai.get_http_pool_stats(),
+            'Хеджирование запросов': self.openai.get_hedge_stats() or 'выключено',
+        }
+        await update.message.reply_text('\n\n'.join(
+            f'{title}:\n{json.dumps(value, ensure_ascii=False, indent=2)}' for title, value in stats.items()
+        ))
+
     async def test_send_notification_to_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         self.user_states[update.effective_chat.id] = ''
 
@@ -1356,25 +1402,15 @@ class ChatGPTTelegramBot:
             # if not await self.check_and_handle_subscription_status(update, context, feature):
             #     return
             user = session.query(User).filter(User.id == user_id).first()
-            analytics_words_1_query = f"Cейчас я отправлю тебе определённый набор информации о моем канале на YouTube и по нему нам нужно будет выполнить серию заданий. {user.analytics_channel_description}. {user.analytics_channel_audience}. {user.analytics_channel_goals} Для начала - мне важно понять к каким категориям контента можно вообще отнести мой канал  - какие это ниши? какие есть конкуренты в этой теме? с кем мне нужно будет конкурировать за просмотры."
-            analytics_words_1_query_response, analytics_words_1_query_total_tokens = await self.openai.get_chat_response(
-                chat_id=chat_id, query=analytics_words_1_query)
-
-            analytics_words_2_query = f"{analytics_words_1_query_response}. На основе того что мы разработали выше - помоги мне составить портрет целевого зрителя - я и его интересы - какие у него потребности и желания что ему хочется иметь в своей жизни какой контент он любит смотреть и вообще как нам сделать так чтобы зрители смотрели наши видео а не видео конкурентов"
-            analytics_words_2_query_response, analytics_words_2_query_total_tokens = await self.openai.get_chat_response(
-                chat_id=chat_id, query=analytics_words_2_query)
-
-            analytics_words_3_query = f"{analytics_words_2_query_response}. Хорошо теперь на основе всех данных мне необходимо подготовить 100 ключевых слов которые могут содержаться в названиях видео конкурентов - важно чтобы это были не просто слова по тематике а конкретные слова которые есть в названиях тех видео которое может интересно описанному выше целевому зрителю"
-            analytics_words_3_query_response, analytics_words_3_query_total_tokens = await self.openai.get_chat_response(
-                chat_id=chat_id, query=analytics_words_3_query)
-
-            analytics_words_4_query = f"{analytics_words_3_query_response}. Теперь давай выберем из них 15 самых приоритетных и лучших - я буду загружать эти слова в парсер - поэтому каждый пункт это только 1 слово и важно чтобы оно было максимально простым и отражало суть чтобы собрать лучшие видео со всего ютюба и переведи эти слова на английский - в итоге в списке должно получить 30 слов (15 рус и 15 англ). Напиши только список слов, каждое слово с новой строки, без воды, только список из 30 слов."
-            analytics_words_4_query_response, analytics_words_4_query_total_tokens = await self.openai.get_chat_response(
-                chat_id=chat_id, query=analytics_words_4_query)
-
-            user_context.save_analytics_words(user_id, analytics_words_4_query_response)
+            # The prompt starts a chain, whose steps are counted as they are sent
+            analytics_words_1_query = self.openai.render_prompt(
+                'analytics_niches',
+                channel=f'{user.analytics_channel_description}. {user.analytics_channel_audience}. '
+                        f'{user.analytics_channel_goals}')[0]
 
-            await self.send_notification_to_admin(update, context, analytics_words_4_query_response)
+        # The chain takes hours, so it must not be cancelled by the next command of the user
+        self.cancel_scopes.detach(self.generate_analytics_words(context.bot, chat_id, user_id, analytics_words_1_query),
+                                  name=f'analytics-{user_id}')
 
             # await asyncio.sleep(5)
             #
@@ -1447,18 +1483,24 @@ class ChatGPTTelegramBot:
                 for link in links:
                     subtitles = await self.get_subtitles(link)
                     print(subtitles)
-                    all_subtitles.append(subtitles[:25000])
+                    subtitles, _ = await self.openai.summarise_transcript(subtitles)
+                    all_subtitles.append(subtitles)
 
-                    subtitles_query = f"У меня есть субтитры к видео - напиши по ним краткое содержание в 3-4 предложения. И ничего более. СУБТИТРЫ: {subtitles[:25000]}"
+                    subtitles_query, subtitles_query_tokens = self.openai.render_prompt('subtitles_summary',
+                                                                                        subtitles=subtitles)
 
-                    subtitles_response, subtitles_total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=subtitles_query)
+                    subtitles_response, subtitles_total_tokens = await self.openai.complete(
+                        [{"role": "user", "content": subtitles_query}], cache=True,
+                        prompt_tokens=subtitles_query_tokens)
 
                     all_generates_by_subtitles.append(subtitles_response)
 
-                subtitles_end_query = f"У меня есть 5 кратких содержаний с ютуб канала. СОДЕРЖАНИЯ: {', СЛЕДУЮЩЕЕ СОДЕРЖАНИЕ: '.join(all_generates_by_subtitles)}. На основе этих данных мне необходимо заполнить 3 вопроса: Первый - Расскажите о чем канал (Вставь ответ содержащий 7 предложений начиная с «канал о…». Второй - Расскажите о своей аудитории (Вставь ответ содержащий информацию об аудитории такого канала - ее интересах и потребностях в 7 предложений). Выбери 3 категории из 6-и возможных - это категории «задачи канал» то есть то что важно для автора на основе этой информации. Категории следующие: Набор подписчиков, Повышение узнаваемости, Информирование людей, Получение клиентов, Личная реализация. Представь ответ в формате 3 пунктов по заданию выше. В выдаче должны быть только ответы, три абзаца."
+                subtitles_end_query, subtitles_end_query_tokens = self.openai.render_prompt(
+                    'channel_characteristics',
+                    summaries=', СЛЕДУЮЩЕЕ СОДЕРЖАНИЕ: '.join(all_generates_by_subtitles))
 
-                subtitles_end_query_response, subtitles_end_query_total_tokens = await self.openai.get_chat_response(chat_id=chat_id,
-                                                                                                 query=subtitles_end_query)
+                subtitles_end_query_response, subtitles_end_query_total_tokens = await self.openai.complete(
+                    [{"role": "user", "content": subtitles_end_query}], prompt_tokens=subtitles_end_query_tokens)
 
                 user_context.save_analytics_channel_characteristics(user_id, subtitles_end_query_response)
 
@@ -1534,27 +1576,47 @@ class ChatGPTTelegramBot:
 
             print("Chat id:", chat_id)
 
-            analytics_words_1_query = f"Cейчас я отправлю тебе определённый набор информации о моем канале на YouTube и по нему нам нужно будет выполнить серию заданий. {user.analytics_channel_characteristics} Для начала - мне важно понять к каким категориям контента можно вообще отнести мой канал  - какие это ниши? какие есть конкуренты в этой теме? с кем мне нужно будет конкурировать за просмотры."
-            analytics_words_1_query_response, analytics_words_1_query_total_tokens = await self.openai.get_chat_response(
-                chat_id=chat_id, query=analytics_words_1_query)
+            # The prompt starts a chain, whose steps are counted as they are sent
+            analytics_words_1_query = self.openai.render_prompt(
+                'analytics_niches', channel=user.analytics_channel_characteristics)[0]
 
-            analytics_words_2_query = f"{analytics_words_1_query_response}. На основе того что мы разработали выше - помоги мне составить портрет целевого зрителя - я и его интересы - какие у него потребности и желания что ему хочется иметь в своей жизни какой контент он любит смотреть и вообще как нам сделать так чтобы зрители смотрели наши видео а не видео конкурентов"
-            analytics_words_2_query_response, analytics_words_2_query_total_tokens = await self.openai.get_chat_response(
-                chat_id=chat_id, query=analytics_words_2_query)
+        # The chain takes hours, so it must not be cancelled by the next command of the user
+        self.cancel_scopes.detach(self.generate_analytics_words(context.bot, chat_id, user_id, analytics_words_1_query),
+                                  name=f'analytics-{user_id}')
 
-            analytics_words_3_query = f"{analytics_words_2_query_response}. Хорошо теперь на основе всех данных мне необходимо подготовить 100 ключевых слов которые могут содержаться в названиях видео конкурентов - важно чтобы это были не просто слова по тематике а конкретные слова которые есть в названиях тех видео которое может интересно описанному выше целевому зрителю"
-            analytics_words_3_query_response, analytics_words_3_query_total_tokens = await self.openai.get_chat_response(
-                chat_id=chat_id, query=analytics_words_3_query)
-
-            analytics_words_4_query = f"{analytics_words_3_query_response}. Теперь давай выберем из них 15 самых приоритетных и лучших - я буду загружать эти слова в парсер - поэтому каждый пункт это только 1 слово и важно чтобы оно было максимально простым и отражало суть чтобы собрать лучшие видео со всего ютюба и переведи эти слова на английский - в итоге в списке должно получить 30 слов (15 рус и 15 англ). Напиши только список слов, каждое слово с новой строки, без воды, только список из 30 слов."
-            analytics_words_4_query_response, analytics_words_4_query_total_tokens = await self.openai.get_chat_response(
-                chat_id=chat_id, query=analytics_words_4_query)
-
-            print("Chat id:", chat_id)
+    async def generate_analytics_words(self, bot, chat_id, user_id, analytics_words_1_query=None, job_id=None):
+        """
+        Runs the chain of analytics prompts, which go through the Batch API and may take hours,
+        saves the resulting keywords and sends them to the admins.
+        The chain is saved as it goes, so post_init resumes it if the bot restarts before it is done.
+        :param analytics_words_1_query: The first prompt of a new chain
+        :param job_id: The ID of a saved chain to resume instead
+        """
+        try:
+            if job_id is None:
+                job_id = f'analytics-{user_id}-{uuid4().hex[:8]}'
+                model = self.openai.config['model']
+                prompts = [analytics_words_1_query] + [
+                    render_prompt(name, model)[0]
+                    for name in ('analytics_audience', 'analytics_keywords', 'analytics_priority_keywords')
+                ]
+                analytics_words_4_query_response = await self.openai.complete_chain(
+                    job_id, prompts, metadata={'kind': 'analytics', 'chat_id': chat_id, 'user_id': user_id},
+                    batch=True)
+            else:
+                analytics_words_4_query_response = await self.openai.resume_chain(job_id)
+        except Exception as e:
+            logging.error(f'Analytics chain {job_id} failed: {str(e)}')
+            self.openai.finish_chain(job_id)
+            await bot.send_message(chat_id=chat_id,
+                                   text=f"Кажется, что-то пошло не так при подготовке аналитики, попробуй еще раз.\n\n{e}")
+            return
 
-            user_context.save_analytics_words(user_id, analytics_words_4_query_response)
+        user_context = await self.get_user_context(chat_id)
+        user_context.save_analytics_words(user_id, analytics_words_4_query_response)
 
-            await self.send_notification_to_admin(update, context, analytics_words_4_query_response)
+        await self.send_notification_to_admin(bot, chat_id, analytics_words_4_query_response)
+        self.openai.finish_chain(job_id)
 
     async def monitor_task_and_get_data(self, update: Update, context: ContextTypes.DEFAULT_TYPE, task_id):
         octoparse = Octoparse()
@@ -2101,20 +2163,23 @@ class ChatGPTTelegramBot:
 
         async def _generate():
             try:
-                speech_file, text_length = await self.openai.generate_speech(text=tts_query)
-
-                await update.effective_message.reply_voice(
-                    reply_to_message_id=get_reply_to_message_id(self.config, update),
-                    voice=speech_file
-                )
-                speech_file.close()
-                # add image request to users usage tracker
                 user_id = update.message.from_user.id
-                self.usage[user_id].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
-                # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
-                    self.usage["guests"].add_tts_request(text_length, self.config['tts_model'],
-                                                         self.config['tts_prices'])
+                first = True
+                # Send every part as soon as it is ready, while the later ones are still being synthesised
+                async for speech_file, text_length in self.openai.generate_speech_chunks(text=tts_query):
+                    await update.effective_message.reply_voice(
+                        reply_to_message_id=get_reply_to_message_id(self.config, update) if first else None,
+                        voice=speech_file
+                    )
+                    speech_file.close()
+                    first = False
+                    # add tts request to users usage tracker
+                    self.usage[user_id].add_tts_request(text_length, self.config['tts_model'],
+                                                        self.config['tts_prices'])
+                    # add guest chat request to guest usage tracker
+                    if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
+                        self.usage["guests"].add_tts_request(text_length, self.config['tts_model'],
+                                                             self.config['tts_prices'])
 
             except Exception as e:
                 logging.exception(e)
@@ -2181,15 +2246,29 @@ class ChatGPTTelegramBot:
             if user_id not in self.usage:
                 self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
 
+            chunk_filenames = []
             try:
-                transcript = await self.openai.transcribe(filename_mp3)
-
+                chunks = await asyncio.to_thread(split_audio, audio_track,
+                                                 self.config['transcription_chunk_seconds'],
+                                                 self.config['transcription_chunk_overlap_seconds'])
+                if len(chunks) == 1:
+                    transcript = await self.openai.transcribe(filename_mp3)
+                else:
+                    logging.info(f'Transcribing {audio_track.duration_seconds:.0f}s of audio in {len(chunks)} chunks')
+                    chunk_filenames = [f'{filename}_{index}.mp3' for index in range(len(chunks))]
+                    for chunk, chunk_filename in zip(chunks, chunk_filenames):
+                        await asyncio.to_thread(chunk.audio.export, chunk_filename, format="mp3")
+                    transcripts = await self.openai.transcribe_chunks(chunk_filenames)
+                    transcript = stitch_transcripts(transcripts, chunks)
+
+                # Overlapping parts are billed twice
+                duration_seconds = sum(chunk.audio.duration_seconds for chunk in chunks)
                 transcription_price = self.config['transcription_price']
-                self.usage[user_id].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                self.usage[user_id].add_transcription_seconds(duration_seconds, transcription_price)
 
                 allowed_user_ids = self.config['allowed_user_ids'].split(',')
                 if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
-                    self.usage["guests"].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                    self.usage["guests"].add_transcription_seconds(duration_seconds, transcription_price)
 
                 # check if transcript starts with any of the prefixes
                 response_to_transcription = any(transcript.lower().startswith(prefix.lower()) if prefix else False
@@ -2211,6 +2290,9 @@ class ChatGPTTelegramBot:
                 else:
                     # Get the response of the transcript
                     response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=transcript)
+                    if response is None:
+                        # Answered along with an earlier message of this chat
+                        return
 
                     self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
                     if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
@@ -2240,6 +2322,9 @@ class ChatGPTTelegramBot:
                     parse_mode=constants.ParseMode.MARKDOWN
                 )
             finally:
+                for chunk_filename in chunk_filenames:
+                    if os.path.exists(chunk_filename):
+                        os.remove(chunk_filename)
                 if os.path.exists(filename_mp3):
                     os.remove(filename_mp3)
                 if os.path.exists(filename):
@@ -2567,6 +2652,9 @@ class ChatGPTTelegramBot:
                 async def _reply():
                     nonlocal total_tokens
                     response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=prompt)
+                    if response is None:
+                        # Answered along with an earlier message of this chat
+                        return
 
                     if is_direct_result(response):
                         return await handle_direct_result(self.config, update, response)
@@ -2755,6 +2843,11 @@ class ChatGPTTelegramBot:
 
                         logging.info(f'Generating response for inline query by {name}')
                         response, total_tokens = await self.openai.get_chat_response(chat_id=user_id, query=query)
+                        if response is None:
+                            # Answered along with an earlier query of this user
+                            await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                                          text=query, is_inline=True)
+                            return
 
                         if is_direct_result(response):
                             cleanup_intermediate_files(response)
@@ -2843,6 +2936,23 @@ class ChatGPTTelegramBot:
         await application.bot.set_my_commands(self.group_commands, scope=BotCommandScopeAllGroupChats())
         await application.bot.set_my_commands(self.commands)
 
+        # Analytics chains that were still running when the bot stopped
+        for job_id, metadata in self.openai.pending_chains().items():
+            if metadata.get('kind') == 'analytics':
+                logging.info(f'Resuming analytics chain {job_id}')
+                self.cancel_scopes.detach(
+                    self.generate_analytics_words(application.bot, metadata['chat_id'], metadata['user_id'],
+                                                  job_id=job_id),
+                    name=job_id)
+
+    async def post_shutdown(self, application: Application) -> None:
+        """
+        Post shutdown hook for the bot.
+        """
+        await self.cancel_scopes.close()
+        # Writes the conversations that are still waiting for the next batch
+        self.openai.conversations.close()
+
     async def admin_menu(self, update: Update, context: CallbackContext):
         self.user_states[update.effective_chat.id] = ''
 
@@ -2858,6 +2968,7 @@ class ChatGPTTelegramBot:
             .proxy_url(self.config['proxy']) \
             .get_updates_proxy_url(self.config['proxy']) \
             .post_init(self.post_init) \
+            .post_shutdown(self.post_shutdown) \
             .concurrent_updates(True) \
             .build()
 
@@ -2884,6 +2995,8 @@ class ChatGPTTelegramBot:
         # dispatcher.add_handler(conv_handler)
 
         # application.add_handler(CommandHandler('admin_menu', self.admin_menu, filters=filters.User(user_id=627512965)))
+        # Updates are handled concurrently, each in its own task, which the cancel scope can cancel
+        application.add_handler(TypeHandler(Update, self.open_cancel_scope), group=-1)
         application.add_handler(CommandHandler('start', self.start))
         application.add_handler(CommandHandler('analytics', self.analytics))
         application.add_handler(CommandHandler('naming', self.naming))
@@ -2899,6 +3012,7 @@ class ChatGPTTelegramBot:
         application.add_handler(CommandHandler('support', self.support))
         application.add_handler(CommandHandler('faq', self.faq))
         application.add_handler(CommandHandler('admin', self.admin, filters=filters.User(user_id=627512965)))
+        application.add_handler(CommandHandler('health', self.health, filters=filters.User(user_id=627512965)))
 
         application.add_handler(CommandHandler('test', self.test_send_notification_to_admin, filters=filters.User(user_id=627512965)))
 
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+
+class UsageStream:
+    """
+    Wraps a stream of chat completion chunks to pick up the usage the server reports in the final chunk,
+    when the request asked for it with stream_options={'include_usage': True}.
+    """
+
+    def __init__(self, stream, on_usage=None, on_abort=None, on_end=None):
+        """
+        Initializes the stream.
+        :param stream: The stream of chunks
+        :param on_usage: Called with the usage once the server has reported it
+        :param on_abort: Called if the stream is closed before it was read to the end
+                         and before the server has reported the usage
+        :param on_end: Called with the generated text if the stream was read to the end
+                       without the server reporting the usage, e.g. because it ignores include_usage
+        """
+        self.stream = stream
+        self.on_usage = on_usage
+        self.on_abort = on_abort
+        self.on_end = on_end
+        self.usage = None
+        self.iterator = None
+        self.first_chunk = None
+        self.exhausted = False
+        self.parts: list[str] = []  # the generated text, only kept while the usage is unknown
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.first_chunk is not None:
+            chunk, self.first_chunk = self.first_chunk, None
+            return chunk
+        if self.iterator is None:
+            self.iterator = self.stream.__aiter__()
+        try:
+            chunk = await self.iterator.__anext__()
+        except StopAsyncIteration:
+            self.exhausted = True
+            raise
+        if getattr(chunk, 'usage', None) is not None and self.usage is None:
+            self.usage = chunk.usage
+            self.parts = []
+            if self.on_usage is not None:
+                self.on_usage(chunk.usage)
+        elif self.usage is None and self.on_end is not None:
+            self.parts.extend(choice.delta.content for choice in getattr(chunk, 'choices', None) or []
+                              if choice.delta is not None and choice.delta.content)
+        return chunk
+
+    async def prime(self):
+        """
+        Waits for the first chunk, which is kept to be read first.
+        """
+        if self.first_chunk is None:
+            try:
+                self.first_chunk = await self.__anext__()
+            except StopAsyncIteration:
+                pass
+
+    async def close(self):
+        """
+        Closes the underlying response.
+        """
+        try:
+            await self.stream.close()
+        finally:
+            if self.usage is None:
+                on_abort, on_end, self.on_abort, self.on_end = self.on_abort, self.on_end, None, None
+                if self.exhausted:
+                    if on_end is not None:
+                        on_end(''.join(self.parts))
+                elif on_abort is not None:
+                    on_abort()
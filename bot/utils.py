@@ -6,11 +6,13 @@ import json
 import logging
 import os
 import base64
+import re
 
 import telegram
 from telegram import Message, MessageEntity, Update, ChatMember, constants
 from telegram.ext import CallbackContext, ContextTypes
 
+from cancel_scope import current_scope
 from usage_tracker import UsageTracker
 
 
@@ -85,21 +87,58 @@ def split_into_chunks(text: str, chunk_size: int = 4096) -> list[str]:
     return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
 
 
+def split_into_sentence_chunks(text: str, chunk_size: int) -> list[str]:
+    """
+    Splits a text into chunks of at most chunk_size characters, at sentence boundaries where possible.
+    Sentences longer than a chunk are split between words.
+    """
+    chunks = []
+    current = ''
+    for sentence in re.split(r'(?<=[.!?…])\s+|\n+', text.strip()):
+        while len(sentence) > chunk_size:
+            cut = sentence.rfind(' ', 0, chunk_size)
+            cut = cut if cut > 0 else chunk_size
+            sentence_part, sentence = sentence[:cut], sentence[cut:].lstrip()
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(sentence_part)
+        if not sentence:
+            continue
+        if current and len(current) + 1 + len(sentence) > chunk_size:
+            chunks.append(current)
+            current = ''
+        current = f'{current} {sentence}' if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
 async def wrap_with_indicator(update: Update, context: CallbackContext, coroutine,
                               chat_action: constants.ChatAction = "", is_inline=False):
     """
     Wraps a coroutine while repeatedly sending a chat action to the user.
+    The coroutine belongs to the cancel scope of the update, and is cancelled if the wrapper is.
     """
+    scope = current_scope()
     task = context.application.create_task(coroutine(), update=update)
-    while not task.done():
-        if not is_inline:
-            context.application.create_task(
-                update.effective_chat.send_action(chat_action, message_thread_id=get_thread_id(update))
-            )
-        try:
-            await asyncio.wait_for(asyncio.shield(task), 4.5)
-        except asyncio.TimeoutError:
-            pass
+    if scope is not None:
+        scope.add(task)
+    try:
+        while not task.done():
+            if not is_inline:
+                action = context.application.create_task(
+                    update.effective_chat.send_action(chat_action, message_thread_id=get_thread_id(update))
+                )
+                if scope is not None:
+                    scope.add(action)
+            try:
+                await asyncio.wait_for(asyncio.shield(task), 4.5)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if not task.done():
+            task.cancel()
 
 
 async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: int | None,
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import re
+
+import httpx
+import openai
+
+from openai_helper import OpenAIHelper
+from providers import OpenAIProvider, ProviderRouter
+
+
+class OpenAIStandIn:
+    """
+    A local stand-in for the chat completions endpoint of the OpenAI API.
+    Streams keep track of whether they were closed, and can be slow to send their first chunk.
+    """
+
+    def __init__(self, answer='Hello', status_code=200, delay=0.0, first_chunk_delay=0.0, usage=True):
+        self.answer = answer
+        self.status_code = status_code
+        self.delay = delay
+        self.first_chunk_delay = first_chunk_delay
+        self.usage = usage  # whether streams report their usage when asked to
+        self.requests = []
+        self.streams_opened = 0
+        self.streams_closed = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        assert request.url.path == '/v1/chat/completions'
+        body = json.loads(request.content)
+        self.requests.append(body)
+        await asyncio.sleep(self.delay)
+        if self.status_code != 200:
+            return httpx.Response(self.status_code, json={'error': {'message': 'stand-in error', 'type': 'error'}})
+        usage = {'prompt_tokens': 10, 'completion_tokens': 2, 'total_tokens': 12}
+        if body.get('stream'):
+            chunk = {'id': 'chatcmpl-1', 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'],
+                     'choices': [{'index': 0, 'delta': {'content': self.answer}, 'finish_reason': 'stop'}]}
+            events = [f'data: {json.dumps(chunk)}\n\n']
+            if self.usage and body.get('stream_options', {}).get('include_usage'):
+                events.append(f"data: {json.dumps({**chunk, 'choices': [], 'usage': usage})}\n\n")
+            events.append('data: [DONE]\n\n')
+            self.streams_opened += 1
+            return httpx.Response(200, headers={'content-type': 'text/event-stream'},
+                                  stream=_EventStream(events, self.first_chunk_delay, self.__stream_closed))
+        return httpx.Response(200, json={
+            'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': self.answer},
+                         'finish_reason': 'stop'}],
+            'usage': usage
+        })
+
+    def __stream_closed(self):
+        self.streams_closed += 1
+
+
+class _EventStream(httpx.AsyncByteStream):
+    """
+    The body of a streamed response, which reports when it is closed.
+    """
+
+    def __init__(self, events: list[str], first_chunk_delay: float, on_close):
+        self.events = events
+        self.first_chunk_delay = first_chunk_delay
+        self.on_close = on_close
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.first_chunk_delay)
+        for event in self.events:
+            yield event.encode()
+
+    async def aclose(self):
+        self.on_close()
+
+
+class YandexGPTStandIn:
+    """
+    A local stand-in for the completion endpoint of the YandexGPT API.
+    """
+
+    def __init__(self, answer='Привет', status_code=200):
+        self.answer = answer
+        self.status_code = status_code
+        self.requests = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        assert request.url.path == '/foundationModels/v1/completion'
+        self.requests.append((request.headers, json.loads(request.content)))
+        if self.status_code != 200:
+            return httpx.Response(self.status_code, json={'error': 'stand-in error'})
+        return httpx.Response(200, json={'result': {
+            'alternatives': [{'message': {'role': 'assistant', 'text': self.answer},
+                              'status': 'ALTERNATIVE_STATUS_FINAL'}],
+            'usage': {'inputTextTokens': '8', 'completionTokens': '3', 'totalTokens': '11'}
+        }})
+
+
+class BatchAPIStandIn:
+    """
+    A local stand-in for the files and batches endpoints of the OpenAI API.
+    A batch is processed on its first poll, unless it was created after the stand-in was told to hold batches.
+    """
+
+    def __init__(self):
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+        self.requests: list[dict] = []  # the bodies of the batched chat completion requests, in order
+        self.hold_from: int | None = None  # the number of batches after which new batches are held
+        self.held: set[str] = set()
+        self.created = 0
+
+    def answer(self, body: dict) -> str:
+        return f"answer to {body['messages'][-1]['content']}"
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if request.method == 'POST' and path == '/v1/files':
+            content = re.search(rb'filename="[^"]*"\r\n.*?\r\n\r\n(.*?)\r\n--', request.content, re.S).group(1)
+            return httpx.Response(200, json=self.__file(content, 'batch'))
+        if request.method == 'GET' and path.startswith('/v1/files/') and path.endswith('/content'):
+            return httpx.Response(200, content=self.files[path.split('/')[3]])
+        if request.method == 'DELETE' and path.startswith('/v1/files/'):
+            file_id = path.split('/')[3]
+            self.files.pop(file_id)
+            return httpx.Response(200, json={'id': file_id, 'object': 'file', 'deleted': True})
+        if request.method == 'POST' and path == '/v1/batches':
+            body = json.loads(request.content)
+            batch = {'id': f'batch_{len(self.batches)}', 'object': 'batch', 'endpoint': body['endpoint'],
+                     'input_file_id': body['input_file_id'], 'completion_window': body['completion_window'],
+                     'status': 'in_progress', 'created_at': 0}
+            if self.hold_from is not None and len(self.batches) >= self.hold_from:
+                self.held.add(batch['id'])
+            self.batches[batch['id']] = batch
+            return httpx.Response(200, json=batch)
+        if request.method == 'GET' and path.startswith('/v1/batches/'):
+            batch = self.batches.get(path.split('/')[3])
+            if batch is None:
+                return httpx.Response(404, json={'error': {'message': 'No such batch', 'type': 'invalid_request'}})
+            if batch['status'] == 'in_progress' and batch['id'] not in self.held:
+                self.__process(batch)
+            return httpx.Response(200, json=batch)
+        return httpx.Response(404, json={'error': {'message': f'Unknown endpoint {path}'}})
+
+    def __file(self, content: bytes, purpose: str) -> dict:
+        self.created += 1
+        file_id = f'file_{self.created}_{purpose}'
+        self.files[file_id] = content
+        return {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': 0,
+                'filename': f'{purpose}.jsonl', 'purpose': purpose, 'status': 'processed'}
+
+    def __process(self, batch: dict):
+        output = []
+        for line in self.files[batch['input_file_id']].decode().splitlines():
+            request = json.loads(line)
+            self.requests.append(request['body'])
+            output.append(json.dumps({'id': 'response', 'custom_id': request['custom_id'], 'response': {
+                'status_code': 200,
+                'body': {'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0,
+                         'model': request['body']['model'],
+                         'choices': [{'index': 0, 'finish_reason': 'stop',
+                                      'message': {'role': 'assistant', 'content': self.answer(request['body'])}}],
+                         'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}}
+            }}))
+        batch['status'] = 'completed'
+        batch['output_file_id'] = self.__file('\n'.join(output).encode(), 'batch_output')['id']
+
+
+def openai_client(stand_in) -> openai.AsyncOpenAI:
+    """
+    Creates an OpenAI client whose requests are answered by the given stand-in.
+    """
+    return openai.AsyncOpenAI(api_key='test', base_url='http://openai.test/v1', max_retries=0,
+                              http_client=httpx.AsyncClient(transport=httpx.MockTransport(stand_in)))
+
+
+def create_helper(stand_in, jobs_dir, **config) -> OpenAIHelper:
+    """
+    Creates an OpenAIHelper whose OpenAI requests are answered by the given stand-in.
+    """
+    config = {
+        'api_key': 'test', 'model': 'gpt-3.5-turbo', 'max_tokens': 1200, 'temperature': 1.0,
+        'presence_penalty': 0.0, 'frequency_penalty': 0.0, 'assistant_prompt': 'You are a helpful assistant.',
+        'bot_language': 'en', 'max_conversation_age_minutes': 180, 'max_history_size': 15, 'n_choices': 1,
+        'summarisation_threshold': 0.8, 'functions_max_consecutive_calls': 10,
+        'response_cache': 'off', 'enable_functions': False, 'show_usage': False, 'show_plugins_used': False,
+        'jobs_dir': str(jobs_dir), **config
+    }
+    helper = OpenAIHelper(config=config, plugin_manager=None)
+    helper.client = openai_client(stand_in)
+    helper.providers = ProviderRouter([OpenAIProvider('openai', helper.client)])
+    return helper
@@ -0,0 +1,71 @@
+import asyncio
+
+from stand_ins import BatchAPIStandIn, create_helper
+
+
+def create_batch_helper(stand_in, jobs_dir, **config):
+    return create_helper(stand_in, jobs_dir, batch_api=True, batch_poll_interval=0, **config)
+
+
+def test_chain_goes_through_batches(tmp_path):
+    stand_in = BatchAPIStandIn()
+    helper = create_batch_helper(stand_in, tmp_path)
+
+    answer = asyncio.run(helper.complete_chain('job', ['one', 'two', 'three'], metadata={'chat_id': 1}, batch=True))
+
+    assert answer == 'answer to three'
+    assert len(stand_in.batches) == 3
+    assert [message['content'] for message in stand_in.requests[2]['messages']] == [
+        'You are a helpful assistant.', 'one', 'answer to one', 'two', 'answer to two', 'three']
+    assert not any(file_id.endswith('_batch') for file_id in stand_in.files)  # input files are deleted
+    assert helper.pending_chains() == {'job': {'chat_id': 1}}
+    helper.finish_chain('job')
+    assert helper.pending_chains() == {}
+
+
+def test_chain_resumes_its_pending_batch_after_a_restart(tmp_path):
+    stand_in = BatchAPIStandIn()
+    helper = create_batch_helper(stand_in, tmp_path)
+
+    stand_in.hold_from = 1  # the second step is still being processed when the bot stops
+
+    async def run_until_second_batch():
+        task = asyncio.create_task(helper.complete_chain('job', ['one', 'two', 'three'], batch=True))
+        while len(stand_in.batches) < 2 and not task.done():
+            await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run_until_second_batch())
+    assert stand_in.batches['batch_1']['status'] == 'in_progress'
+
+    # The bot restarts
+    stand_in.hold_from = None
+    stand_in.held.clear()
+    restarted = create_batch_helper(stand_in, tmp_path)
+    assert list(restarted.pending_chains()) == ['job']
+    answer = asyncio.run(restarted.resume_chain('job'))
+
+    assert answer == 'answer to three'
+    assert len(stand_in.batches) == 3  # the second step was waited for, not submitted again
+    assert [body['messages'][-1]['content'] for body in stand_in.requests] == ['one', 'two', 'three']
+
+
+def test_batch_requests_are_fitted_to_the_context_window(tmp_path):
+    stand_in = BatchAPIStandIn()
+    helper = create_batch_helper(stand_in, tmp_path, max_tokens=4000)
+
+    asyncio.run(helper.complete([{'role': 'user', 'content': 'word ' * 500}], batch=True))
+
+    body = stand_in.requests[0]
+    assert body['model'] == 'gpt-3.5-turbo'
+    assert 0 < body['max_tokens'] < 4096 - 500
+
+
+def test_batch_requests_are_routed_to_the_large_context_model(tmp_path):
+    stand_in = BatchAPIStandIn()
+    helper = create_batch_helper(stand_in, tmp_path, large_context_model='gpt-3.5-turbo-16k')
+
+    asyncio.run(helper.complete([{'role': 'user', 'content': 'word ' * 4000}], batch=True))
+
+    assert stand_in.requests[0]['model'] == 'gpt-3.5-turbo-16k'
@@ -0,0 +1,50 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from cassette import CassetteTransport
+from stand_ins import OpenAIStandIn
+
+MESSAGES = [{'role': 'user', 'content': 'Hi'}]
+
+
+def openai_client(transport) -> openai.AsyncOpenAI:
+    return openai.AsyncOpenAI(api_key='test', base_url='http://openai.test/v1', max_retries=0,
+                              http_client=httpx.AsyncClient(transport=transport))
+
+
+def complete(client, **kwargs):
+    async def _complete():
+        response = await client.chat.completions.create(model='gpt-3.5-turbo', messages=MESSAGES, **kwargs)
+        if not kwargs.get('stream'):
+            return response.choices[0].message.content
+        return ''.join([chunk.choices[0].delta.content async for chunk in response if chunk.choices])
+    return asyncio.run(_complete())
+
+
+def test_records_and_replays_responses_and_streams(tmp_path):
+    path = str(tmp_path / 'cassettes' / 'openai.json')
+    stand_in = OpenAIStandIn(answer='Recorded')
+    recorder = CassetteTransport(path, 'record', transport=httpx.MockTransport(stand_in))
+
+    assert complete(openai_client(recorder)) == 'Recorded'
+    assert complete(openai_client(recorder), stream=True) == 'Recorded'
+    assert len(stand_in.requests) == 2
+
+    # Replayed without a transport, i.e. without a network
+    player = CassetteTransport(path, 'replay', preserve_latency=True)
+    assert complete(openai_client(player), stream=True) == 'Recorded'
+    assert complete(openai_client(player)) == 'Recorded'
+    assert len(stand_in.requests) == 2
+
+
+def test_replay_fails_for_requests_that_were_not_recorded(tmp_path):
+    path = str(tmp_path / 'openai.json')
+    recorder = CassetteTransport(path, 'record', transport=httpx.MockTransport(OpenAIStandIn()))
+    complete(openai_client(recorder))
+
+    player = CassetteTransport(path, 'replay')
+    with pytest.raises(openai.APIConnectionError):
+        complete(openai_client(player), temperature=0.5)
@@ -0,0 +1,83 @@
+import asyncio
+
+from chat_queue import ChatQueue
+
+
+def test_requests_of_a_chat_run_one_at_a_time_in_order():
+    queue = ChatQueue()
+    events = []
+
+    async def request(name, chat_id=1):
+        async with queue.turn(chat_id):
+            events.append(f'{name} start')
+            await asyncio.sleep(0.01)
+            events.append(f'{name} end')
+
+    async def _test():
+        await asyncio.gather(request('a'), request('b'), request('c'))
+
+    asyncio.run(_test())
+    assert events == ['a start', 'a end', 'b start', 'b end', 'c start', 'c end']
+    assert queue.locks == {} and queue.waiting == {}
+
+
+def test_requests_of_different_chats_run_in_parallel():
+    queue = ChatQueue()
+    running = []
+    peak = []
+
+    async def request(chat_id):
+        async with queue.turn(chat_id):
+            running.append(chat_id)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(chat_id)
+
+    async def _test():
+        await asyncio.gather(request(1), request(2), request(3))
+
+    asyncio.run(_test())
+    assert max(peak) == 3
+
+
+def test_queued_queries_are_merged_into_the_first_queued_request():
+    queue = ChatQueue(coalesce=True)
+    sent = {}
+
+    async def request(name, query):
+        async with queue.turn(1, query) as merged:
+            sent[name] = merged
+            await asyncio.sleep(0.01)
+
+    async def _test():
+        first = asyncio.create_task(request('first', 'one'))
+        await asyncio.sleep(0)  # the first request holds the turn while the others queue up
+        assert queue.busy(1)
+        await asyncio.gather(first, request('second', 'two'), request('third', 'three'))
+
+    asyncio.run(_test())
+    assert sent == {'first': 'one', 'second': 'two\n\nthree', 'third': None}
+    assert not queue.busy(1) and queue.pending == {}
+
+
+def test_query_of_a_request_cancelled_while_queued_is_dropped():
+    queue = ChatQueue(coalesce=True)
+    sent = []
+
+    async def request(query):
+        async with queue.turn(1, query) as merged:
+            sent.append(merged)
+            await asyncio.sleep(0.02)
+
+    async def _test():
+        first = asyncio.create_task(request('one'))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(request('two'))
+        last = asyncio.create_task(request('three'))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(first, cancelled, last, return_exceptions=True)
+
+    asyncio.run(_test())
+    assert sent == ['one', 'three']
+    assert queue.locks == {} and queue.waiting == {} and queue.pending == {}
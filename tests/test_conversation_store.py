@@ -0,0 +1,66 @@
+import asyncio
+import threading
+import time
+
+from conversation import Conversation
+from conversation_store import LRUConversationStore, SQLiteConversationStore
+from image_store import ImageStore
+from stand_ins import OpenAIStandIn, create_helper
+
+
+def conversation(text='Hi') -> Conversation:
+    conversation = Conversation()
+    conversation.append({'role': 'user', 'content': text}, 5)
+    return conversation
+
+
+def test_conversation_with_a_request_in_flight_is_not_evicted():
+    busy = {1}
+    store = LRUConversationStore(max_conversations=1, in_use=lambda chat_id: chat_id in busy)
+    store[1] = conversation()
+    store[2] = conversation()
+    store[3] = conversation()
+
+    assert 1 in store and 3 in store and 2 not in store
+
+    busy.clear()
+    store[4] = conversation()
+    assert list(store.conversations) == [4]
+
+
+def test_chat_keeps_its_conversation_while_other_chats_fill_the_store(tmp_path):
+    helper = create_helper(OpenAIStandIn(delay=0.1), tmp_path, max_conversations=1)
+
+    async def chat(chat_id):
+        return [answer async for answer, _ in helper.get_chat_response_stream(chat_id, 'Hi')][-1]
+
+    async def _test():
+        return await asyncio.gather(chat(1), chat(2), chat(3))
+
+    assert asyncio.run(_test()) == ['Hello', 'Hello', 'Hello']
+
+
+def test_reads_do_not_wait_for_a_batch_being_written(tmp_path):
+    path = str(tmp_path / 'conversations.db')
+    store = SQLiteConversationStore(path, ImageStore())
+    store[1] = conversation('saved')
+    store.close()
+
+    store = SQLiteConversationStore(path, ImageStore())
+    writing = threading.Event()
+
+    def write_batch():
+        with store.lock:  # as the worker thread does for a whole batch
+            writing.set()
+            time.sleep(1.0)
+
+    writer = threading.Thread(target=write_batch)
+    writer.start()
+    writing.wait()
+    start = time.monotonic()
+    assert 1 in store
+    assert store.get(1).messages == [{'role': 'user', 'content': 'saved'}]
+    assert len(store) == 1
+    assert time.monotonic() - start < 0.5
+    writer.join()
+    store.close()
@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import httpx
+
+from stand_ins import create_helper
+
+
+class ToolCallingStandIn:
+    """
+    A stand-in for the chat completions endpoint that asks for the given tool calls first, then answers.
+    """
+
+    def __init__(self, tool_calls: int):
+        self.tool_calls = tool_calls
+        self.requests = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self.requests.append(body)
+        if len(self.requests) == 1:
+            message = {'role': 'assistant', 'content': None, 'tool_calls': [
+                {'id': f'call_{index}', 'type': 'function',
+                 'function': {'name': 'lookup', 'arguments': json.dumps({'index': index})}}
+                for index in range(self.tool_calls)
+            ]}
+        else:
+            message = {'role': 'assistant', 'content': 'Hello'}
+        return httpx.Response(200, json={
+            'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 2, 'total_tokens': 12}
+        })
+
+
+class PluginManager:
+    def __init__(self):
+        self.calls = []
+
+    def get_functions_specs(self):
+        return [{'name': 'lookup', 'parameters': {'type': 'object', 'properties': {'index': {'type': 'integer'}}}}]
+
+    async def call_function(self, name, helper, arguments):
+        self.calls.append(json.loads(arguments)['index'])
+        return json.dumps({'result': 'found'})
+
+    def get_plugin_source_name(self, name):
+        return name
+
+
+def test_parallel_tool_calls_beyond_the_limit_are_not_run(tmp_path):
+    stand_in = ToolCallingStandIn(tool_calls=3)
+    helper = create_helper(stand_in, tmp_path, enable_functions=True, functions_max_consecutive_calls=2)
+    helper.plugin_manager = PluginManager()
+
+    answer, _ = asyncio.run(helper.get_chat_response(1, 'Hi'))
+
+    assert answer == 'Hello'
+    assert helper.plugin_manager.calls == [0, 1]
+    follow_up = stand_in.requests[1]
+    assert follow_up['tool_choice'] == 'none'
+    results = [message for message in follow_up['messages'] if message['role'] == 'tool']
+    assert [result['tool_call_id'] for result in results] == ['call_0', 'call_1', 'call_2']
+    assert 'error' in json.loads(results[2]['content'])
@@ -0,0 +1,77 @@
+import asyncio
+
+from hedging import HedgePolicy
+
+
+class Admissions:
+    """
+    Stands in for the rate limiter: every attempt waits for the given delay before it is admitted.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.granted = 0
+
+    async def __call__(self):
+        await asyncio.sleep(self.delay)
+        self.granted += 1
+        return self.granted
+
+
+def test_request_queued_for_its_rate_limit_is_not_hedged():
+    policy = HedgePolicy(budget_percent=100, initial_delay=0.05)
+    admissions = Admissions(delay=0.2)
+
+    async def attempt(reservation):
+        await asyncio.sleep(0.01)
+        return reservation
+
+    assert asyncio.run(policy.call('model', attempt, admit=admissions)) == 1
+    assert policy.hedges == 0
+    assert admissions.granted == 1
+    assert max(policy.latencies['model']) < 0.2  # the wait for the rate limit is not learned as latency
+
+
+def test_slow_request_is_hedged_with_its_own_reservation():
+    policy = HedgePolicy(budget_percent=100, initial_delay=0.05)
+    admissions = Admissions()
+    delays = {1: 1.0, 2: 0.01}  # the first reservation belongs to the slow original request
+
+    async def attempt(reservation):
+        await asyncio.sleep(delays[reservation])
+        return reservation
+
+    assert asyncio.run(policy.call('model', attempt, admit=admissions)) == 2
+    assert policy.hedges == 1 and policy.wins == 1
+    assert admissions.granted == 2
+
+
+def test_hedge_waiting_for_its_reservation_is_cancelled_without_taking_it():
+    policy = HedgePolicy(budget_percent=100, initial_delay=0.05)
+    admissions = Admissions(delay=0.0)
+
+    async def attempt(reservation):
+        admissions.delay = 1.0  # the hedge is still queued when the original request answers
+        await asyncio.sleep(0.1)
+        return reservation
+
+    assert asyncio.run(policy.call('model', attempt, admit=admissions)) == 1
+    assert policy.hedges == 1 and policy.wins == 0
+    assert admissions.granted == 1
+
+
+def test_hedges_stay_within_their_budget_from_the_first_request():
+    policy = HedgePolicy(budget_percent=10, initial_delay=0.01)
+
+    async def attempt(_):
+        await asyncio.sleep(0.02)
+        return 'answer'
+
+    async def _test():
+        for _ in range(20):
+            await policy.call('model', attempt)
+
+    asyncio.run(_test())
+    # Every request is slow, but only one in ten may be hedged, and not the first one
+    assert policy.hedges == 2
+    assert policy.stats()['hedge_rate'] <= 0.1
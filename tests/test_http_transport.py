@@ -0,0 +1,47 @@
+import httpx
+
+from http_transport import EnvironmentProxyTransport, create_http_client
+
+
+def test_proxy_environment_variables_are_respected_without_a_configured_proxy(monkeypatch):
+    monkeypatch.setenv('HTTPS_PROXY', 'http://proxy.test:3128')
+    monkeypatch.setenv('NO_PROXY', 'internal.test')
+
+    _, pooled_transport = create_http_client({})
+
+    transport = pooled_transport.transport
+    assert isinstance(transport, EnvironmentProxyTransport)
+    assert transport.route(httpx.URL('https://api.openai.com/v1/chat/completions')) is not transport.direct
+    assert transport.route(httpx.URL('https://internal.test/v1')) is transport.direct
+    assert transport.route(httpx.URL('http://api.openai.com/v1')) is transport.direct
+    assert pooled_transport.stats()['connections'] == 0
+
+
+def test_configured_proxy_overrides_the_environment(monkeypatch):
+    monkeypatch.setenv('HTTPS_PROXY', 'http://proxy.test:3128')
+
+    _, pooled_transport = create_http_client({'proxy': 'http://configured.test:8080'})
+
+    assert isinstance(pooled_transport.transport, httpx.AsyncHTTPTransport)
+
+
+def test_no_proxy_without_configuration_or_environment(monkeypatch):
+    for name in ('HTTP_PROXY', 'HTTPS_PROXY', 'ALL_PROXY', 'http_proxy', 'https_proxy', 'all_proxy'):
+        monkeypatch.delenv(name, raising=False)
+
+    _, pooled_transport = create_http_client({})
+
+    assert isinstance(pooled_transport.transport, httpx.AsyncHTTPTransport)
+
+
+def test_all_proxy_covers_the_schemes_without_their_own_proxy(monkeypatch):
+    for name in ('HTTP_PROXY', 'HTTPS_PROXY', 'NO_PROXY', 'http_proxy', 'https_proxy', 'no_proxy'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('all_proxy', 'proxy.test:3128')
+
+    _, pooled_transport = create_http_client({})
+
+    transport = pooled_transport.transport
+    assert isinstance(transport, EnvironmentProxyTransport)
+    assert transport.route(httpx.URL('http://api.openai.com/v1')) is transport.proxied['all']
+    assert transport.route(httpx.URL('https://api.openai.com/v1')) is transport.proxied['all']
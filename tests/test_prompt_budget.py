@@ -0,0 +1,93 @@
+import asyncio
+
+from encodings_registry import get_encoding
+from prompt_templates import PromptTemplate, render_prompt
+from stand_ins import OpenAIStandIn, create_helper
+
+MODEL = 'gpt-3.5-turbo'
+SUBTITLES = 'word ' * 20000  # far more than the budget of 12000 tokens of the seo template
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding(MODEL).encode(text))
+
+
+def test_values_are_cut_to_the_budget_of_the_template():
+    template = PromptTemplate('summary', 'Summarise these subtitles: {subtitles}', budget=300)
+
+    prompt, tokens = template.render(MODEL, subtitles=SUBTITLES)
+
+    assert tokens == count_tokens(prompt)
+    assert 300 - 5 <= tokens <= 300
+    assert prompt.startswith('Summarise these subtitles: word word')
+
+
+def test_short_values_are_kept_whole_and_long_ones_share_the_rest():
+    template = PromptTemplate('compare', 'Title: {title}. First: {first}. Second: {second}', budget=400)
+
+    prompt, tokens = template.render(MODEL, title='A short title', first=SUBTITLES, second=SUBTITLES)
+
+    assert tokens <= 400
+    assert 'Title: A short title.' in prompt
+    first = prompt.split('First: ')[1].split('. Second: ')[0]
+    second = prompt.split('. Second: ')[1]
+    assert abs(count_tokens(first) - count_tokens(second)) <= 2
+
+
+def test_limit_caps_the_budget_of_the_template():
+    template = PromptTemplate('summary', 'Summarise these subtitles: {subtitles}', budget=500)
+
+    _, tokens = template.render(MODEL, limit=200, subtitles=SUBTITLES)
+
+    assert 200 - 5 <= tokens <= 200
+
+
+def test_limit_is_the_budget_of_a_template_without_one():
+    template = PromptTemplate('summary', 'Summarise these subtitles: {subtitles}')
+
+    _, tokens = template.render(MODEL, limit=150, subtitles=SUBTITLES)
+
+    assert 150 - 5 <= tokens <= 150
+
+
+def test_values_within_the_budget_are_not_cut():
+    template = PromptTemplate('summary', 'Summarise these subtitles: {subtitles}', budget=500)
+
+    prompt, tokens = template.render(MODEL, limit=200, subtitles='a short video')
+
+    assert prompt == 'Summarise these subtitles: a short video'
+    assert tokens == count_tokens(prompt)
+
+
+def test_loaded_template_keeps_its_budget_below_a_larger_limit():
+    _, tokens = render_prompt('seo', 'gpt-3.5-turbo-16k', limit=15000, subtitles=SUBTITLES)
+
+    assert 12000 - 5 <= tokens <= 12000
+
+
+def test_helper_caps_the_budget_at_the_room_left_in_the_context_window(tmp_path):
+    helper = create_helper(OpenAIStandIn(), tmp_path)
+
+    _, prompt_tokens = helper.render_prompt('seo', subtitles=SUBTITLES)
+
+    # The system prompt, the message and the completion of 1200 tokens share the 4096 tokens of gpt-3.5-turbo
+    assert 4096 - 1200 - 50 < prompt_tokens <= 4096 - 1200
+
+
+def test_prompt_leaves_room_for_its_answer_and_a_follow_up(tmp_path):
+    stand_in = OpenAIStandIn(answer='word ' * 3999)  # an answer of the full max_tokens
+    helper = create_helper(stand_in, tmp_path, model='gpt-3.5-turbo-16k', max_tokens=4000)
+
+    tags_query, tags_query_tokens = helper.render_prompt('tags')
+    seo_query, seo_query_tokens = helper.render_prompt('seo', follow_up_tokens=tags_query_tokens,
+                                                       subtitles=SUBTITLES)
+
+    async def _test():
+        messages = [{'role': 'user', 'content': seo_query}]
+        answer, _ = await helper.complete(messages, prompt_tokens=seo_query_tokens)
+        await helper.complete(messages + [{'role': 'assistant', 'content': answer},
+                                          {'role': 'user', 'content': tags_query}])
+
+    asyncio.run(_test())
+
+    assert [body['max_tokens'] for body in stand_in.requests] == [4000, 4000]
@@ -0,0 +1,126 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from providers import OpenAIProvider, ProviderRouter, YandexGPTProvider
+from stand_ins import OpenAIStandIn, YandexGPTStandIn, openai_client
+
+MESSAGES = [{'role': 'system', 'content': 'You are a helpful assistant.'}, {'role': 'user', 'content': 'Hi'}]
+
+
+def openai_provider(name, stand_in) -> OpenAIProvider:
+    return OpenAIProvider(name, openai_client(stand_in))
+
+
+def yandexgpt_provider(name, stand_in) -> YandexGPTProvider:
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(stand_in))
+    return YandexGPTProvider(name, http_client, api_key='key', folder_id='folder',
+                             base_url='http://yandex.test/foundationModels/v1')
+
+
+def complete(router, **kwargs):
+    request = {'model': 'gpt-3.5-turbo', 'messages': MESSAGES, **kwargs}
+    return asyncio.run(router.call(lambda provider: provider.create_chat_completion(**request), **request))
+
+
+def test_yandexgpt_provider_translates_request_and_response():
+    stand_in = YandexGPTStandIn()
+    provider = yandexgpt_provider('yandexgpt', stand_in)
+
+    response = asyncio.run(provider.create_chat_completion(model='gpt-3.5-turbo', messages=MESSAGES,
+                                                           temperature=1.5, max_tokens=100))
+
+    headers, body = stand_in.requests[0]
+    assert headers['authorization'] == 'Api-Key key'
+    assert body['modelUri'] == 'gpt://folder/yandexgpt-lite/latest'
+    assert body['completionOptions'] == {'stream': False, 'temperature': 1.0, 'maxTokens': '100'}
+    assert body['messages'] == [{'role': 'system', 'text': 'You are a helpful assistant.'},
+                                {'role': 'user', 'text': 'Hi'}]
+    assert response.choices[0].message.content == 'Привет'
+    assert response.usage.total_tokens == 11
+
+
+def test_yandexgpt_provider_does_not_support_streams_or_tools():
+    provider = yandexgpt_provider('yandexgpt', YandexGPTStandIn())
+    assert provider.supports(messages=MESSAGES)
+    assert not provider.supports(messages=MESSAGES, stream=True)
+    assert not provider.supports(messages=MESSAGES, tools=[{'type': 'function'}])
+
+
+def test_fails_over_on_server_error_and_cools_the_provider_down():
+    primary, fallback = OpenAIStandIn(status_code=500), YandexGPTStandIn()
+    router = ProviderRouter([openai_provider('openai', primary), yandexgpt_provider('yandexgpt', fallback)],
+                            cooldown=60)
+
+    response = complete(router)
+
+    assert response.choices[0].message.content == 'Привет'
+    assert len(primary.requests) == 1 and len(fallback.requests) == 1
+    assert not router.stats()['openai']['healthy']
+    assert [provider.name for provider in router.candidates(messages=MESSAGES)] == ['yandexgpt', 'openai']
+
+
+def test_failing_provider_is_tried_again_after_its_cooldown():
+    primary, fallback = OpenAIStandIn(status_code=503), YandexGPTStandIn()
+    router = ProviderRouter([openai_provider('openai', primary), yandexgpt_provider('yandexgpt', fallback)],
+                            cooldown=0.05)
+    complete(router)
+    primary.status_code = 200
+
+    asyncio.run(asyncio.sleep(0.1))
+    response = complete(router)
+
+    assert router.stats()['openai']['healthy']
+    assert response.choices[0].message.content == 'Hello'
+    assert len(primary.requests) == 2 and len(fallback.requests) == 1
+
+
+def test_client_errors_are_raised_without_failing_over():
+    primary, fallback = OpenAIStandIn(status_code=400), YandexGPTStandIn()
+    router = ProviderRouter([openai_provider('openai', primary), yandexgpt_provider('yandexgpt', fallback)])
+
+    with pytest.raises(openai.BadRequestError):
+        complete(router)
+
+    assert fallback.requests == []
+    assert router.stats()['openai']['healthy']
+    assert router.stats()['openai']['failures'] == 0
+
+
+def test_orders_providers_by_latency():
+    slow, fast = OpenAIStandIn(answer='slow', delay=0.05), OpenAIStandIn(answer='fast')
+    router = ProviderRouter([openai_provider('slow', slow), openai_provider('fast', fast)])
+
+    # A provider that has not answered yet is tried before the providers are compared
+    assert complete(router).choices[0].message.content == 'slow'
+    assert complete(router).choices[0].message.content == 'fast'
+    assert complete(router).choices[0].message.content == 'fast'
+
+    assert [provider.name for provider in router.candidates(messages=MESSAGES)] == ['fast', 'slow']
+    assert len(slow.requests) == 1 and len(fast.requests) == 2
+
+
+def test_slow_first_token_of_a_stream_fails_over():
+    slow, fast = OpenAIStandIn(answer='slow', delay=1.0), OpenAIStandIn(answer='fast')
+    router = ProviderRouter([openai_provider('slow', slow), openai_provider('fast', fast)], slow_timeout=0.1)
+
+    async def first_chunk(stream):
+        async for chunk in stream:
+            return chunk.choices[0].delta.content
+
+    assert asyncio.run(first_chunk(complete(router, stream=True))) == 'fast'
+    assert not router.stats()['slow']['healthy']
+
+
+def test_slow_timeout_does_not_apply_to_whole_responses():
+    slow, fast = OpenAIStandIn(answer='slow', delay=0.2), OpenAIStandIn(answer='fast')
+    router = ProviderRouter([openai_provider('slow', slow), openai_provider('fast', fast)], slow_timeout=0.1)
+
+    assert complete(router).choices[0].message.content == 'slow'
+    assert fast.requests == []
+
+    router = ProviderRouter([openai_provider('slow', slow), openai_provider('fast', fast)],
+                            slow_timeout=0.1, response_timeout=0.1)
+    assert complete(router).choices[0].message.content == 'fast'
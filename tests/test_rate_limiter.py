@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+from rate_limiter import RateLimiter
+
+
+def available(limiter, model='gpt-3.5-turbo') -> float:
+    return limiter.limiters[model].tokens.available
+
+
+def test_reservation_is_settled_with_the_actual_usage():
+    limiter = RateLimiter(tokens_per_minute=60000)
+
+    reservation = asyncio.run(limiter.acquire('gpt-3.5-turbo', 3000))
+    assert round(available(limiter)) == 57000
+
+    limiter.settle(reservation, 1000)  # the unused completion is given back
+    assert round(available(limiter)) == 59000
+    limiter.settle(reservation, 1500)  # settling again only takes the difference
+    assert round(available(limiter)) == 58500
+    limiter.release(reservation)
+    assert round(available(limiter)) == 60000
+    assert reservation.tokens == 0
+
+
+def test_usage_above_the_reservation_is_taken_from_the_budget():
+    limiter = RateLimiter(tokens_per_minute=60000)
+
+    reservation = asyncio.run(limiter.acquire('gpt-3.5-turbo', 1000))
+    limiter.settle(reservation, 4000)
+
+    assert round(available(limiter)) == 56000
+
+
+def test_request_waits_until_the_budget_has_refilled():
+    limiter = RateLimiter(tokens_per_minute=6000)  # refills 100 tokens per second
+
+    async def _test():
+        await limiter.acquire('gpt-3.5-turbo', 6000)
+        start = time.monotonic()
+        await limiter.acquire('gpt-3.5-turbo', 20)
+        return time.monotonic() - start
+
+    assert 0.15 < asyncio.run(_test()) < 1.0
+
+
+def test_waiting_requests_are_served_in_order():
+    limiter = RateLimiter(tokens_per_minute=6000)
+    served = []
+
+    async def request(name, tokens):
+        await limiter.acquire('gpt-3.5-turbo', tokens)
+        served.append(name)
+
+    async def _test():
+        await limiter.acquire('gpt-3.5-turbo', 6000)
+        # The small request does not overtake the large one, which waits for the budget to refill
+        await asyncio.gather(request('large', 30), request('small', 1))
+
+    asyncio.run(_test())
+    assert served == ['large', 'small']
+
+
+def test_models_have_their_own_limits():
+    limiter = RateLimiter(requests_per_minute=0, tokens_per_minute=0,
+                          model_limits=RateLimiter.parse_model_limits('gpt-4:10:1000, gpt-3.5-turbo:0:0, bad'))
+
+    assert limiter.model_limits == {'gpt-4': (10, 1000), 'gpt-3.5-turbo': (0, 0)}
+
+    async def _test():
+        await limiter.acquire('gpt-3.5-turbo', 10 ** 9)  # no limit
+        return await limiter.acquire('gpt-4', 500)
+
+    reservation = asyncio.run(_test())
+    assert reservation.model == 'gpt-4'
+    assert round(available(limiter, 'gpt-4')) == 500
+    assert limiter.limiters['gpt-3.5-turbo'] is None
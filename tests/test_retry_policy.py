@@ -0,0 +1,90 @@
+import asyncio
+import datetime
+from email.utils import format_datetime
+
+import httpx
+import openai
+import pytest
+
+from retry_policy import RetryPolicy, is_retryable, parse_duration, retry_after
+
+
+def status_error(status_code, headers=None) -> openai.APIStatusError:
+    response = httpx.Response(status_code, headers=headers or {},
+                              request=httpx.Request('POST', 'http://openai.test/v1/chat/completions'))
+    return openai.APIStatusError('stand-in error', response=response, body=None)
+
+
+@pytest.mark.parametrize('value, seconds', [
+    ('20ms', 0.02), ('1s', 1.0), ('1.5s', 1.5), ('6m0s', 360.0), ('1h2m3s', 3723.0), (' 7s ', 7.0),
+])
+def test_parses_durations(value, seconds):
+    assert parse_duration(value) == pytest.approx(seconds)
+
+
+@pytest.mark.parametrize('value', ['', 'abc', '5', '1s later', '1d'])
+def test_does_not_parse_other_values(value):
+    assert parse_duration(value) is None
+
+
+def test_retry_after_prefers_the_most_precise_header():
+    assert retry_after(status_error(429, {'retry-after-ms': '250', 'retry-after': '3'})) == 0.25
+    assert retry_after(status_error(429, {'retry-after': '3'})) == 3.0
+    assert retry_after(status_error(429, {'x-ratelimit-reset-requests': '6m0s'})) == 360.0
+    assert retry_after(status_error(429, {'x-ratelimit-reset-requests': 'soon',
+                                          'x-ratelimit-reset-tokens': '20ms'})) == 0.02
+    assert retry_after(status_error(429)) is None
+    assert retry_after(ValueError()) is None
+
+
+def test_retry_after_accepts_an_http_date():
+    date = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+    assert 25 < retry_after(status_error(503, {'retry-after': format_datetime(date, usegmt=True)})) <= 30
+    past = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=30)
+    assert retry_after(status_error(503, {'retry-after': format_datetime(past, usegmt=True)})) == 0
+
+
+def test_only_transient_errors_are_retryable():
+    request = httpx.Request('POST', 'http://openai.test/v1/chat/completions')
+    assert all(is_retryable(status_error(code)) for code in (408, 409, 429, 500, 503))
+    assert not any(is_retryable(status_error(code)) for code in (400, 401, 403, 404, 422))
+    assert is_retryable(openai.APIConnectionError(request=request))
+    assert is_retryable(httpx.ConnectTimeout('timeout'))
+    assert not is_retryable(ValueError())
+
+
+def test_waits_as_long_as_the_server_asks_with_a_little_jitter():
+    policy = RetryPolicy(initial_wait=1.0, max_wait=60.0)
+
+    assert 5.0 <= policy.wait_time(1, status_error(429, {'retry-after': '5'})) <= 6.0
+    assert policy.wait_time(1, status_error(429, {'retry-after': '600'})) == 60.0
+    assert all(0 <= policy.wait_time(attempt, None) <= min(2 ** (attempt - 1), 60.0) for attempt in range(1, 10))
+
+
+def test_retries_transient_errors_until_the_request_succeeds():
+    policy = RetryPolicy(max_attempts=3, initial_wait=0.01)
+    attempts = []
+
+    async def request():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise status_error(503, {'retry-after-ms': '1'})
+        return 'answer'
+
+    assert asyncio.run(policy.call(request)) == 'answer'
+    assert len(attempts) == 3
+
+
+def test_gives_up_after_the_last_attempt_and_on_client_errors():
+    policy = RetryPolicy(max_attempts=2, initial_wait=0.01)
+    attempts = []
+
+    async def request(status_code):
+        attempts.append(status_code)
+        raise status_error(status_code, {'retry-after-ms': '1'})
+
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(policy.call(request, 500))
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(policy.call(request, 400))
+    assert attempts == [500, 500, 400]
@@ -0,0 +1,36 @@
+import asyncio
+
+from providers import OpenAIProvider, ProviderRouter
+from stand_ins import OpenAIStandIn, create_helper, openai_client
+
+
+async def chat(helper, query='Hi', chat_id=1) -> str:
+    return [answer async for answer, _ in helper.get_chat_response_stream(chat_id, query)][-1]
+
+
+def test_stream_of_a_slow_provider_is_closed_when_failing_over(tmp_path):
+    slow, fast = OpenAIStandIn(answer='slow', first_chunk_delay=5.0), OpenAIStandIn(answer='fast')
+    helper = create_helper(slow, tmp_path)
+    helper.providers = ProviderRouter([OpenAIProvider('slow', openai_client(slow)),
+                                       OpenAIProvider('fast', openai_client(fast))], slow_timeout=0.2)
+
+    async def _test():
+        # Checked before the event loop closes, which would finalise an abandoned stream anyway
+        assert await chat(helper) == 'fast'
+        assert slow.streams_opened == 1 and slow.streams_closed == 1
+        assert fast.streams_opened == 1 and fast.streams_closed == 1
+
+    asyncio.run(_test())
+
+
+def test_stream_without_reported_usage_is_settled_with_its_counted_tokens(tmp_path):
+    stand_in = OpenAIStandIn(answer='word ' * 100, usage=False)
+    helper = create_helper(stand_in, tmp_path)
+    settle = helper.rate_limiter.settle
+    settled = []
+    helper.rate_limiter.settle = lambda reservation, tokens: settled.append(tokens) or settle(reservation, tokens)
+
+    asyncio.run(chat(helper))
+
+    assert len(settled) == 1
+    assert 100 < settled[0] < 1200  # the prompt and the answer, not only the prompt nor the whole reservation
@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+from usage_stream import UsageStream
+
+
+class Chunks:
+    """
+    A stream of chat completion chunks, optionally ending with the usage.
+    """
+
+    def __init__(self, texts, usage=None):
+        self.chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+                       for text in texts]
+        if usage is not None:
+            self.chunks.append(SimpleNamespace(choices=[], usage=usage))
+        self.closed = False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+def read(stream, chunks=None):
+    async def _read():
+        await stream.prime()
+        read_chunks = 0
+        async for _ in stream:
+            read_chunks += 1
+            if read_chunks == chunks:
+                break
+        await stream.close()
+    asyncio.run(_read())
+
+
+def test_reported_usage_is_passed_on():
+    settled = []
+    stream = UsageStream(Chunks(['Hello', ' world'], usage=SimpleNamespace(total_tokens=12)),
+                         on_usage=lambda usage: settled.append(usage.total_tokens),
+                         on_abort=lambda: settled.append('abort'), on_end=lambda text: settled.append(text))
+    read(stream)
+    assert settled == [12]
+    assert stream.stream.closed
+
+
+def test_stream_read_to_the_end_without_usage_is_not_aborted():
+    settled = []
+    stream = UsageStream(Chunks(['Hello', ' world']),
+                         on_abort=lambda: settled.append('abort'), on_end=lambda text: settled.append(text))
+    read(stream)
+    assert settled == ['Hello world']
+
+
+def test_stream_closed_early_is_aborted():
+    settled = []
+    stream = UsageStream(Chunks(['Hello', ' world', '!'], usage=SimpleNamespace(total_tokens=12)),
+                         on_abort=lambda: settled.append('abort'), on_end=lambda text: settled.append(text))
+    read(stream, chunks=1)
+    assert settled == ['abort']